@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2014, sdmac
+# All rights reserved.
+###
+
+"""
+Offline maintenance tool for the BeerMe databases.  Run it from the bot's
+directory while the bot is stopped, e.g.
+
+    python plugins/BeerMe/beerdb.py import-cdb data
+    python plugins/BeerMe/beerdb.py export data '#beer' beer.jsonl
+    python plugins/BeerMe/beerdb.py import data '#beer' beer.csv
+    python plugins/BeerMe/beerdb.py --config bot.conf snapshot data '#beer'
+
+import, export and snapshot use the cdb databases unless --backend sqlite3 is
+given.  snapshot writes where the bot reads snapshots from, as set by
+supybot.plugins.BeerMe.snapshot.directory in the --config file if given.  Beers named without a beer_id are only looked up in the local
+catalog, as the tool doesn't talk to BreweryDB.
+"""
+
+import os
+import sys
+import optparse
+
+import supybot.conf as conf
+import supybot.registry as registry
+
+import plugin
+
+
+def importCdb(datadir):
+    filename = os.path.join(datadir, 'BeerMe.sqlite3.db')
+    if os.path.exists(filename):
+        sys.exit('%s already exists; refusing to import twice.' % filename)
+    review_db = plugin.BeerReviewSQLiteDB(filename)
+    tracker_db = plugin.BeerTrackerSQLiteDB(filename)
+    try:
+        (reviews, mentions) = plugin.importCdb(datadir, review_db, tracker_db)
+    finally:
+        review_db.close()
+        tracker_db.close()
+    print 'Imported %s reviews and %s mentions into %s.' % \
+          (reviews, mentions, filename)
+    print 'Set supybot.plugins.BeerMe.database to sqlite3 to use it.'
+
+
+def openDBs(datadir, backend):
+    types = {'cdb': (plugin.BeerReviewDB, plugin.BeerTrackerDB),
+             'sqlite3': (plugin.BeerReviewSQLiteDB,
+                         plugin.BeerTrackerSQLiteDB)}
+    filename = os.path.join(datadir, 'BeerMe.%s.db' % backend)
+    return [cls(filename) for cls in types[backend]]
+
+
+def importRecords(datadir, channel, filename, backend='cdb'):
+    catalog = None
+    if os.path.exists(os.path.join(datadir, 'BeerMe.catalog.db')):
+        catalog = plugin.BeerCatalog(os.path.join(datadir,
+                                                  'BeerMe.catalog.db'))
+    def resolve(names):
+        found = {}
+        for name in names:
+            hits = catalog and catalog.search(name, 'beer', 1)
+            if hits:
+                found[name] = hits[0]
+        return found
+    (review_db, tracker_db) = openDBs(datadir, backend)
+    fd = open(filename)
+    try:
+        (reviews, mentions, skipped) = plugin.importRecords(
+                plugin.readRecords(fd, plugin.recordFormat(filename)),
+                review_db, tracker_db, channel, resolve)
+    finally:
+        fd.close()
+        review_db.close()
+        tracker_db.close()
+        if catalog is not None:
+            catalog.close()
+    print 'Imported %s reviews and %s mentions, skipped %s rows.' % \
+          (reviews, mentions, skipped)
+
+
+def exportRecords(datadir, channel, filename=None, backend='cdb'):
+    (review_db, tracker_db) = openDBs(datadir, backend)
+    fd = filename and open(filename, 'w') or sys.stdout
+    try:
+        n = plugin.writeRecords(plugin.exportRecords(review_db, tracker_db,
+                                                     channel), fd)
+    finally:
+        if fd is not sys.stdout:
+            fd.close()
+        review_db.close()
+        tracker_db.close()
+    print >>sys.stderr, 'Exported %s rows.' % n
+
+
+def writeSnapshot(datadir, channel, filename=None, backend='cdb'):
+    if filename is None:
+        filename = plugin.snapshotFile(channel,
+                conf.supybot.plugins.BeerMe.snapshot.directory.get(channel)())
+    (review_db, tracker_db) = openDBs(datadir, backend)
+    try:
+        n = plugin.writeSnapshot(filename, review_db.iter_records(channel))
+    finally:
+        review_db.close()
+        tracker_db.close()
+    print 'Wrote %s beers to %s.' % (n, filename)
+
+
+# name: (function, minimum and maximum number of arguments)
+commands = {'import-cdb': (importCdb, 1, 1),
+            'import': (importRecords, 3, 3),
+            'export': (exportRecords, 2, 3),
+            'snapshot': (writeSnapshot, 2, 3)}
+
+def main():
+    parser = optparse.OptionParser(usage="""%prog import-cdb <datadir>
+       %prog [--backend B] import <datadir> <channel> <file>
+       %prog [--backend B] export <datadir> <channel> [<file>]
+       %prog [--backend B] [--config F] snapshot <datadir> <channel> [<file>]""")
+    parser.add_option('-b', '--backend', choices=['cdb', 'sqlite3'],
+                      help='database backend to import into or read from '
+                           '(cdb or sqlite3, default cdb)')
+    parser.add_option('-c', '--config', metavar='FILE',
+                      help="the bot's registry file, to read the plugin's "
+                           "settings from")
+    (options, args) = parser.parse_args()
+    if len(args) < 2 or args[0] not in commands:
+        parser.error('unknown command')
+    (command, least, most) = commands[args[0]]
+    if not least <= len(args) - 1 <= most:
+        parser.error('wrong number of arguments')
+    if options.config:
+        registry.open(options.config)
+    # Registered once the bot's registry has been read, so the plugin's
+    # settings take their values from it.
+    import config
+    conf.supybot.directories.data.setValue(args[1])
+    kwargs = {}
+    if options.backend:
+        if args[0] == 'import-cdb':
+            parser.error('import-cdb always imports into sqlite3')
+        kwargs['backend'] = options.backend
+    command(*args[1:], **kwargs)
+
+
+if __name__ == '__main__':
+    main()
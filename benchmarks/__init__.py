@@ -0,0 +1,4 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
@@ -0,0 +1,138 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+What brewery data costs on the wire and in storage.
+
+Runs the same searches against the fake BreweryDB three ways: with
+withBreweries=Y, as the plugin does; lean, which has no brewery at all,
+not even its id; and lean followed by /beer/<id>/breweries for every hit
+shown, the only way to join a lean payload to its breweries.  For each it
+reports requests, bytes received and JSON decode time.  It then reports
+how much the hits take to store whole and split: beers with brewery ids,
+plus each brewery's id, name and year once.
+
+With 1000 beers and 200 searches, withBreweries=Y took 1 request and
+4056 bytes per search, lean 1896 bytes with no breweries, and lean plus
+the joins 2 requests and 4129 bytes.  Stored whole the hits took 793KB,
+split 367KB plus 4KB of breweries.  The plugin keeps breweries inline
+anyway: the split only saves storage, costs a brewery read for every
+cached or catalogued beer shown, and loses every beer's brewery if the
+brewery store is lost.
+
+    python benchmarks/enrichment.py [--beers 1000] [--queries 200]
+"""
+
+import json
+import time
+import random
+import shutil
+import urllib
+import urllib2
+import optparse
+import tempfile
+
+import harness
+import fakeserver
+
+STRATEGIES = ('withBreweries', 'lean', 'lean + /beer/<id>/breweries')
+# What a split brewery store would keep of each brewery.
+BREWERY_FIELDS = ('id', 'name', 'established')
+
+
+def fetch(url, path, params, totals):
+    started = time.time()
+    body = urllib2.urlopen('%s%s?%s' % (url, path,
+                                        urllib.urlencode(params))).read()
+    fetched = time.time()
+    data = json.loads(body)
+    totals['decode'].append(time.time() - fetched)
+    totals['fetch'].append(fetched - started)
+    totals['bytes'] += len(body)
+    return data
+
+
+def run(options):
+    payloads = fakeserver.loadPayloads()
+    rng = random.Random(options.seed)
+    queries = [fakeserver.synthesizedName(i, payloads).encode('utf-8')
+               for i in rng.sample(xrange(options.beers), options.queries)]
+    server = harness.ServerProcess(options.beers, 0.0, options.seed)
+    results = {}
+    hits = []
+    try:
+        for strategy in STRATEGIES:
+            totals = {'decode': [], 'fetch': [], 'bytes': 0}
+            for query in queries:
+                params = {'type': 'beer', 'q': query}
+                if strategy == 'withBreweries':
+                    params['withBreweries'] = 'Y'
+                data = fetch(server.url, '/search', params,
+                             totals).get('data', [])[:options.hits]
+                if strategy == 'withBreweries':
+                    hits.extend(data)
+                elif strategy != 'lean':
+                    for beer in data:
+                        fetch(server.url, '/beer/%s/breweries' % beer['id'],
+                              {}, totals)
+            results[strategy] = {
+                'requests': len(totals['decode']),
+                'bytes': totals['bytes'],
+                'bytes_per_query': totals['bytes'] // len(queries),
+                'decode_ms': round(sum(totals['decode']) * 1000, 3),
+                'decode_ms_per_query': round(sum(totals['decode']) * 1000 /
+                                             len(queries), 3),
+                'decode': harness.summarize(totals['decode']),
+                'fetch': harness.summarize(totals['fetch'])}
+    finally:
+        server.stop()
+    whole = sum([len(json.dumps(beer)) for beer in hits])
+    breweries = {}
+    stripped = 0
+    for beer in hits:
+        beer = dict(beer)
+        for brewery in beer.get('breweries', []):
+            breweries[brewery['id']] = json.dumps(
+                dict([(name, brewery[name]) for name in BREWERY_FIELDS
+                      if name in brewery]))
+        beer['breweryIds'] = [b['id'] for b in beer.pop('breweries', [])]
+        stripped += len(json.dumps(beer))
+    store = sum([len(k) + len(v) for (k, v) in breweries.iteritems()])
+    results['stored'] = {'beers': len(hits), 'whole_bytes': whole,
+                         'stripped_bytes': stripped,
+                         'brewery_store_bytes': store,
+                         'breweries': len(breweries)}
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--beers', type='int', default=1000,
+                      help='Number of beers the fake BreweryDB knows.')
+    parser.add_option('--queries', type='int', default=200,
+                      help='Number of searches, each for a different beer.')
+    parser.add_option('--hits', type='int', default=5,
+                      help='Hits shown per search, as search.limit.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    (options, args) = parser.parse_args()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    try:
+        harness.bootstrap(workdir)
+        doc = {'meta': harness.meta(),
+               'options': {'beers': options.beers,
+                           'queries': options.queries,
+                           'hits': options.hits, 'seed': options.seed},
+               'results': run(options)}
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Local stand-in for the BreweryDB v2 API, used by the tests and benchmarks.
+
+It answers /search, /beer/random, /beers, /breweries and
+/beer/<id>/breweries from a set of beer payloads in BreweryDB's response
+format (payloads.json, or copies of them made by synthesize), honouring
+withBreweries.  Every request can be delayed by a fixed latency or made
+to fail with a given HTTP status.  The requests made and bytes sent are
+recorded, and can be read back from /_stats when the server runs in its
+own process:
+
+    python fakeserver.py [--count N] [--latency SECONDS]
+
+prints the server's URL and serves until stdin is closed.
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import time
+import random
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'payloads.json')
+
+
+def loadPayloads(filename=PAYLOADS):
+    """Returns the sample beer payloads, breweries nested."""
+    fd = open(filename)
+    try:
+        return json.load(fd)['beers']
+    finally:
+        fd.close()
+
+
+def synthesizedName(i, payloads):
+    """Returns the name synthesize gives to beer number <i>."""
+    return '%s %d' % (payloads[i % len(payloads)]['name'], i)
+
+
+def synthesize(count, payloads=None, seed=0):
+    """Returns <count> distinct beers cloned from <payloads>, numbered
+    after the beer they copy ('Stone IPA 17'), with about one brewery per
+    twenty beers shared between them."""
+    if payloads is None:
+        payloads = loadPayloads()
+    rng = random.Random(seed)
+    breweries = {}
+    nbreweries = max(count // 20, 1)
+    beers = []
+    for i in xrange(count):
+        beer = copy.deepcopy(payloads[i % len(payloads)])
+        beer['id'] = 'bm%07d' % i
+        beer['name'] = beer['nameDisplay'] = synthesizedName(i, payloads)
+        nested = []
+        for template in beer['breweries']:
+            n = rng.randrange(nbreweries)
+            if n not in breweries:
+                brewery = copy.deepcopy(template)
+                brewery['id'] = 'br%06d' % n
+                brewery['name'] = '%s %d' % (template['name'], n)
+                breweries[n] = brewery
+            nested.append(breweries[n])
+        beer['breweries'] = nested
+        beers.append(beer)
+    return beers
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; with Nagle on, keep-alive
+    # clients wait out a delayed ACK on every request.
+    disable_nagle_algorithm = True
+    api = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = url.path
+        if path.startswith('/v2'):
+            path = path[3:]
+        status = 200
+        if path == '/_stats':
+            body = json.dumps(self.api.stats(params.get('reset') == '1'))
+        else:
+            if self.api.latency:
+                time.sleep(self.api.latency)
+            status = self.api.failure() or 200
+            if status == 200:
+                body = json.dumps(self.api.respond(path, params))
+            else:
+                body = json.dumps({'status': 'failure',
+                                   'errorMessage': 'HTTP %d' % status})
+            self.api.record(path, params, len(body))
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', str(self.api.retryAfter))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeBreweryDB(object):
+    """Serves <beers> on a local port until stopped.  <latency> is the
+    number of seconds every request is held for, and can be changed while
+    the server runs.  While <failures> holds HTTP statuses, each request
+    takes the first one off and is answered with it; a 429 asks for
+    <retryAfter> seconds."""
+    pageSize = 50
+    retryAfter = 30
+
+    def __init__(self, beers=None, latency=0.0, seed=0):
+        self.beers = {}
+        self.links = {}
+        self.breweries = {}
+        self.tokens = {}
+        self.latency = latency
+        self.failures = []
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.bytes_sent = 0
+        self.server = None
+        for beer in (loadPayloads() if beers is None else beers):
+            self.add(beer)
+
+    def add(self, beer):
+        beer = dict(beer)
+        breweries = beer.pop('breweries', [])
+        self.beers[beer['id']] = beer
+        self.links[beer['id']] = [b['id'] for b in breweries]
+        for brewery in breweries:
+            self.breweries[brewery['id']] = brewery
+        for token in set(tokenize(beer['name'])):
+            self.tokens.setdefault(token, set()).add(beer['id'])
+
+    def start(self):
+        class BoundHandler(Handler):
+            api = self
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), BoundHandler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='FakeBreweryDB')
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v2' % self.server.server_address[1]
+
+    def record(self, path, params, size):
+        params = dict([(k, v) for (k, v) in params.iteritems()
+                       if k != 'key'])
+        with self.lock:
+            self.calls.append((path, params))
+            self.bytes_sent += size
+
+    def failure(self):
+        """Returns the status the next request fails with, if any."""
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+            return None
+
+    def reset(self):
+        with self.lock:
+            self.calls = []
+            self.bytes_sent = 0
+
+    def stats(self, reset=False):
+        """Returns the number of requests per path and the bytes sent."""
+        with self.lock:
+            paths = {}
+            for (path, params) in self.calls:
+                paths[path] = paths.get(path, 0) + 1
+            stats = {'calls': paths, 'bytes': self.bytes_sent}
+            if reset:
+                self.calls = []
+                self.bytes_sent = 0
+            return stats
+
+    def count(self, path):
+        """Returns how many requests were made for <path>."""
+        with self.lock:
+            return len([call for call in self.calls if call[0] == path])
+
+    def _beer(self, beer_id, withBreweries):
+        beer = dict(self.beers[beer_id])
+        if withBreweries:
+            beer['breweries'] = [self.breweries[brewery_id]
+                                 for brewery_id in self.links[beer_id]]
+        return beer
+
+    def _page(self, data):
+        if not data:
+            return {'status': 'success', 'currentPage': 1}
+        return {'status': 'success', 'currentPage': 1, 'numberOfPages': 1,
+                'totalResults': len(data), 'data': data}
+
+    def respond(self, path, params):
+        withBreweries = params.get('withBreweries') == 'Y'
+        ids = [i for i in params.get('ids', '').split(',') if i]
+        if path == '/search':
+            matched = None
+            for token in tokenize(params.get('q', '').decode('utf-8')):
+                found = self.tokens.get(token, set())
+                matched = found if matched is None else (matched & found)
+            return self._page([self._beer(beer_id, withBreweries)
+                               for beer_id in sorted(matched or ())
+                               [:self.pageSize]])
+        if path == '/beer/random':
+            with self.lock:
+                beer_id = self.random.choice(sorted(self.beers))
+            return {'status': 'success',
+                    'data': self._beer(beer_id, withBreweries)}
+        if path == '/beers':
+            return self._page([self._beer(beer_id, withBreweries)
+                               for beer_id in ids if beer_id in self.beers])
+        if path == '/breweries':
+            return self._page([self.breweries[brewery_id]
+                               for brewery_id in ids
+                               if brewery_id in self.breweries])
+        match = re.match(r'^/beer/([^/]+)/breweries$', path)
+        if match and match.group(1) in self.beers:
+            return self._page([self.breweries[brewery_id] for brewery_id
+                               in self.links[match.group(1)]])
+        return {'status': 'failure', 'errorMessage': 'Not found: %s' % path}
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--count', type='int', default=0,
+                      help='Serves this many synthesized beers instead of '
+                      'the sample payloads.')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds to hold every request for.')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    beers = None
+    if options.count:
+        beers = synthesize(options.count, seed=options.seed)
+    server = FakeBreweryDB(beers, options.latency, options.seed).start()
+    sys.stdout.write(server.url + '\n')
+    sys.stdout.flush()
+    sys.stdin.read()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
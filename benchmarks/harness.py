@@ -0,0 +1,407 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Runs the plugin under supybot's own test harness, outside of supybot-test,
+so the benchmarks measure whole commands: parsing, the databases, the
+BreweryDB client and the replies.
+
+bootstrap() has to run before anything imports supybot.conf, just like
+the top of supybot-test.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import urllib2
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEST_CONF = """
+supybot.directories.data: test-data
+supybot.directories.conf: test-conf
+supybot.directories.log: test-logs
+supybot.reply.whenNotCommand: True
+supybot.log.stdout: False
+supybot.log.level: WARNING
+supybot.log.plugins.individualLogfiles: False
+supybot.protocols.irc.throttleTime: 0
+supybot.reply.whenAddressedBy.chars: @
+supybot.networks.test.server: should.not.need.this
+supybot.nick: test
+supybot.databases.users.allowUnregistration: True
+"""
+
+# Nothing is rate limited, so the numbers are the plugin's and not the
+# limiter's.
+CONFIG = {
+    'limit.rate': 1000000.0,
+    'limit.burst': 1000000,
+    'limit.channelRate': 1000000.0,
+    'limit.channelBurst': 1000000,
+    'limit.daily': 0,
+}
+
+
+def bootstrap(workdir):
+    """Sets up a supybot test environment in <workdir>, with this checkout
+    as the BeerMe plugin, and makes it the working directory."""
+    plugins = os.path.join(workdir, 'plugins')
+    if not os.path.isdir(plugins):
+        os.makedirs(plugins)
+    link = os.path.join(plugins, 'BeerMe')
+    if not os.path.exists(link):
+        os.symlink(ROOT, link)
+    os.chdir(workdir)
+    if not os.path.isdir('test-conf'):
+        os.mkdir('test-conf')
+    filename = os.path.join('test-conf', 'test.conf')
+    fd = open(filename, 'w')
+    try:
+        fd.write(TEST_CONF)
+    finally:
+        fd.close()
+    import supybot.registry as registry
+    registry.open(filename)
+    import supybot.log as log
+    import supybot.conf as conf
+    import supybot.world as world
+    conf.allowEval = True
+    conf.supybot.flush.setValue(False)
+    log.testing = world.testing = True
+    world.myVerbose = False
+    world.startedAt = time.time()
+    conf.supybot.directories.plugins.setValue([plugins])
+
+
+def loadPlugin():
+    """Returns the BeerMe plugin package; its config is registered once this
+    has run."""
+    import supybot.plugin as plugin
+    return plugin.loadPluginModule('BeerMe')
+
+
+def setConfig(config):
+    import supybot.conf as conf
+    for (name, value) in config.iteritems():
+        group = reduce(getattr, name.split('.'), conf.supybot.plugins.BeerMe)
+        group.setValue(value)
+
+
+class Bot(object):
+    """A test bot in #beer with the plugin loaded and <config> applied.
+
+    With <threaded> False commands run to completion inside command(),
+    which is what the latency measurements want; the throughput harness
+    keeps the plugin threaded and collects the replies as they come.  With
+    <load> False the plugin is left for the caller to load with
+    loadInto()."""
+    channel = '#beer'
+
+    def __init__(self, config, threaded=False, load=True):
+        import supybot.test as test
+        setConfig(config)
+
+        class Case(test.ChannelPluginTestCase):
+            # Misc is always loaded, so this loads nothing more.
+            plugins = load and ('BeerMe',) or ('Misc',)
+            channel = self.channel
+            cleanDataDir = False
+
+            def runTest(self):
+                pass
+
+        self.threaded = threaded
+        self.case = Case()
+        self.case.setUp()
+        self.irc = self.case.irc
+        self.cb = None
+        if load:
+            self.cb = self.irc.getCallback('BeerMe')
+            if not threaded:
+                self.cb.threaded = False
+
+    def loadInto(self, module):
+        """Makes and adds the plugin from its package <module>, as supybot
+        does on load and reload."""
+        import supybot.plugin as plugin
+        self.cb = plugin.loadPluginClass(self.irc, module)
+        if not self.threaded:
+            self.cb.threaded = False
+        return self.cb
+
+    def feed(self, text, nick=None):
+        import supybot.ircmsgs as ircmsgs
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        prefix = self.case.prefix
+        if nick is not None:
+            prefix = '%s!%s' % (nick, prefix.split('!', 1)[1])
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel,
+                                         '%s: %s' % (self.irc.nick, text),
+                                         prefix=prefix))
+
+    def take(self):
+        msg = self.irc.takeMsg()
+        if msg is not None:
+            return msg.args[1]
+
+    def command(self, text, nick=None, timeout=10):
+        """Runs <text> and returns its replies."""
+        self.feed(text, nick)
+        replies = []
+        deadline = time.time() + timeout
+        while True:
+            reply = self.take()
+            if reply is not None:
+                replies.append(reply)
+            elif replies or time.time() > deadline:
+                return replies
+            elif self.cb.threaded:
+                time.sleep(0.0005)
+            else:
+                return replies
+
+    def close(self):
+        self.case.tearDown()
+
+
+class ServerProcess(object):
+    """The fake BreweryDB server with <count> synthesized beers, run in its
+    own process so it doesn't count towards the bot's memory."""
+
+    def __init__(self, count, latency=0.0, seed=0):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'fakeserver.py')
+        self.proc = subprocess.Popen([sys.executable, script,
+                                      '--count', str(count),
+                                      '--latency', str(latency),
+                                      '--seed', str(seed)],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.url = self.proc.stdout.readline().strip()
+
+    def stats(self, reset=False):
+        """Returns the requests per path and bytes the server sent."""
+        url = self.url + '/_stats' + ('?reset=1' if reset else '')
+        return json.load(urllib2.urlopen(url))
+
+    def stop(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def percentile(ordered, point):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * point / 100.0),
+                       len(ordered) - 1)]
+
+
+def summarize(samples, elapsed=None):
+    """Returns count, throughput and latency percentiles (in ms) of a list
+    of latencies in seconds."""
+    ordered = sorted(samples)
+    if elapsed is None:
+        elapsed = sum(ordered)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {'count': len(ordered),
+            'ops_per_sec': round(len(ordered) / elapsed, 1) if elapsed else 0,
+            'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else 0.0,
+            'p50_ms': ms(percentile(ordered, 50)),
+            'p95_ms': ms(percentile(ordered, 95)),
+            'p99_ms': ms(percentile(ordered, 99)),
+            'max_ms': ms(ordered[-1]) if ordered else 0.0}
+
+
+def timeit(fn, iterations):
+    """Calls <fn> <iterations> times and returns the latencies."""
+    samples = []
+    for i in xrange(iterations):
+        started = time.time()
+        fn(i)
+        samples.append(time.time() - started)
+    return samples
+
+
+def peakRss():
+    """Returns this process' peak resident set size in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss():
+    """Returns this process' current resident set size in KiB, or its peak
+    where /proc isn't available."""
+    try:
+        fd = open('/proc/self/statm')
+    except IOError:
+        return peakRss()
+    try:
+        pages = int(fd.read().split()[1])
+    finally:
+        fd.close()
+    return pages * resource.getpagesize() // 1024
+
+
+def meta():
+    import supybot
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                    cwd=ROOT, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        revision = ''
+    # Once anything has imported supybot.version, that's the module.
+    version = getattr(supybot, 'version', '')
+    return {'python': platform.python_version(),
+            'supybot': getattr(version, 'version', version),
+            'platform': platform.platform(),
+            'revision': revision.strip(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+def writeResults(doc, output=None):
+    """Writes <doc> as JSON to <output>, or stdout."""
+    text = json.dumps(doc, sort_keys=True, indent=2)
+    if output:
+        fd = open(output, 'w')
+        try:
+            fd.write(text + '\n')
+        finally:
+            fd.close()
+    else:
+        sys.stdout.write(text + '\n')
+
+
+def runWorker(args):
+    """Runs a benchmark script in a fresh interpreter, so that its peak RSS
+    is its own, and returns the JSON document it prints last."""
+    proc = subprocess.Popen([sys.executable] + list(args),
+                            stdout=subprocess.PIPE)
+    (out, _) = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError('%s exited with %s' % (' '.join(args),
+                                                  proc.returncode))
+    return json.loads(out[out.rindex('\n{') + 1:] if '\n{' in out else out)
+
+
+def brewery(beer):
+    breweries = beer.get('breweries') or [{}]
+    return breweries[0].get('name', '')
+
+
+def reviews(rng, nicks, now, count):
+    return [{'nick': rng.choice(nicks),
+             'rating': '%.1f' % rng.uniform(1, 5),
+             'description': 'benchmark review',
+             'date': time.strftime('%B %d, %Y %H:%M', time.localtime(
+                 now - rng.uniform(0, 90 * 86400)))}
+            for i in xrange(count)]
+
+
+def channels(count):
+    """Returns the names of <count> channels, the main one first."""
+    return ['#beer'] + ['#beer%d' % i for i in xrange(1, count)]
+
+
+def openDatabases(module, backend):
+    """Returns the review and tracker databases of <backend> in the data
+    dir, named as the plugin names them."""
+    import supybot.conf as conf
+    filename = '.'.join([conf.supybot.directories.data.dirize('BeerMe'),
+                         backend, 'db'])
+    types = {'cdb': (module.BeerReviewDB, module.BeerTrackerDB),
+             'sqlite3': (module.BeerReviewSQLiteDB,
+                         module.BeerTrackerSQLiteDB)}[backend]
+    return [cls(filename) for cls in types]
+
+
+def buildDatabases(module, backend, beers, channels, seed=0,
+                   other=1000):
+    """Fills the review and tracker databases of <backend> in the data
+    dir: the first of <channels> gets reviews and mentions of all <beers>,
+    the others of at most <other> of them.  Each beer gets 1-4 reviews and
+    1-10 mentions from the last 90 days by 50 nicks."""
+    rng = random.Random(seed)
+    nicks = ['drinker%d' % i for i in xrange(50)]
+    now = time.time()
+    (review_db, tracker_db) = openDatabases(module, backend)
+    try:
+        for (i, channel) in enumerate(channels):
+            subset = beers if i == 0 else beers[:other]
+            for start in xrange(0, len(subset), 5000):
+                chunk = subset[start:start + 5000]
+                review_db.import_reviews(channel, dict(
+                    (beer['id'], (beer['name'], brewery(beer),
+                                  reviews(rng, nicks, now,
+                                          rng.randint(1, 4)),
+                                  rng.randint(0, 20)))
+                    for beer in chunk))
+                tracker_db.import_mentions(channel, dict(
+                    (beer['id'], (beer['name'], brewery(beer),
+                                  [(rng.choice(nicks),
+                                    now - rng.uniform(0, 90 * 86400))
+                                   for j in xrange(rng.randint(1, 10))]))
+                    for beer in chunk))
+    finally:
+        review_db.close()
+        tracker_db.close()
+
+
+def runScenario(script, workdir, backend, size, channels, seed=0,
+                args=()):
+    """Runs <script> --worker <backend> <size> in a fresh copy of a data dir
+    whose databases hold <size> beers over <channels> channels, and returns
+    its results.  The databases are built the first time and kept in
+    <workdir>; every run starts from them as built, without whatever
+    earlier runs added."""
+    scenario = os.path.abspath(os.path.join(
+        workdir, '%s-%d-%d' % (backend, size, channels)))
+    dataset = os.path.join(scenario, 'dataset')
+    prepared = os.path.join(scenario, 'prepared')
+    if not os.path.exists(prepared):
+        if os.path.isdir(scenario):
+            shutil.rmtree(scenario)
+        os.makedirs(dataset)
+        runWorker([os.path.abspath(__file__), '--workdir', dataset,
+                   '--prepare', backend, str(size),
+                   '--channels', str(channels), '--seed', str(seed)])
+        open(prepared, 'w').close()
+    run = os.path.join(scenario, 'run')
+    if os.path.isdir(run):
+        shutil.rmtree(run)
+    shutil.copytree(os.path.join(dataset, 'test-data'),
+                    os.path.join(run, 'test-data'))
+    return runWorker([os.path.abspath(script), '--workdir', run,
+                      '--worker', backend, str(size)] + list(args))
+
+
+def main():
+    import optparse
+    import fakeserver
+    parser = optparse.OptionParser(usage='Usage: %prog --workdir DIR '
+                                   '--prepare BACKEND SIZE [options]')
+    parser.add_option('--workdir')
+    parser.add_option('--prepare', nargs=2)
+    parser.add_option('--channels', type='int', default=8)
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    (backend, size) = (options.prepare[0], int(options.prepare[1]))
+    bootstrap(options.workdir)
+    module = loadPlugin().plugin
+    buildDatabases(module, backend,
+                   fakeserver.synthesize(size, seed=options.seed),
+                   channels(options.channels), options.seed)
+    writeResults({'backend': backend, 'size': size})
+
+
+if __name__ == '__main__':
+    main()
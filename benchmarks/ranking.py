@@ -0,0 +1,122 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Latency of the `top` and `tracker` leaderboards on channels of 1k, 10k and
+100k beers, straight from the databases, next to the full sort they used
+to do.
+
+For each backend and size it times the databases' top() with and without
+a window or nick, and the old way over the same records: a tuple per
+record, sorted in full and cut to ten.  `rank` and `sort` time the two
+ways of picking ten out of the same in-memory list, without the database.
+
+    python benchmarks/ranking.py [--sizes 1000,10000,100000]
+"""
+
+import random
+import shutil
+import optparse
+import tempfile
+
+import harness
+
+
+def fullSortTop(db, channel):
+    ranked = []
+    for record in db.iter_records(channel):
+        ranked.append((record.rating_sum / record.rating_count,
+                       record.rating_count, record))
+    return sorted(ranked, reverse=True)[0:10]
+
+
+def fullSortTracker(db, channel):
+    ranked = []
+    for record in db.iter_records(channel):
+        ranked.append((record.count, set(record.nicks), record))
+    return sorted(ranked, reverse=True)[0:10]
+
+
+def worker(options, backend, size):
+    module = harness.loadPlugin().plugin
+    (review_db, tracker_db) = harness.openDatabases(module, backend)
+    channel = '#beer'
+    rng = random.Random(options.seed)
+    items = [(rng.randint(0, 20), 'bm%07d' % i) for i in xrange(size)]
+    cases = [
+        ('top', lambda: review_db.top(channel, 10)),
+        ('top --window week', lambda: review_db.top(channel, 10, 7)),
+        ('top --nick', lambda: review_db.top(channel, 10, None,
+                                             'drinker7')),
+        ('top full sort', lambda: fullSortTop(review_db, channel)),
+        ('tracker', lambda: tracker_db.top(channel, 10)),
+        ('tracker --window week', lambda: tracker_db.top(channel, 10, 7)),
+        ('tracker --nick', lambda: tracker_db.top(channel, 10, None,
+                                                  'drinker7')),
+        ('tracker full sort', lambda: fullSortTracker(tracker_db,
+                                                      channel)),
+        ('rank', lambda: module.rank(items, 10, lambda item: item)),
+        ('sort', lambda: sorted(items, reverse=True)[0:10]),
+    ]
+    results = {}
+    try:
+        for (label, fn) in cases:
+            # The first call builds rollups and warms the caches.
+            fn()
+            results[label] = harness.summarize(
+                harness.timeit(lambda i: fn(), options.iterations))
+    finally:
+        review_db.close()
+        tracker_db.close()
+    return {'backend': backend, 'size': size, 'cases': results,
+            'peak_rss_kb': harness.peakRss()}
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='Comma-separated numbers of beers in the '
+                      'channel.')
+    parser.add_option('--backends', default='cdb,sqlite3')
+    parser.add_option('--channels', type='int', default=8,
+                      help='Channels in the generated databases; only the '
+                      'first, holding every beer, is ranked.')
+    parser.add_option('--iterations', type='int', default=10)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir',
+                      help='Keeps the generated databases here for later '
+                      'runs, instead of a temporary directory.')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, options.worker[0],
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    common = ['--iterations', str(options.iterations),
+              '--seed', str(options.seed)]
+    doc = {'meta': harness.meta(),
+           'options': {'channels': options.channels,
+                       'iterations': options.iterations,
+                       'seed': options.seed},
+           'results': []}
+    try:
+        for backend in options.backends.split(','):
+            for size in [int(size) for size in options.sizes.split(',')]:
+                doc['results'].append(harness.runScenario(
+                    __file__, workdir, backend, size, options.channels,
+                    options.seed, common))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Per-line cost of rendering beer payloads as IRC text.
+
+Renders the same synthesized payloads with the old field dispatch, which
+looked up every field's function and colored every piece on every line,
+and with the renderers compileFields() builds once per field list, and
+checks that both give the same text.
+
+    python benchmarks/render.py [--payloads 10000] [--repeat 5]
+"""
+
+import time
+import shutil
+import optparse
+import tempfile
+
+import harness
+import fakeserver
+
+FIELDS = [
+    ('search.fields', ['name', 'style', 'brewery', 'abv']),
+    ('every field', ['name', 'style', 'category', 'abv', 'glass',
+                     'description', 'brewery']),
+]
+
+
+def dispatchFields(fieldDispatch, beer, fields):
+    """BeerMe._printFields as it was before renderers were compiled."""
+    outFields = []
+    for field in fields:
+        if field in fieldDispatch:
+            (dispatch, kwargs) = fieldDispatch[field]
+            out = dispatch(beer, **kwargs)
+            if out:
+                if 'bracketize' in kwargs and kwargs['bracketize'] is False:
+                    outFields.append(out)
+                else:
+                    outFields.append(u"[{0}]".format(out))
+    return ' '.join(outFields)
+
+
+def perLine(samples, count):
+    """Adds the per-line cost in microseconds to a summary of passes over
+    <count> payloads."""
+    summary = harness.summarize(samples)
+    summary['per_line_us'] = round(summary['p50_ms'] * 1000 / count, 3)
+    return summary
+
+
+def run(options):
+    module = harness.loadPlugin().plugin
+    fieldDispatch = module.BeerMe.fieldDispatch
+    beers = fakeserver.synthesize(options.payloads, seed=options.seed)
+    results = {}
+    for (label, fields) in FIELDS:
+        started = time.time()
+        render = module.BeerMeHelper.compileFields(fieldDispatch, fields)
+        compiled = time.time() - started
+        mismatches = len([beer for beer in beers
+                          if render(beer) !=
+                          dispatchFields(fieldDispatch, beer, fields)])
+
+        def old(i):
+            for beer in beers:
+                dispatchFields(fieldDispatch, beer, fields)
+
+        def new(i):
+            for beer in beers:
+                render(beer)
+        results[label] = {
+            'fields': fields, 'mismatches': mismatches,
+            'compile_ms': round(compiled * 1000, 3),
+            'dispatch': perLine(harness.timeit(old, options.repeat),
+                                len(beers)),
+            'compiled': perLine(harness.timeit(new, options.repeat),
+                                len(beers))}
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--payloads', type='int', default=10000,
+                      help='Number of beer payloads rendered per pass.')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Passes over the payloads timed.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    (options, args) = parser.parse_args()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    try:
+        harness.bootstrap(workdir)
+        doc = {'meta': harness.meta(),
+               'options': {'payloads': options.payloads,
+                           'repeat': options.repeat, 'seed': options.seed},
+               'results': run(options)}
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+End-to-end benchmarks: runs the plugin's commands through supybot's test
+harness against a fake BreweryDB, with review and tracker databases of
+each size spread over several channels, and writes JSON with throughput,
+latency percentiles and peak memory per backend and size.
+
+    python benchmarks/run.py [--sizes 1000,10000,100000] [--output FILE]
+
+Every backend and size runs in its own process so its peak RSS is its own;
+the databases are built once per work directory and every run starts from
+a fresh copy of them.
+"""
+
+import sys
+import random
+import shutil
+import optparse
+import tempfile
+
+import harness
+import fakeserver
+
+# (name, command); %(name)s is a beer in the dataset, picked at random.
+COMMANDS = [
+    ('search', 'BeerMe search %(name)s'),
+    ('describe', 'describe %(name)s'),
+    ('review', 'review %(name)s; 4; benchmark'),
+    ('reviews', 'reviews %(name)s'),
+    ('top', 'top'),
+    ('top --window week', 'top --window week'),
+    ('top --nick', 'top --nick drinker7'),
+    ('tracker', 'tracker'),
+    ('tracker --window week', 'tracker --window week'),
+    ('tracker --nick', 'tracker --nick drinker7'),
+    ('random', 'random'),
+]
+
+
+def worker(options, backend, size):
+    harness.loadPlugin()
+    payloads = fakeserver.loadPayloads()
+    server = harness.ServerProcess(size, options.latency, options.seed)
+    config = dict(harness.CONFIG)
+    config.update({'apiUrl': server.url, 'database': backend})
+    bot = harness.Bot(config)
+    rng = random.Random(options.seed)
+    results = {}
+    try:
+        for (label, command) in COMMANDS:
+            errors = [0]
+            server.stats(reset=True)
+
+            def run(i):
+                name = fakeserver.synthesizedName(rng.randrange(size),
+                                                  payloads)
+                replies = bot.command(command % {'name': name})
+                if not replies or replies[0].startswith('Error'):
+                    errors[0] += 1
+
+            samples = harness.timeit(run, options.iterations)
+            results[label] = harness.summarize(samples)
+            results[label]['errors'] = errors[0]
+            results[label]['api'] = server.stats()
+    finally:
+        bot.close()
+        server.stop()
+    return {'backend': backend, 'size': size,
+            'channels': options.channels, 'commands': results,
+            'peak_rss_kb': harness.peakRss()}
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='Comma-separated numbers of beers reviewed and '
+                      'tracked in the main channel.')
+    parser.add_option('--backends', default='cdb,sqlite3')
+    parser.add_option('--channels', type='int', default=8,
+                      help='Channels with reviews and mentions; all but the '
+                      'first get at most 1000 beers each.')
+    parser.add_option('--iterations', type='int', default=200,
+                      help='Times each command is run.')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds the fake BreweryDB holds each request.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir',
+                      help='Keeps the generated databases here for later '
+                      'runs, instead of a temporary directory.')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, options.worker[0],
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    common = ['--channels', str(options.channels),
+              '--iterations', str(options.iterations),
+              '--latency', str(options.latency),
+              '--seed', str(options.seed)]
+    doc = {'meta': harness.meta(),
+           'options': {'channels': options.channels,
+                       'iterations': options.iterations,
+                       'latency': options.latency,
+                       'seed': options.seed},
+           'results': []}
+    try:
+        for backend in options.backends.split(','):
+            for size in [int(size) for size in options.sizes.split(',')]:
+                sys.stderr.write('%s %d\n' % (backend, size))
+                doc['results'].append(harness.runScenario(
+                    __file__, workdir, backend, size, options.channels,
+                    options.seed, common))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Latency of `reviews` and all-time `top` lookups answered from a channel's
+review snapshot, next to the live review database they are compiled from.
+
+For each backend and size it writes the snapshot of the main channel,
+then times get() of beers picked at random, and of ids that aren't
+there, and top(10), against both.
+
+    python benchmarks/snapshot.py [--sizes 1000,10000,100000]
+"""
+
+import os
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import harness
+
+
+def worker(options, backend, size):
+    module = harness.loadPlugin().plugin
+    (review_db, tracker_db) = harness.openDatabases(module, backend)
+    channel = '#beer'
+    filename = module.snapshotFile(channel)
+    rng = random.Random(options.seed)
+    ids = ['bm%07d' % rng.randrange(size) for i in xrange(options.iterations)]
+    missing = ['missing%d' % i for i in xrange(options.iterations)]
+    try:
+        started = time.time()
+        written = module.writeSnapshot(filename,
+                                       review_db.iter_records(channel))
+        write = time.time() - started
+        started = time.time()
+        snapshot = module.BeerSnapshot(filename)
+        opened = time.time() - started
+
+        def lookup(get, beer_ids):
+            def run(i):
+                try:
+                    get(beer_ids[i])
+                except KeyError:
+                    pass
+            return harness.summarize(harness.timeit(run, len(beer_ids)))
+        try:
+            results = {
+                'db get': lookup(lambda beer_id:
+                                 review_db.get(channel, beer_id), ids),
+                'snapshot get': lookup(snapshot.get, ids),
+                'db get missing': lookup(lambda beer_id:
+                                         review_db.get(channel, beer_id),
+                                         missing),
+                'snapshot get missing': lookup(snapshot.get, missing),
+                'db top': harness.summarize(harness.timeit(
+                    lambda i: review_db.top(channel, 10),
+                    options.iterations)),
+                'snapshot top': harness.summarize(harness.timeit(
+                    lambda i: snapshot.top(10), options.iterations)),
+            }
+        finally:
+            snapshot.close()
+    finally:
+        review_db.close()
+        tracker_db.close()
+    return {'backend': backend, 'size': size, 'beers': written,
+            'write_s': round(write, 3), 'open_ms': round(opened * 1000, 3),
+            'snapshot_bytes': os.path.getsize(filename), 'cases': results,
+            'peak_rss_kb': harness.peakRss()}
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='Comma-separated numbers of beers in the '
+                      'channel.')
+    parser.add_option('--backends', default='cdb,sqlite3')
+    parser.add_option('--channels', type='int', default=8,
+                      help='Channels in the generated databases; only the '
+                      'first, holding every beer, is snapshotted.')
+    parser.add_option('--iterations', type='int', default=1000,
+                      help='Lookups of each kind timed.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir',
+                      help='Keeps the generated databases here for later '
+                      'runs, instead of a temporary directory.')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, options.worker[0],
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    common = ['--iterations', str(options.iterations),
+              '--seed', str(options.seed)]
+    doc = {'meta': harness.meta(),
+           'options': {'channels': options.channels,
+                       'iterations': options.iterations,
+                       'seed': options.seed},
+           'results': []}
+    try:
+        for backend in options.backends.split(','):
+            for size in [int(size) for size in options.sizes.split(',')]:
+                doc['results'].append(harness.runScenario(
+                    __file__, workdir, backend, size, options.channels,
+                    options.seed, common))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+How long the plugin takes to load, cold and on reload, and how much memory
+it holds before anyone uses it.
+
+Each backend runs in a fresh interpreter with a data directory of the given
+size.  It imports the plugin, makes it as supybot does on load, and runs a
+first `top`, which only reads the local databases, and a first `describe`,
+which talks to the fake BreweryDB.  Then it reloads the plugin the way the
+Owner plugin's reload command does, timing the old instance's die()
+separately, and does the same again.  With `eager` every database and
+client is made as soon as the plugin is, as it was before they were made
+on first use.
+
+    python benchmarks/startup.py [--sizes 10000] [--modes lazy,eager]
+"""
+
+import gc
+import sys
+import time
+import shutil
+import optparse
+import tempfile
+
+import harness
+import fakeserver
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def worker(options, backend, size):
+    import supybot.plugin as plugin
+    server = harness.ServerProcess(size, 0.0, options.seed)
+    config = dict(harness.CONFIG)
+    config.update({'apiUrl': server.url, 'database': backend})
+    # The plugin's settings only exist once it has been imported.
+    bot = harness.Bot({}, load=False)
+    payloads = fakeserver.loadPayloads()
+    results = {'backend': backend, 'size': size, 'mode': options.mode}
+    try:
+        for (i, phase) in enumerate(('cold', 'reload')):
+            # A beer neither phase has looked up before.
+            name = fakeserver.synthesizedName(size // (i + 2), payloads)
+            result = {}
+            baseline = harness.rss()
+            started = time.time()
+            if phase == 'reload':
+                callbacks = bot.irc.removeCallback('BeerMe')
+            module = plugin.loadPluginModule('BeerMe')
+            result['import_ms'] = ms(time.time() - started)
+            harness.setConfig(config)
+            if phase == 'reload':
+                # Flushes and closes the old instance's databases.
+                started = time.time()
+                for callback in callbacks:
+                    callback.die()
+                del callbacks
+                gc.collect()
+                result['die_ms'] = ms(time.time() - started)
+            started = time.time()
+            cb = bot.loadInto(module)
+            if options.mode == 'eager':
+                for value in vars(cb).values():
+                    if isinstance(value, module.plugin.LazyResource):
+                        value._load()
+            result['load_ms'] = ms(time.time() - started)
+            result['loaded_rss_kb'] = harness.rss() - baseline
+            result['requests_imported'] = 'requests' in sys.modules
+            for (label, command) in [('top', 'top'),
+                                     ('describe', 'describe %s' % name)]:
+                started = time.time()
+                replies = bot.command(command)
+                result['first_%s_ms' % label] = ms(time.time() - started)
+                if not replies or replies[0].startswith('Error'):
+                    result['first_%s_error' % label] = replies
+            result['used_rss_kb'] = harness.rss() - baseline
+            results[phase] = result
+    finally:
+        bot.close()
+        server.stop()
+    results['peak_rss_kb'] = harness.peakRss()
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--sizes', default='10000',
+                      help='Comma-separated numbers of beers in the '
+                      'databases loaded.')
+    parser.add_option('--backends', default='cdb,sqlite3')
+    parser.add_option('--modes', default='lazy,eager',
+                      help='lazy makes databases and clients on first use, '
+                      'eager when the plugin is loaded.')
+    parser.add_option('--channels', type='int', default=8)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir',
+                      help='Keeps the generated databases here for later '
+                      'runs, instead of a temporary directory.')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    parser.add_option('--mode', help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, options.worker[0],
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    doc = {'meta': harness.meta(),
+           'options': {'channels': options.channels, 'seed': options.seed},
+           'results': []}
+    try:
+        for backend in options.backends.split(','):
+            for size in [int(size) for size in options.sizes.split(',')]:
+                for mode in options.modes.split(','):
+                    doc['results'].append(harness.runScenario(
+                        __file__, workdir, backend, size, options.channels,
+                        options.seed, ['--mode', mode,
+                                       '--seed', str(options.seed)]))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+Size of the tracker database in the old layout, a refs list holding every
+(nick, date) mention, next to the compact one with counters and a bounded
+list of recent mentions.
+
+For each number of mentions, spread over the beers so a few are far more
+popular than the rest, it builds the old layout, the new one, and the old
+one migrated by opening it with the plugin.  It measures the file size,
+the bytes in records and in the rollups kept next to them, the largest
+record and how many are too long for the csv module to read, the time to add one more mention of the most popular beer, and
+the time and memory it takes to read every record back.
+
+    python benchmarks/storage.py [--mentions 10000,100000,1000000]
+"""
+
+import os
+import csv
+import sys
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import harness
+
+LAYOUTS = ('old', 'new', 'migrated')
+# Before the worker changes directory.
+SCRIPT = os.path.abspath(__file__)
+
+
+def mentions(options, count):
+    """Returns <count> (beer_id, nick, when) over the last year; the beers
+    are picked so the most popular get most of the mentions."""
+    rng = random.Random(options.seed)
+    now = time.time()
+    return [('bm%07d' % int(options.beers * rng.random() ** 3),
+             'drinker%d' % rng.randrange(options.nicks),
+             now - rng.uniform(0, 365 * 86400))
+            for i in xrange(count)]
+
+
+def grouped(entries):
+    beers = {}
+    for (beer_id, nick, when) in entries:
+        if beer_id not in beers:
+            beers[beer_id] = ('Beer %s' % beer_id, 'Brewery', [])
+        beers[beer_id][2].append((nick, when))
+    return beers
+
+
+def oldRecord():
+    import supybot.dbi as dbi
+
+    class OldRecord(dbi.Record):
+        # The record as it was before the compact layout.
+        __fields__ = ['beer_id', 'name', 'brewery', 'refs']
+    return OldRecord
+
+
+def openLayout(module, layout, filename):
+    """Returns the database of <layout> in <filename> and functions that
+    add a mention of a beer to it and read every record back."""
+    import supybot.cdb as cdb
+    if layout != 'old':
+        db = module.BeerTrackerDB.DB(filename)
+
+        def update(beer_id):
+            db.update(beer_id, 'Beer', 'Brewery', 'drinker0', time.time())
+
+        def load():
+            return list(db.iter_records())
+        return (db, update, load)
+    OldRecord = oldRecord()
+    db = cdb.open(filename + '.tracker', 'c')
+
+    def update(beer_id):
+        # What BeerTrackerDB.DB.update did for every mention.
+        record = OldRecord()
+        record.deserialize(db[beer_id])
+        record.refs.append(('drinker0', time.strftime('%B %d, %Y %H:%M',
+                                                      time.localtime())))
+        db[beer_id] = record.serialize()
+
+    def load():
+        records = []
+        for (beer_id, serialized) in db.iteritems():
+            record = OldRecord()
+            record.deserialize(serialized)
+            records.append(record)
+        return records
+    return (db, update, load)
+
+
+def worker(options, layout, count):
+    module = harness.loadPlugin().plugin
+    import supybot.cdb as cdb
+    import supybot.conf as conf
+    filename = os.path.abspath('storage')
+    # Old records can outgrow what the csv module reads by default, which
+    # the old plugin could then not read at all; count them and read them.
+    limit = csv.field_size_limit(sys.maxint)
+    if options.load:
+        # Its own process, so nothing else has grown the heap before.
+        (db, update, load) = openLayout(module, layout, filename)
+        try:
+            before = harness.rss()
+            started = time.time()
+            records = load()
+            loaded = time.time() - started
+            after = harness.rss()
+        finally:
+            db.close()
+        return {'beers': len(records), 'load_s': round(loaded, 3),
+                'load_rss_kb': after - before}
+
+    conf.supybot.plugins.BeerMe.tracker.batchSize.setValue(1)
+    beers = grouped(mentions(options, count))
+    hottest = max(beers, key=lambda beer_id: len(beers[beer_id][2]))
+    started = time.time()
+    if layout in ('old', 'migrated'):
+        OldRecord = oldRecord()
+        db = cdb.open(filename + '.tracker', 'c')
+        for (beer_id, (name, brewery, refs)) in beers.iteritems():
+            db[beer_id] = OldRecord(
+                beer_id=beer_id, name=name, brewery=brewery,
+                refs=[(nick, time.strftime('%B %d, %Y %H:%M',
+                                           time.localtime(when)))
+                      for (nick, when) in refs]).serialize()
+        db.close()
+    if layout in ('new', 'migrated'):
+        db = module.BeerTrackerDB.DB(filename)
+        if layout == 'new':
+            db.import_mentions(beers)
+        db.close()
+    build = time.time() - started
+
+    db = cdb.open(filename + '.tracker')
+    lengths = [len(db[beer_id]) for beer_id in beers]
+    # The compact layout keeps its rollups in the same file.
+    sizes = {'records': 0, 'other': 0}
+    for (key, value) in db.iteritems():
+        sizes[key in beers and 'records' or 'other'] += len(key) + len(value)
+    db.close()
+    result = {'layout': layout, 'mentions': count,
+              'hottest_mentions': len(beers[hottest][2]),
+              'build_s': round(build, 3),
+              'file_bytes': os.path.getsize(filename + '.tracker'),
+              'record_bytes': sizes['records'],
+              'other_bytes': sizes['other'],
+              'largest_record_bytes': max(lengths),
+              'records_over_csv_limit': len([n for n in lengths
+                                             if n > limit])}
+    result.update(harness.runWorker(
+        [SCRIPT, '--workdir', os.getcwd(), '--load',
+         '--worker', layout, str(count)]))
+    (db, update, load) = openLayout(module, layout, filename)
+    try:
+        result['update'] = harness.summarize(harness.timeit(
+            lambda i: update(hottest), options.iterations))
+    finally:
+        db.close()
+    result['peak_rss_kb'] = harness.peakRss()
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--mentions', default='10000,100000,1000000',
+                      help='Comma-separated numbers of mentions tracked.')
+    parser.add_option('--beers', type='int', default=1000,
+                      help='Number of beers the mentions are spread over.')
+    parser.add_option('--nicks', type='int', default=200,
+                      help='Number of nicks mentioning them.')
+    parser.add_option('--iterations', type='int', default=20,
+                      help='Mentions of the most popular beer timed.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    parser.add_option('--load', action='store_true',
+                      help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, options.worker[0],
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    common = ['--beers', str(options.beers), '--nicks', str(options.nicks),
+              '--iterations', str(options.iterations),
+              '--seed', str(options.seed)]
+    doc = {'meta': harness.meta(),
+           'options': {'beers': options.beers, 'nicks': options.nicks,
+                       'iterations': options.iterations,
+                       'seed': options.seed},
+           'results': []}
+    try:
+        for count in options.mentions.split(','):
+            for layout in LAYOUTS:
+                run = os.path.abspath(os.path.join(
+                    workdir, 'storage-%s-%s' % (layout, count)))
+                if os.path.isdir(run):
+                    shutil.rmtree(run)
+                os.makedirs(run)
+                doc['results'].append(harness.runWorker(
+                    [__file__, '--workdir', run,
+                     '--worker', layout, count] + common))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
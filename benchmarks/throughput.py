@@ -0,0 +1,144 @@
+###
+# Copyright (c) 2014, Sean Mac
+# All rights reserved.
+###
+
+"""
+How many commands a second the plugin gets through while BreweryDB is slow.
+
+A burst of describe commands, each for a different beer so nothing is
+cached, goes to a threaded bot talking to the fake BreweryDB, which holds
+every request for the given latency.  While they are in flight, `top`
+(which only reads the local database) is run every so often, to show the
+bot keeps answering.  Writes JSON with commands/sec and latency
+percentiles for each latency and http.concurrency.
+
+    python benchmarks/throughput.py [--latency 0,0.1,0.5]
+                                    [--concurrency 1,4,16] [--commands 100]
+"""
+
+import os
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import harness
+import fakeserver
+
+COLOR = '\x0307'
+
+
+def worker(options, latency, concurrency):
+    harness.loadPlugin()
+    payloads = fakeserver.loadPayloads()
+    server = harness.ServerProcess(options.beers, latency, options.seed)
+    config = dict(harness.CONFIG)
+    config.update({'apiUrl': server.url, 'http.concurrency': concurrency,
+                   'http.timeout': 60.0})
+    bot = harness.Bot(config, threaded=True)
+    rng = random.Random(options.seed)
+    names = [fakeserver.synthesizedName(i, payloads).encode('utf-8')
+             for i in rng.sample(xrange(options.beers), options.commands)]
+    # Names are rendered in orange first thing in describe's reply.
+    pending = dict([(COLOR + name + '\x03', None) for name in names])
+    latencies = []
+    probes = []
+    probeSent = None
+    nextProbe = 0
+    errors = 0
+    started = time.time()
+    try:
+        for name in names:
+            bot.feed('describe %s' % name)
+        deadline = started + options.timeout
+        while pending and time.time() < deadline:
+            if probeSent is None and time.time() >= nextProbe:
+                probeSent = time.time()
+                nextProbe = probeSent + options.probeInterval
+                bot.feed('top')
+            reply = bot.take()
+            if reply is None:
+                time.sleep(0.0005)
+                continue
+            now = time.time()
+            key = reply[:reply.find('\x03', len(COLOR)) + 1]
+            if key in pending:
+                del pending[key]
+                latencies.append(now - started)
+            elif 'No reviewed beers' in reply:
+                probes.append(now - probeSent)
+                probeSent = None
+            else:
+                errors += 1
+        elapsed = time.time() - started
+        api = server.stats()
+    finally:
+        bot.close()
+        server.stop()
+    return {'latency': latency, 'concurrency': concurrency,
+            'commands': options.commands, 'unanswered': len(pending),
+            'errors': errors, 'elapsed_s': round(elapsed, 3),
+            'commands_per_sec': round(len(latencies) / elapsed, 1),
+            'describe': harness.summarize(latencies, elapsed),
+            'probe': harness.summarize(probes), 'api': api,
+            'peak_rss_kb': harness.peakRss()}
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--latency', default='0,0.1,0.5',
+                      help='Comma-separated seconds the fake BreweryDB '
+                      'holds each request.')
+    parser.add_option('--concurrency', default='1,4,16',
+                      help='Comma-separated values of http.concurrency.')
+    parser.add_option('--commands', type='int', default=100,
+                      help='Number of describe commands in the burst.')
+    parser.add_option('--beers', type='int', default=1000,
+                      help='Number of beers the fake BreweryDB knows.')
+    parser.add_option('--timeout', type='float', default=300.0,
+                      help='Seconds to wait for the burst to be answered.')
+    parser.add_option('--probeInterval', type='float', default=0.05,
+                      help='Seconds between runs of top during the burst.')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--workdir')
+    parser.add_option('--output', help='Writes the results here, not stdout.')
+    parser.add_option('--worker', nargs=2, help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.worker:
+        harness.bootstrap(options.workdir)
+        harness.writeResults(worker(options, float(options.worker[0]),
+                                    int(options.worker[1])))
+        return
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='beerme-bench-')
+    common = ['--commands', str(options.commands),
+              '--beers', str(options.beers),
+              '--timeout', str(options.timeout),
+              '--probeInterval', str(options.probeInterval),
+              '--seed', str(options.seed)]
+    doc = {'meta': harness.meta(),
+           'options': {'commands': options.commands,
+                       'beers': options.beers, 'seed': options.seed},
+           'results': []}
+    try:
+        for latency in options.latency.split(','):
+            for concurrency in options.concurrency.split(','):
+                run = os.path.abspath(os.path.join(
+                    workdir, 'throughput-%s-%s' % (latency, concurrency)))
+                if os.path.isdir(run):
+                    shutil.rmtree(run)
+                os.makedirs(run)
+                doc['results'].append(harness.runWorker(
+                    [__file__, '--workdir', run,
+                     '--worker', latency, concurrency] + common))
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+    harness.writeResults(doc, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,10 +15,22 @@ def configure(advanced):
     conf.registerPlugin('BeerMe', True)
 
 
+class DatabaseBackend(registry.OnlySomeStrings):
+    validStrings = ('cdb', 'sqlite3')
+
 BeerMe = conf.registerPlugin('BeerMe')
 conf.registerGlobalValue(BeerMe, 'apiKey',
     registry.String('a2cac2b9b32c8724e39964d6f84ba644',
     """The BreweryDB API Key."""))
+conf.registerGlobalValue(BeerMe, 'apiUrl',
+    registry.String('http://api.brewerydb.com/v2', """The base URL of the
+    BreweryDB API, without a trailing slash.  Point it at a local stand-in
+    to exercise the plugin offline.  Changes take effect when the plugin is
+    reloaded."""))
+conf.registerGlobalValue(BeerMe, 'database',
+    DatabaseBackend('cdb', """Determines which database backend stores
+    reviews and tracked beers: per-channel cdb files, or a single sqlite3
+    file.  Changes take effect when the plugin is reloaded."""))
 conf.registerGroup(BeerMe, 'search')
 conf.registerGlobalValue(BeerMe.search, 'limit',
     registry.PositiveInteger(5, """Maximum number of search results to
@@ -26,4 +38,111 @@ conf.registerGlobalValue(BeerMe.search, 'limit',
 conf.registerGlobalValue(BeerMe.search, 'fields',
     registry.CommaSeparatedListOfStrings(['name', 'style', 'brewery', 'abv'],
     """Which fields to display for each search result hit."""))
+conf.registerGlobalValue(BeerMe.search, 'cacheSize',
+    registry.NonNegativeInteger(256, """Maximum number of BreweryDB search
+    responses to keep in memory.  0 disables the search cache."""))
+conf.registerGlobalValue(BeerMe.search, 'cacheTTL',
+    registry.PositiveInteger(3600, """Number of seconds a cached BreweryDB
+    search response stays valid."""))
+conf.registerGroup(BeerMe, 'http')
+conf.registerGlobalValue(BeerMe.http, 'timeout',
+    registry.PositiveFloat(10.0, """Number of seconds to wait for BreweryDB
+    before giving up on a request."""))
+conf.registerGlobalValue(BeerMe.http, 'concurrency',
+    registry.PositiveInteger(4, """Maximum number of BreweryDB requests the
+    plugin will have in flight at once; this is also the size of the
+    keep-alive connection pool.  Changes take effect when the plugin is
+    reloaded."""))
+conf.registerGlobalValue(BeerMe.http, 'retries',
+    registry.NonNegativeInteger(3, """Number of times a BreweryDB request is
+    retried after a connection error or a 5xx response.  Retries count
+    against supybot.plugins.BeerMe.limit.daily.  A 429 response is not
+    retried; requests pause for as long as BreweryDB asks instead.  Changes
+    take effect when the plugin is reloaded."""))
+conf.registerGlobalValue(BeerMe.http, 'backoff',
+    registry.PositiveFloat(0.5, """Base number of seconds for the exponential
+    backoff between BreweryDB retries.  Changes take effect when the plugin is
+    reloaded."""))
+conf.registerGroup(BeerMe, 'tracker')
+conf.registerGlobalValue(BeerMe.tracker, 'batchSize',
+    registry.PositiveInteger(20, """Number of buffered beer mentions that
+    triggers a write to a channel's tracker database."""))
+conf.registerGlobalValue(BeerMe.tracker, 'batchInterval',
+    registry.PositiveInteger(300, """Maximum number of seconds buffered beer
+    mentions are held before they are written to the tracker database.
+    Buffered mentions are also written whenever the bot flushes its
+    databases and when the plugin is unloaded."""))
+conf.registerGlobalValue(BeerMe.tracker, 'recent',
+    registry.NonNegativeInteger(10, """Number of most recent (nick, time)
+    mentions kept with each tracked beer.  0 keeps none; mention counts per
+    nick are always kept."""))
+conf.registerGroup(BeerMe, 'catalog')
+conf.registerGlobalValue(BeerMe.catalog, 'enabled',
+    registry.Boolean(True, """Determines whether every beer seen in a
+    BreweryDB response is kept in a local catalog, and whether searches are
+    answered from that catalog before asking BreweryDB."""))
+conf.registerGroup(BeerMe, 'random')
+conf.registerGlobalValue(BeerMe.random, 'lowWatermark',
+    registry.NonNegativeInteger(3, """When fewer than this many prefetched
+    random beers are left, the plugin starts fetching more in the background,
+    two with each random command."""))
+conf.registerGlobalValue(BeerMe.random, 'highWatermark',
+    registry.NonNegativeInteger(10, """Number of random beers the background
+    refill prefetches up to, and never more than random was used in the last
+    random.maxAge seconds.  0 disables prefetching, so every random command
+    asks BreweryDB directly."""))
+conf.registerGlobalValue(BeerMe.random, 'maxAge',
+    registry.PositiveInteger(3600, """Number of seconds a prefetched random
+    beer may be kept before it is discarded unused."""))
 
+conf.registerGroup(BeerMe, 'stats')
+conf.registerGlobalValue(BeerMe.stats, 'dumpFile',
+    registry.String('', """Name of a file in the bot's data directory that
+    the plugin's timings and counters are periodically written to as JSON.
+    Empty disables the dump."""))
+conf.registerGlobalValue(BeerMe.stats, 'dumpInterval',
+    registry.PositiveInteger(300, """Number of seconds between writes of the
+    stats dump file.  Takes effect when the plugin is reloaded."""))
+conf.registerGroup(BeerMe, 'limit')
+conf.registerGlobalValue(BeerMe.limit, 'rate',
+    registry.PositiveFloat(5.0, """Number of BreweryDB requests per second
+    the plugin may make across all channels."""))
+conf.registerGlobalValue(BeerMe.limit, 'burst',
+    registry.PositiveInteger(10, """Number of BreweryDB requests the plugin
+    may make at once before supybot.plugins.BeerMe.limit.rate applies."""))
+conf.registerGlobalValue(BeerMe.limit, 'channelRate',
+    registry.PositiveFloat(1.0, """Number of BreweryDB requests per second
+    commands in any one channel may make."""))
+conf.registerGlobalValue(BeerMe.limit, 'channelBurst',
+    registry.PositiveInteger(5, """Number of BreweryDB requests commands in
+    any one channel may make at once."""))
+conf.registerGlobalValue(BeerMe.limit, 'daily',
+    registry.NonNegativeInteger(0, """Number of BreweryDB requests the
+    plugin may make per day (UTC); set it to the API key's daily quota.  0
+    means no daily limit."""))
+conf.registerGlobalValue(BeerMe.limit, 'reserve',
+    registry.NonNegativeInteger(3, """Number of requests, both of the burst
+    and of the daily quota, that background prefetching leaves for
+    commands."""))
+conf.registerGroup(BeerMe, 'db')
+conf.registerGlobalValue(BeerMe.db, 'maxOpen',
+    registry.NonNegativeInteger(64, """Maximum number of channel databases
+    of each kind (reviews, tracker, aliases) kept open; opening another
+    closes the least recently used one.  0 means no limit.  Only applies to
+    the per-channel cdb files."""))
+conf.registerGlobalValue(BeerMe.db, 'idleTimeout',
+    registry.NonNegativeInteger(3600, """Number of seconds a channel
+    database may go unused before it is closed when the bot next flushes
+    its databases.  0 keeps them open until the plugin is unloaded."""))
+conf.registerGroup(BeerMe, 'snapshot')
+conf.registerChannelValue(BeerMe.snapshot, 'directory',
+    registry.String('', """Directory holding the review snapshots written
+    by the beersnapshot command and read when
+    supybot.plugins.BeerMe.snapshot.read is on, each channel's under its
+    own name.  Bots sharing review data can point this at the same
+    directory.  Empty means each channel's data directory."""))
+conf.registerChannelValue(BeerMe.snapshot, 'read',
+    registry.Boolean(False, """Determines whether the reviews command and
+    the all-time top list are answered from the channel's review snapshot
+    instead of its live review database.  Reviewing and voting still write
+    to, and echo from, the live database."""))
@@ -3,13 +3,35 @@
 # All rights reserved.
 ###
 
+import os
+import re
+import sys
+import ast
+import csv
+import json
 import time
-import requests
+import random
+import mmap
+import heapq
+import shutil
+import struct
+import tempfile
+import bisect
+import threading
+import contextlib
+import types
+from collections import OrderedDict, deque
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 import supybot.dbi as dbi
 import supybot.cdb as cdb
 import supybot.conf as conf
 import supybot.utils as utils
+import supybot.world as world
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
@@ -17,106 +39,1502 @@ from supybot.ircutils import mircColor as mircColor
 import supybot.callbacks as callbacks
 
 
-class BeerReviewDB(plugins.DbiChannelDB):
-    class DB(dbi.DB):
+def parseDate(date):
+    """Turns a '%B %d, %Y %H:%M' date as stored by older versions of this
+    plugin into an epoch timestamp, or None if it can't be parsed."""
+    try:
+        return time.mktime(time.strptime(date, '%B %d, %Y %H:%M'))
+    except (TypeError, ValueError):
+        return None
+
+
+def literal(s):
+    """Decodes a value written with repr(), like utils.safeEval but without
+    building a compiler AST twice per value, which made scans over a whole
+    channel's records cost about a millisecond per field."""
+    try:
+        return ast.literal_eval(s)
+    except SyntaxError, e:
+        raise ValueError, 'Invalid string: %s.' % e
+
+
+def rank(items, num, key):
+    """Returns the <num> largest of <items> by <key>, best first.
+
+    Uses a bounded heap rather than sorting everything, and only ever
+    compares the keys, never the items themselves."""
+    return heapq.nlargest(num, items, key=key)
+
+
+def epochDay(when):
+    """Returns the number of the UTC day <when> falls on."""
+    return int(when // 86400)
+
+
+def deserializeFields(record, serialized, fields):
+    """Like dbi.Record.deserialize, but only decodes the given fields; the
+    others keep the defaults the record was created with."""
+    for (name, value) in zip(record.fields, csv.split(serialized)):
+        if name in fields:
+            setattr(record, name, record.converters[name](value))
+    return record
+
+
+class BeerRollups(object):
+    """Mixin for the cdb databases keeping per-day and per-nick rollups of
+    their reviews or mentions, so windowed and per-nick leaderboards don't
+    have to scan every record.  A day bucket maps beer_id to {nick: value}
+    for one UTC day; a nick bucket maps beer_id to the nick's all-time
+    value.  Subclasses define how values combine."""
+    dayKey = '__day__:%d'
+    nickKey = '__nick__:%s'
+    rollupKey = '__rollup__'
+
+    def _combine(self, old, value):
+        raise NotImplementedError
+
+    def _bucket(self, key):
+        if key in self.db:
+            return literal(self.db[key])
+        return {}
+
+    def _add_rollups(self, entries):
+        """Adds (beer_id, nick, when, value) entries to the buckets, writing
+        each bucket once.  Entries with no <when> only count towards the
+        nick bucket."""
+        buckets = {}
+        for (beer_id, nick, when, value) in entries:
+            nick = ircutils.toLower(nick)
+            keys = [(self.nickKey % nick, None)]
+            if when is not None:
+                keys.append((self.dayKey % epochDay(when), nick))
+            for (key, sub) in keys:
+                if key not in buckets:
+                    buckets[key] = self._bucket(key)
+                if sub is None:
+                    bucket = buckets[key]
+                    sub = beer_id
+                else:
+                    bucket = buckets[key].setdefault(beer_id, {})
+                bucket[sub] = self._combine(bucket.get(sub), value)
+        for (key, bucket) in buckets.iteritems():
+            self._put(key, repr(bucket))
+
+    def _rollup_view(self, days, nick):
+        """Returns {beer_id: {nick: value}} over the last <days> UTC days
+        (all time if None), only counting <nick> if given."""
+        if nick is not None:
+            nick = ircutils.toLower(nick)
+        if days is None:
+            return dict([(beer_id, {nick: value}) for (beer_id, value)
+                         in self._bucket(self.nickKey % nick).iteritems()])
+        view = {}
+        today = epochDay(time.time())
+        for day in xrange(today - days + 1, today + 1):
+            for (beer_id, nicks) in \
+                    self._bucket(self.dayKey % day).iteritems():
+                for (n, value) in nicks.iteritems():
+                    if nick is None or n == nick:
+                        merged = view.setdefault(beer_id, {})
+                        merged[n] = self._combine(merged.get(n), value)
+        return view
+
+
+def cdbBuffered(db):
+    """Returns the bytes a cdb ReaderWriter holds in memory: every value
+    written since it was opened, as flushing doesn't release them."""
+    return sum([len(key) + len(value) for (key, value) in db.adds.iteritems()])
+
+
+def addStats(totals, stats):
+    """Adds a database's statistics to <totals>, keeping the largest of the
+    last_* values."""
+    for (key, value) in stats.iteritems():
+        if key.startswith('last_'):
+            totals[key] = max(totals.get(key, 0), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+class PinnedIterator(object):
+    """Iterates over <iterator>, calling <release> once it is exhausted,
+    closed or collected."""
+    def __init__(self, iterator, release):
+        self.iterator = iterator
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.iterator.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+            self.release()
+
+    __del__ = close
+
+
+class BeerChannelDB(plugins.DbiChannelDB):
+    """Channel databases are opened on first use and kept most recently
+    used last.  Opening one past supybot.plugins.BeerMe.db.maxOpen closes
+    the least recently used, and flushing closes those idle for longer than
+    db.idleTimeout.  A database is pinned while a call to it, or an
+    iterator it returned, is in progress, and pinned ones are never closed;
+    the cap is enforced again once they are released."""
+    def __init__(self, filename):
+        plugins.DbiChannelDB.__init__(self, filename)
+        self.dbs = OrderedDict()
+        self.used = {}
+        self.pins = {}
+        self.lock = threading.RLock()
+        self.opened = 0
+        self.evicted = 0
+        # Statistics of the databases closed so far, so they aren't lost.
+        self.retired = {}
+
+    def _getDb(self, channel):
+        """Returns <channel>'s database pinned; pair it with _release."""
+        key = ircutils.toLower(channel)
+        with self.lock:
+            db = self.dbs.pop(key, None)
+            if db is None:
+                db = self.DB(plugins.makeChannelFilename(self.filename,
+                                                         channel))
+                self.opened += 1
+            self.dbs[key] = db
+            self.used[key] = time.time()
+            self.pins[key] = self.pins.get(key, 0) + 1
+            self._trim()
+        return db
+
+    def _release(self, channel):
+        key = ircutils.toLower(channel)
+        with self.lock:
+            self.pins[key] -= 1
+            if not self.pins[key]:
+                del self.pins[key]
+            self._trim()
+
+    def _trim(self):
+        maxOpen = conf.supybot.plugins.BeerMe.db.maxOpen()
+        if not maxOpen:
+            return
+        idle = [key for key in self.dbs if key not in self.pins]
+        for key in idle[:max(len(self.dbs) - maxOpen, 0)]:
+            self._evict(key)
+
+    def __getattr__(self, attr):
+        def dispatch(channel, *args, **kwargs):
+            db = self._getDb(channel)
+            try:
+                result = getattr(db, attr)(*args, **kwargs)
+            except:
+                self._release(channel)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return PinnedIterator(result,
+                                      lambda: self._release(channel))
+            self._release(channel)
+            return result
+        return dispatch
+
+    def _evict(self, key):
+        db = self.dbs.pop(key)
+        del self.used[key]
+        db.close()
+        addStats(self.retired, db.stats())
+        self.evicted += 1
+
+    def evict_idle(self):
+        timeout = conf.supybot.plugins.BeerMe.db.idleTimeout()
+        if not timeout:
+            return
+        cutoff = time.time() - timeout
+        with self.lock:
+            for key in [key for key in self.dbs
+                        if self.used[key] < cutoff and key not in self.pins]:
+                self._evict(key)
+
+    def flush(self):
+        with self.lock:
+            plugins.DbiChannelDB.flush(self)
+        self.evict_idle()
+
+    def close(self):
+        with self.lock:
+            plugins.DbiChannelDB.close(self)
+            self.dbs.clear()
+            self.used.clear()
+
+    def stats(self):
+        """Sums the statistics of every channel DB, and adds how many are
+        open, have been opened and evicted, and the bytes the open ones hold
+        in memory for writes not yet merged into their cdb files."""
+        with self.lock:
+            totals = dict(self.retired)
+            buffered = 0
+            for db in self.dbs.itervalues():
+                addStats(totals, db.stats())
+                buffered += db.buffered()
+            totals.update({'open_handles': len(self.dbs),
+                           'opened_handles': self.opened,
+                           'evicted_handles': self.evicted,
+                           'buffered_bytes': buffered})
+        return totals
+
+
+class BeerReviewDB(BeerChannelDB):
+    class DB(dbi.DB, BeerRollups):
         Mapping = 'cdb'
+        topKey = '__top__'
+        topSize = 10
+        rankFields = ('beer_id', 'rating_sum', 'rating_count')
         class Record(dbi.Record):
             __fields__ = [
-                    'beer_id',
-                    'name',
-                    'brewery',
-                    'nick',
-                    'date_added',
-                    'votes',
-                    'reviews',
+                    ('beer_id', literal),
+                    ('name', literal),
+                    ('brewery', literal),
+                    ('nick', literal),
+                    ('date_added', literal),
+                    ('votes', literal),
+                    ('reviews', literal),
+                    ('rating_sum', (literal, 0.0)),
+                    ('rating_count', (literal, 0)),
                     ]
 
+            def rating_avg(self):
+                return self.rating_sum / self.rating_count
+
         def __init__(self, filename):
             self.db = cdb.open(filename + '.reviews', 'c')
+            # Commands run in threads; a cdb ReaderWriter isn't safe to
+            # share, so every read-modify-write, scan and flush holds this.
+            self.lock = threading.RLock()
+            self.bytes_written = 0
+            if self.topKey in self.db:
+                self.top_index = literal(self.db[self.topKey])
+            else:
+                self._migrate()
+            if self.rollupKey not in self.db:
+                self._build_rollups()
+
+        def _put(self, key, value):
+            self.bytes_written += len(key) + len(value)
+            self.db[key] = value
 
-        def _new_record(self, serialized):
+        def _new_record(self, serialized, fields=None):
             record = self.Record()
-            record.deserialize(serialized)
+            if fields is None:
+                record.deserialize(serialized)
+            else:
+                deserializeFields(record, serialized, fields)
             return record
 
+        def _combine(self, old, value):
+            if old is None:
+                return value
+            return (old[0] + value[0], old[1] + value[1])
+
+        def _review_rollups(self, beer_id, reviews):
+            return [(beer_id, review['nick'], parseDate(review['date']),
+                     (float(review['rating']), 1)) for review in reviews]
+
+        def _build_rollups(self):
+            entries = []
+            for record in self.iter_records(('beer_id', 'reviews')):
+                entries.extend(self._review_rollups(record.beer_id,
+                                                    record.reviews))
+            self._add_rollups(entries)
+            self._put(self.rollupKey, '1')
+
+        def _rank_key(self, record):
+            return (record.rating_avg(), record.rating_count, record.beer_id)
+
+        def _migrate(self):
+            """Fills in the rating aggregates of records written before they
+            existed, then builds the top index."""
+            for (beer_id, serialized) in self.db.items():
+                if beer_id.startswith('__'):
+                    continue
+                record = self._new_record(serialized)
+                if record.rating_count != len(record.reviews):
+                    record.rating_sum = sum([float(review['rating'])
+                                             for review in record.reviews])
+                    record.rating_count = len(record.reviews)
+                    self._put(beer_id, record.serialize())
+            self._rebuild_top()
+
+        def _rank(self, num):
+            ranked = rank(self.iter_records(self.rankFields), num,
+                          self._rank_key)
+            return [self._rank_key(r) for r in ranked]
+
+        def _rebuild_top(self):
+            self._store_top(self._rank(self.topSize))
+
+        def _store_top(self, ranked):
+            self.top_index = ranked
+            self._put(self.topKey, repr(ranked))
+
+        def _update_top(self, record, old_key):
+            index = self.top_index
+            if index is None:
+                return
+            new_key = self._rank_key(record)
+            if (old_key in index and len(index) == self.topSize and
+                new_key < index[-1]):
+                # A beer outside the index may now outrank this one.
+                self._store_top(None)
+                return
+            ranked = [key for key in index if key[2] != record.beer_id]
+            if len(ranked) < self.topSize or new_key > ranked[-1]:
+                ranked.append(new_key)
+                ranked.sort(reverse=True)
+            ranked = ranked[:self.topSize]
+            if ranked != index:
+                self._store_top(ranked)
+
         def update(self, beer_id, name, brewery, date, nick, review):
-            if beer_id in self.db:
-                existing_record = self._new_record(self.db[beer_id])
-                existing_record.reviews.append(review)
-                self.db[beer_id] = existing_record.serialize()
-            else:
-                new_record = self.Record(beer_id=beer_id, name=name,
-                                         brewery=brewery, date_added=date,
-                                         nick=nick, reviews=[review],
-                                         votes=0)
-                self.db[beer_id] = new_record.serialize()
-
-        def update_votes(self, beer_id, votes):
-            if beer_id in self.db:
-                existing_record = self._new_record(self.db[beer_id])
-                existing_record.votes = votes
-                self.db[beer_id] = existing_record.serialize()
-            else:
-                raise KeyError, beer_id
+            rating = float(review['rating'])
+            with self.lock:
+                if beer_id in self.db:
+                    existing_record = self._new_record(self.db[beer_id])
+                    old_key = self._rank_key(existing_record)
+                    existing_record.reviews.append(review)
+                    existing_record.rating_sum += rating
+                    existing_record.rating_count += 1
+                    self._put(beer_id, existing_record.serialize())
+                    self._update_top(existing_record, old_key)
+                else:
+                    new_record = self.Record(beer_id=beer_id, name=name,
+                                             brewery=brewery,
+                                             date_added=date, nick=nick,
+                                             reviews=[review], votes=0,
+                                             rating_sum=rating,
+                                             rating_count=1)
+                    self._put(beer_id, new_record.serialize())
+                    self._update_top(new_record, None)
+                self._add_rollups(self._review_rollups(beer_id, [review]))
+
+        def vote(self, beer_id, up):
+            """Adds an upvote, or takes one away down to 0, and returns the
+            beer's votes."""
+            with self.lock:
+                record = self._new_record(self.db[beer_id])
+                record.votes = max(record.votes + (1 if up else -1), 0)
+                self._put(beer_id, record.serialize())
+                return record.votes
 
         def get(self, beer_id):
-            return self._new_record(self.db[beer_id])
+            with self.lock:
+                return self._new_record(self.db[beer_id])
+
+        def iter_records(self, fields=None):
+            """Yields every record one at a time.  If <fields> is given, only
+            those fields are decoded.  Writes wait until the scan is done."""
+            with self.lock:
+                for (beer_id, serialized_record) in self.db.iteritems():
+                    if beer_id.startswith('__'):
+                        continue
+                    yield self._new_record(serialized_record, fields)
 
         def get_all(self):
-            records = {}
-            for (beer_id, serialized_record) in self.db.iteritems():
-                records[beer_id] = self._new_record(serialized_record)
-            return records
+            return dict([(r.beer_id, r) for r in self.iter_records()])
 
-        def flush(self):
+        def import_reviews(self, beers):
+            """Adds reviews in bulk from a dict of beer_id to (name, brewery,
+            reviews, votes), writing each record once.  votes is None to
+            leave a beer's votes alone."""
+            with self.lock:
+                self._import_reviews(beers)
+
+        def _import_reviews(self, beers):
+            entries = []
+            for (beer_id, (name, brewery, reviews, votes)) in \
+                    beers.iteritems():
+                if beer_id in self.db:
+                    record = self._new_record(self.db[beer_id])
+                elif reviews:
+                    record = self.Record(beer_id=beer_id, name=name,
+                                         brewery=brewery,
+                                         date_added=reviews[0]['date'],
+                                         nick=reviews[0]['nick'], reviews=[],
+                                         votes=0, rating_sum=0.0,
+                                         rating_count=0)
+                else:
+                    continue
+                record.reviews.extend(reviews)
+                record.rating_sum += sum([float(review['rating'])
+                                          for review in reviews])
+                record.rating_count += len(reviews)
+                if votes is not None:
+                    record.votes = votes
+                self._put(beer_id, record.serialize())
+                entries.extend(self._review_rollups(beer_id, reviews))
+            self._add_rollups(entries)
+            self._rebuild_top()
             self.db.flush()
 
+        def top(self, num, days=None, nick=None):
+            """Returns the <num> best rated beers as (avg, count, record),
+            only counting reviews from the last <days> days and by <nick>
+            if given."""
+            with self.lock:
+                return self._top(num, days, nick)
+
+        def _top(self, num, days, nick):
+            if days is not None or nick is not None:
+                totals = []
+                for (beer_id, nicks) in \
+                        self._rollup_view(days, nick).iteritems():
+                    (rating_sum, count) = reduce(self._combine,
+                                                 nicks.itervalues())
+                    totals.append((rating_sum / count, count, beer_id))
+                ranked = rank(totals, num, lambda key: key)
+            elif num > self.topSize:
+                ranked = self._rank(num)
+            else:
+                if self.top_index is None:
+                    self._rebuild_top()
+                ranked = self.top_index[:num]
+            return [(avg, count, self.get(beer_id))
+                    for (avg, count, beer_id) in ranked]
+
+        def stats(self):
+            return {'bytes_written': self.bytes_written}
+
+        def buffered(self):
+            with self.lock:
+                return cdbBuffered(self.db)
+
+        def flush(self):
+            with self.lock:
+                self.db.flush()
+
         def close(self):
-            self.db.close()
+            with self.lock:
+                self.db.close()
 
-class BeerTrackerDB(plugins.DbiChannelDB):
-    class DB(dbi.DB):
+class BeerTrackerDB(BeerChannelDB):
+    class DB(dbi.DB, BeerRollups):
         Mapping = 'cdb'
+        formatKey = '__format__'
         class Record(dbi.Record):
+            # refs is the old unbounded list of (nick, date) mentions; it is
+            # only kept so records written before the compact format still
+            # deserialize, and is always empty once migrated.
             __fields__ = [
-                    'beer_id',
-                    'name',
-                    'brewery',
-                    'refs',
+                    ('beer_id', literal),
+                    ('name', literal),
+                    ('brewery', literal),
+                    ('refs', literal),
+                    ('count', literal),
+                    ('nicks', literal),
+                    ('first_seen', literal),
+                    ('last_seen', literal),
+                    ('recent', literal),
                     ]
 
+            def mention(self, nick, when, keep):
+                self.count += 1
+                self.nicks[nick] = self.nicks.get(nick, 0) + 1
+                if when is not None:
+                    if self.first_seen is None or when < self.first_seen:
+                        self.first_seen = when
+                    if self.last_seen is None or when > self.last_seen:
+                        self.last_seen = when
+                if keep:
+                    self.recent.append((nick, when))
+                    del self.recent[:-keep]
+
         def __init__(self, filename):
             self.db = cdb.open(filename + '.tracker', 'c')
+            self.lock = threading.RLock()
+            self.bytes_written = 0
+            if self.formatKey not in self.db:
+                self._migrate()
+            self.pending = OrderedDict()
+            self.pending_count = 0
+            self.last_write = time.time()
+            self.batches = 0
+            self.batch_time = 0.0
+            self.last_batch_time = 0.0
+            if self.rollupKey not in self.db:
+                self._build_rollups()
+
+        def _put(self, key, value):
+            self.bytes_written += len(key) + len(value)
+            self.db[key] = value
 
-        def _new_record(self, serialized):
+        def _new_record(self, serialized, fields=None):
             record = self.Record()
-            record.deserialize(serialized)
+            if fields is None:
+                record.deserialize(serialized)
+            else:
+                deserializeFields(record, serialized, fields)
             return record
 
-        def update(self, beer_id, name, brewery, nick, date):
-            if beer_id in self.db:
-                existing_record = self._new_record(self.db[beer_id])
-                existing_record.refs.append((nick, date))
-                self.db[beer_id] = existing_record.serialize()
-            else:
-                new_record = self.Record(beer_id=beer_id, name=name,
-                                         brewery=brewery, refs=[(nick, date)])
-                self.db[beer_id] = new_record.serialize()
+        def _combine(self, old, value):
+            return (old or 0) + value
+
+        def _build_rollups(self):
+            entries = []
+            for record in self.iter_records():
+                entries.extend([(record.beer_id, nick, when, 1)
+                                for (nick, when) in recordMentions(record)])
+            self._add_rollups(entries)
+            self._put(self.rollupKey, '1')
+
+        def _compact(self, record):
+            """Converts a record from the old refs list to counters."""
+            (refs, record.refs) = (record.refs or [], [])
+            (record.count, record.nicks, record.recent) = (0, {}, [])
+            keep = conf.supybot.plugins.BeerMe.tracker.recent()
+            for (nick, date) in refs:
+                record.mention(nick, parseDate(date), keep)
+            return record
+
+        def _migrate(self):
+            # A popular beer's refs list can be longer than the 128KiB the
+            # csv module reads by default; compacted ones only grow with the
+            # number of nicks.
+            limit = csv.field_size_limit(sys.maxint)
+            try:
+                for (beer_id, serialized) in self.db.items():
+                    record = self._new_record(serialized)
+                    if record.count is None:
+                        self._put(beer_id,
+                                  self._compact(record).serialize())
+            finally:
+                csv.field_size_limit(limit)
+            self._put(self.formatKey, '2')
+
+        def _write_pending(self):
+            """Writes every buffered mention, one record write per beer."""
+            with self.lock:
+                self.last_write = time.time()
+                if not self.pending:
+                    return
+                keep = conf.supybot.plugins.BeerMe.tracker.recent()
+                entries = []
+                for (beer_id, (name, brewery, refs)) in \
+                        self.pending.iteritems():
+                    if beer_id in self.db:
+                        record = self._new_record(self.db[beer_id])
+                    else:
+                        record = self.Record(beer_id=beer_id, name=name,
+                                             brewery=brewery, refs=[],
+                                             count=0, nicks={}, recent=[])
+                    for (nick, when) in refs:
+                        record.mention(nick, when, keep)
+                        entries.append((beer_id, nick, when, 1))
+                    self._put(beer_id, record.serialize())
+                self._add_rollups(entries)
+                self.pending.clear()
+                self.pending_count = 0
+                self.batches += 1
+                self.last_batch_time = time.time() - self.last_write
+                self.batch_time += self.last_batch_time
+
+        def update(self, beer_id, name, brewery, nick, when):
+            group = conf.supybot.plugins.BeerMe.tracker
+            with self.lock:
+                if beer_id in self.pending:
+                    self.pending[beer_id][2].append((nick, when))
+                else:
+                    self.pending[beer_id] = (name, brewery, [(nick, when)])
+                self.pending_count += 1
+                if (self.pending_count >= group.batchSize() or
+                    time.time() - self.last_write >= group.batchInterval()):
+                    self._write_pending()
 
         def get(self, beer_id):
-            return self._new_record(self.db[beer_id])
+            with self.lock:
+                self._write_pending()
+                return self._new_record(self.db[beer_id])
+
+        def iter_records(self, fields=None):
+            """Yields every record one at a time.  If <fields> is given, only
+            those fields are decoded.  Writes wait until the scan is done."""
+            with self.lock:
+                self._write_pending()
+                for (beer_id, serialized_record) in self.db.iteritems():
+                    if beer_id.startswith('__'):
+                        continue
+                    yield self._new_record(serialized_record, fields)
 
         def get_all(self):
-            records = {}
-            for (beer_id, serialized_record) in self.db.iteritems():
-                records[beer_id] = self._new_record(serialized_record)
+            return dict([(r.beer_id, r) for r in self.iter_records()])
+
+        def import_mentions(self, beers):
+            """Adds mentions in bulk from a dict of beer_id to (name,
+            brewery, [(nick, when)]), writing each record once."""
+            with self.lock:
+                for (beer_id, (name, brewery, refs)) in beers.iteritems():
+                    if beer_id in self.pending:
+                        self.pending[beer_id][2].extend(refs)
+                    else:
+                        self.pending[beer_id] = (name, brewery, list(refs))
+                    self.pending_count += len(refs)
+                self._write_pending()
+                self.db.flush()
+
+        def top(self, num, days=None, nick=None):
+            """Returns the <num> most mentioned beers as (count, record),
+            only counting mentions from the last <days> days and by <nick>
+            if given; the records' count and nicks are those of the same
+            mentions."""
+            with self.lock:
+                return self._top(num, days, nick)
+
+        def _top(self, num, days, nick):
+            if days is None and nick is None:
+                ranked = rank(self.iter_records(('beer_id', 'count')), num,
+                              lambda r: (r.count, r.beer_id))
+                return [(r.count, self.get(r.beer_id)) for r in ranked]
+            self._write_pending()
+            view = self._rollup_view(days, nick)
+            ranked = rank(view.iterkeys(), num,
+                          lambda beer_id: (sum(view[beer_id].values()),
+                                           beer_id))
+            records = []
+            for beer_id in ranked:
+                record = self.get(beer_id)
+                record.nicks = view[beer_id]
+                record.count = sum(record.nicks.values())
+                records.append((record.count, record))
             return records
 
+        def buffered(self):
+            with self.lock:
+                return cdbBuffered(self.db)
+
+        def stats(self):
+            return {'pending': self.pending_count,
+                    'batches': self.batches,
+                    'batch_time': self.batch_time,
+                    'last_batch_time': self.last_batch_time,
+                    'bytes_written': self.bytes_written}
+
         def flush(self):
-            self.db.flush()
+            with self.lock:
+                self._write_pending()
+                self.db.flush()
 
         def close(self):
-            self.db.close()
+            with self.lock:
+                self._write_pending()
+                self.db.close()
+
+
+class BeerAliasDB(BeerChannelDB):
+    """Per-channel index from the exact names of the beers a channel has
+    reviewed, mentioned or been shown to the beers themselves.  The text
+    people searched with is never a key: what it finds changes as BreweryDB
+    does, and BeerSearchCache already keeps it for a while.  It is kept in
+    cdb files whatever the database backend, like the catalog."""
+    class DB(dbi.DB):
+        Mapping = 'cdb'
+        seededKey = '__seeded__'
+
+        def __init__(self, filename):
+            self.db = cdb.open(filename + '.aliases.db', 'c')
+            self.lock = threading.Lock()
+            self.bytes_written = 0
+            self.hits = 0
+            self.misses = 0
+
+        @staticmethod
+        def fold(name):
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            return ' '.join(name.lower().split())
+
+        def get(self, name):
+            """Returns the beer <name> resolved to as a search hit with an
+            id, name and brewery, or None."""
+            with self.lock:
+                serialized = self.db.get(self.fold(name))
+            if serialized is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(serialized)
+
+        def add(self, name, beer, replace=True):
+            key = self.fold(name)
+            if not key or key.startswith('__'):
+                return
+            brewery = ''
+            if 'breweries' in beer and 'name' in beer['breweries'][0]:
+                brewery = beer['breweries'][0]['name']
+            serialized = json.dumps({'id': beer['id'],
+                                     'name': beer['name'],
+                                     'breweries': [{'name': brewery}]})
+            with self.lock:
+                old = self.db.get(key)
+                if old != serialized and (replace or old is None):
+                    self.bytes_written += len(key) + len(serialized)
+                    self.db[key] = serialized
+
+        def seeded(self):
+            with self.lock:
+                return self.seededKey in self.db
+
+        def mark_seeded(self):
+            with self.lock:
+                self.db[self.seededKey] = '1'
+
+        def stats(self):
+            return {'hits': self.hits, 'misses': self.misses,
+                    'bytes_written': self.bytes_written}
+
+        def buffered(self):
+            with self.lock:
+                return cdbBuffered(self.db)
+
+        def flush(self):
+            with self.lock:
+                self.db.flush()
+
+        def close(self):
+            with self.lock:
+                self.db.close()
+
+
+class BeerSQLiteDB(object):
+    """Base for the SQLite backend, which keeps every channel's reviews and
+    mentions in one WAL-mode database file with normalized tables."""
+    schema = """
+        CREATE TABLE IF NOT EXISTS beers (
+            channel TEXT NOT NULL,
+            beer_id TEXT NOT NULL,
+            name TEXT,
+            brewery TEXT,
+            nick TEXT,
+            date_added TEXT,
+            PRIMARY KEY (channel, beer_id));
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            beer_id TEXT NOT NULL,
+            nick TEXT,
+            rating REAL NOT NULL,
+            rating_text TEXT,
+            description TEXT,
+            date TEXT,
+            ts REAL);
+        CREATE INDEX IF NOT EXISTS reviews_beer ON reviews (channel, beer_id);
+        CREATE INDEX IF NOT EXISTS reviews_nick ON reviews (channel, nick);
+        CREATE INDEX IF NOT EXISTS reviews_ts ON reviews (channel, ts);
+        CREATE TABLE IF NOT EXISTS votes (
+            channel TEXT NOT NULL,
+            beer_id TEXT NOT NULL,
+            votes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel, beer_id));
+        CREATE TABLE IF NOT EXISTS mentions (
+            id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            beer_id TEXT NOT NULL,
+            nick TEXT NOT NULL,
+            ts REAL);
+        CREATE INDEX IF NOT EXISTS mentions_beer
+            ON mentions (channel, beer_id);
+        CREATE INDEX IF NOT EXISTS mentions_nick ON mentions (channel, nick);
+        CREATE INDEX IF NOT EXISTS mentions_ts ON mentions (channel, ts);
+        """
+
+    def __init__(self, filename):
+        if sqlite3 is None:
+            raise callbacks.Error, 'You need Python\'s sqlite3 module to ' \
+                                   'use the sqlite3 database backend.'
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.bytes_written = 0
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.schema)
+        # Files made before ratings kept the text they were given as.
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(reviews)')]
+        if 'rating_text' not in columns:
+            self.conn.execute('ALTER TABLE reviews '
+                              'ADD COLUMN rating_text TEXT')
+        self.conn.commit()
+
+    def _channel(self, channel):
+        return ircutils.toLower(plugins.getChannel(channel))
+
+    def _written(self, rows):
+        """Counts the payload bytes of the given parameter rows."""
+        for row in rows:
+            self.bytes_written += sum([len(str(v)) for v in row
+                                       if v is not None])
+
+    def _window(self, channel, days, nick):
+        """Returns the WHERE clause and parameters selecting <channel>'s rows
+        from the last <days> UTC days and by <nick>, if given."""
+        (clauses, params) = (['channel=?'], [channel])
+        if days is not None:
+            clauses.append('ts >= ?')
+            params.append((epochDay(time.time()) - days + 1) * 86400)
+        if nick is not None:
+            clauses.append('nick=? COLLATE NOCASE')
+            params.append(nick)
+        return (' AND '.join(clauses), params)
+
+    def _add_beer(self, channel, beer_id, name, brewery, nick=None,
+                  date=None):
+        row = (channel, beer_id, name, brewery, nick, date)
+        cursor = self.conn.execute("""INSERT OR IGNORE INTO beers VALUES
+                                      (?, ?, ?, ?, ?, ?)""", row)
+        if cursor.rowcount:
+            self._written([row])
+
+    def stats(self):
+        return {'bytes_written': self.bytes_written}
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class BeerReviewSQLiteDB(BeerSQLiteDB):
+    Record = BeerReviewDB.DB.Record
+
+    def update(self, channel, beer_id, name, brewery, date, nick, review):
+        channel = self._channel(channel)
+        with self.lock:
+            self._add_beer(channel, beer_id, name, brewery, nick, date)
+            self.conn.execute("""INSERT OR IGNORE INTO votes VALUES
+                                 (?, ?, 0)""", (channel, beer_id))
+            row = (channel, beer_id, review['nick'],
+                   float(review['rating']), review['rating'],
+                   review['description'],
+                   review['date'], parseDate(review['date']))
+            self.conn.execute("""INSERT INTO reviews (channel, beer_id, nick,
+                                 rating, rating_text, description, date, ts)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", row)
+            self._written([row])
+            self.conn.commit()
+
+    def vote(self, channel, beer_id, up):
+        """Adds an upvote, or takes one away down to 0, and returns the
+        beer's votes."""
+        channel = self._channel(channel)
+        with self.lock:
+            cursor = self.conn.execute("""UPDATE votes
+                                          SET votes=MAX(votes + ?, 0)
+                                          WHERE channel=? AND beer_id=?""",
+                                       (1 if up else -1, channel, beer_id))
+            if cursor.rowcount == 0:
+                raise KeyError, beer_id
+            (votes,) = self.conn.execute("""SELECT votes FROM votes
+                                            WHERE channel=? AND beer_id=?""",
+                                         (channel, beer_id)).fetchone()
+            self._written([(votes, channel, beer_id)])
+            self.conn.commit()
+            return votes
+
+    def import_reviews(self, channel, beers):
+        """Adds reviews in bulk from a dict of beer_id to (name, brewery,
+        reviews, votes) in one transaction.  votes is None to leave a beer's
+        votes alone."""
+        channel = self._channel(channel)
+        with self.lock:
+            for (beer_id, (name, brewery, reviews, votes)) in \
+                    beers.iteritems():
+                if reviews:
+                    self._add_beer(channel, beer_id, name, brewery,
+                                   reviews[0]['nick'], reviews[0]['date'])
+                    self.conn.execute("""INSERT OR IGNORE INTO votes VALUES
+                                         (?, ?, 0)""", (channel, beer_id))
+                    rows = [(channel, beer_id, review['nick'],
+                             float(review['rating']), review['rating'],
+                             review['description'], review['date'],
+                             parseDate(review['date']))
+                            for review in reviews]
+                    self.conn.executemany("""INSERT INTO reviews (channel,
+                                             beer_id, nick, rating,
+                                             rating_text, description,
+                                             date, ts)
+                                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                          rows)
+                    self._written(rows)
+                if votes is not None:
+                    self.conn.execute("""UPDATE votes SET votes=?
+                                         WHERE channel=? AND beer_id=?""",
+                                      (votes, channel, beer_id))
+            self.conn.commit()
+
+    def _record(self, channel, beer_id):
+        row = self.conn.execute("""SELECT b.name, b.brewery, b.nick,
+                                   b.date_added, v.votes
+                                   FROM beers b JOIN votes v
+                                   USING (channel, beer_id)
+                                   WHERE b.channel=? AND b.beer_id=?""",
+                                (channel, beer_id)).fetchone()
+        if row is None:
+            raise KeyError, beer_id
+        (name, brewery, nick, date_added, votes) = row
+        reviews = [{'rating': str(rating), 'description': description,
+                    'nick': review_nick, 'date': date}
+                   for (rating, description, review_nick, date)
+                   in self.conn.execute("""SELECT COALESCE(rating_text,
+                                           rating), description, nick,
+                                           date FROM reviews
+                                           WHERE channel=? AND beer_id=?
+                                           ORDER BY id""",
+                                        (channel, beer_id))]
+        return self.Record(beer_id=beer_id, name=name, brewery=brewery,
+                           nick=nick, date_added=date_added, votes=votes,
+                           reviews=reviews,
+                           rating_sum=sum([float(r['rating'])
+                                           for r in reviews]),
+                           rating_count=len(reviews))
+
+    def get(self, channel, beer_id):
+        with self.lock:
+            return self._record(self._channel(channel), beer_id)
+
+    def iter_records(self, channel, fields=None):
+        """Yields every record of <channel> one at a time.  <fields> is
+        accepted for compatibility with the cdb backend; every field is
+        always filled in."""
+        channel = self._channel(channel)
+        with self.lock:
+            beer_ids = self.conn.execute("""SELECT beer_id FROM votes
+                                            WHERE channel=?""",
+                                         (channel,)).fetchall()
+        for (beer_id,) in beer_ids:
+            with self.lock:
+                record = self._record(channel, beer_id)
+            yield record
+
+    def get_all(self, channel):
+        return dict([(r.beer_id, r) for r in self.iter_records(channel)])
+
+    def top(self, channel, num, days=None, nick=None):
+        """Returns the <num> best rated beers as (avg, count, record), only
+        counting reviews from the last <days> days and by <nick> if
+        given."""
+        channel = self._channel(channel)
+        (where, params) = self._window(channel, days, nick)
+        with self.lock:
+            ranked = self.conn.execute("""SELECT beer_id,
+                                          AVG(rating) AS avg, COUNT(*) AS n
+                                          FROM reviews WHERE %s
+                                          GROUP BY beer_id
+                                          ORDER BY avg DESC, n DESC,
+                                                   beer_id DESC
+                                          LIMIT ?""" % where,
+                                       params + [num]).fetchall()
+            return [(avg, count, self._record(channel, beer_id))
+                    for (beer_id, avg, count) in ranked]
+
+
+class BeerTrackerSQLiteDB(BeerSQLiteDB):
+    Record = BeerTrackerDB.DB.Record
+
+    def __init__(self, filename):
+        # Bound now: on reload the old instance is closed after the module
+        # has been run again, when the name is another class.
+        self.__parent = super(BeerTrackerSQLiteDB, self)
+        self.__parent.__init__(filename)
+        self.pending = []
+        self.last_write = time.time()
+        self.batches = 0
+        self.batch_time = 0.0
+        self.last_batch_time = 0.0
+
+    def _write_pending(self):
+        with self.lock:
+            self.last_write = time.time()
+            if not self.pending:
+                return
+            for (channel, beer_id, name, brewery, _, _) in self.pending:
+                self._add_beer(channel, beer_id, name, brewery)
+            rows = [(channel, beer_id, nick, when)
+                    for (channel, beer_id, _, _, nick, when) in self.pending]
+            self.conn.executemany("""INSERT INTO mentions
+                                     (channel, beer_id, nick, ts)
+                                     VALUES (?, ?, ?, ?)""", rows)
+            self._written(rows)
+            self.conn.commit()
+            del self.pending[:]
+            self.batches += 1
+            self.last_batch_time = time.time() - self.last_write
+            self.batch_time += self.last_batch_time
+
+    def update(self, channel, beer_id, name, brewery, nick, when):
+        group = conf.supybot.plugins.BeerMe.tracker
+        with self.lock:
+            self.pending.append((self._channel(channel), beer_id, name,
+                                 brewery, nick, when))
+            if (len(self.pending) >= group.batchSize() or
+                time.time() - self.last_write >= group.batchInterval()):
+                self._write_pending()
+
+    def import_mentions(self, channel, beers):
+        """Adds mentions in bulk from a dict of beer_id to (name, brewery,
+        [(nick, when)]) in one transaction."""
+        channel = self._channel(channel)
+        with self.lock:
+            for (beer_id, (name, brewery, refs)) in beers.iteritems():
+                self.pending.extend([(channel, beer_id, name, brewery,
+                                      nick, when) for (nick, when) in refs])
+            self._write_pending()
+
+    def _records(self, channel, beer_ids):
+        keep = conf.supybot.plugins.BeerMe.tracker.recent()
+        records = []
+        for beer_id in beer_ids:
+            row = self.conn.execute("""SELECT name, brewery FROM beers
+                                       WHERE channel=? AND beer_id=?""",
+                                    (channel, beer_id)).fetchone()
+            if row is None:
+                raise KeyError, beer_id
+            # Grouping by +nick stops SQLite walking the whole channel in
+            # mentions_nick order to save a sort of a few rows.
+            nicks = dict(self.conn.execute("""SELECT nick, COUNT(*)
+                                              FROM mentions
+                                              WHERE channel=? AND beer_id=?
+                                              GROUP BY +nick""",
+                                           (channel, beer_id)).fetchall())
+            (first_seen, last_seen) = \
+                self.conn.execute("""SELECT MIN(ts), MAX(ts) FROM mentions
+                                     WHERE channel=? AND beer_id=?""",
+                                  (channel, beer_id)).fetchone()
+            recent = self.conn.execute("""SELECT nick, ts FROM mentions
+                                          WHERE channel=? AND beer_id=?
+                                          ORDER BY id DESC LIMIT ?""",
+                                       (channel, beer_id, keep)).fetchall()
+            recent.reverse()
+            records.append(self.Record(beer_id=beer_id, name=row[0],
+                                       brewery=row[1], refs=[],
+                                       count=sum(nicks.values()),
+                                       nicks=nicks, first_seen=first_seen,
+                                       last_seen=last_seen,
+                                       recent=[tuple(r) for r in recent]))
+        return records
+
+    def get(self, channel, beer_id):
+        self._write_pending()
+        with self.lock:
+            return self._records(self._channel(channel), [beer_id])[0]
+
+    def iter_records(self, channel, fields=None):
+        """Yields every record of <channel> one at a time.  <fields> is
+        accepted for compatibility with the cdb backend; every field is
+        always filled in."""
+        self._write_pending()
+        channel = self._channel(channel)
+        with self.lock:
+            beer_ids = self.conn.execute("""SELECT DISTINCT beer_id
+                                            FROM mentions WHERE channel=?""",
+                                         (channel,)).fetchall()
+        for (beer_id,) in beer_ids:
+            with self.lock:
+                record = self._records(channel, [beer_id])[0]
+            yield record
+
+    def get_all(self, channel):
+        return dict([(r.beer_id, r) for r in self.iter_records(channel)])
+
+    def top(self, channel, num, days=None, nick=None):
+        """Returns the <num> most mentioned beers as (count, record), only
+        counting mentions from the last <days> days and by <nick> if given;
+        the records' count and nicks are those of the same mentions."""
+        self._write_pending()
+        channel = self._channel(channel)
+        (where, params) = self._window(channel, days, nick)
+        with self.lock:
+            ranked = self.conn.execute("""SELECT beer_id, COUNT(*) AS n
+                                          FROM mentions WHERE %s
+                                          GROUP BY beer_id
+                                          ORDER BY n DESC, beer_id DESC
+                                          LIMIT ?""" % where,
+                                       params + [num]).fetchall()
+            records = self._records(channel, [b for (b, _) in ranked])
+            if days is not None or nick is not None:
+                for record in records:
+                    record.nicks = dict(self.conn.execute(
+                            """SELECT nick, COUNT(*) FROM mentions
+                               WHERE %s AND beer_id=?
+                               GROUP BY +nick""" % where,
+                            params + [record.beer_id]).fetchall())
+                    record.count = sum(record.nicks.values())
+            return [(r.count, r) for r in records]
+
+    def stats(self):
+        return {'pending': len(self.pending),
+                'batches': self.batches,
+                'batch_time': self.batch_time,
+                'last_batch_time': self.last_batch_time,
+                'bytes_written': self.bytes_written}
+
+    def flush(self):
+        self._write_pending()
+        self.__parent.flush()
+
+    def close(self):
+        self._write_pending()
+        self.__parent.close()
+
+
+def recordMentions(record):
+    """Returns a tracker record's mentions as (nick, when), oldest first.
+    Only the most recent mentions kept their timestamps, so the others come
+    first with a time of None."""
+    untimed = dict(record.nicks)
+    for (nick, _) in record.recent:
+        untimed[nick] -= 1
+    mentions = []
+    for (nick, count) in sorted(untimed.iteritems()):
+        mentions.extend([(nick, None)] * count)
+    return mentions + list(record.recent)
+
+
+def importCdb(datadir, review_db, tracker_db):
+    """Copies every channel's cdb review and tracker databases found under
+    <datadir> into the given SQLite backend databases.  Returns the number
+    of (reviews, mentions) imported."""
+    (num_reviews, num_mentions) = (0, 0)
+    for channel in sorted(os.listdir(datadir)):
+        base = os.path.join(datadir, channel, 'BeerMe.cdb.db')
+        if os.path.exists(base + '.reviews'):
+            db = BeerReviewDB.DB(base)
+            sqlite_channel = review_db._channel(channel)
+            with review_db.lock:
+                for record in db.iter_records():
+                    review_db._add_beer(sqlite_channel, record.beer_id,
+                                        record.name, record.brewery,
+                                        record.nick, record.date_added)
+                    review_db.conn.execute("""INSERT OR REPLACE INTO votes
+                                              VALUES (?, ?, ?)""",
+                                           (sqlite_channel, record.beer_id,
+                                            record.votes))
+                    review_db.conn.executemany(
+                            """INSERT INTO reviews (channel, beer_id, nick,
+                               rating, rating_text, description, date, ts)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                            [(sqlite_channel, record.beer_id, r['nick'],
+                              float(r['rating']), r['rating'],
+                              r['description'],
+                              r['date'], parseDate(r['date']))
+                             for r in record.reviews])
+                    num_reviews += len(record.reviews)
+                review_db.conn.commit()
+            db.close()
+        if os.path.exists(base + '.tracker'):
+            db = BeerTrackerDB.DB(base)
+            sqlite_channel = tracker_db._channel(channel)
+            with tracker_db.lock:
+                for record in db.iter_records():
+                    tracker_db._add_beer(sqlite_channel, record.beer_id,
+                                         record.name, record.brewery)
+                    mentions = recordMentions(record)
+                    tracker_db.conn.executemany(
+                            """INSERT INTO mentions (channel, beer_id, nick,
+                               ts) VALUES (?, ?, ?, ?)""",
+                            [(sqlite_channel, record.beer_id, nick, when)
+                             for (nick, when) in mentions])
+                    num_mentions += len(mentions)
+                tracker_db.conn.commit()
+            db.close()
+    return (num_reviews, num_mentions)
+
+
+def snapshotFile(channel, directory=''):
+    """Returns the name of <channel>'s review snapshot, in a directory named
+    after the channel under <directory> if given, else in the channel's
+    data directory."""
+    if directory:
+        directory = os.path.join(directory,
+                                 ircutils.toLower(plugins.getChannel(channel)))
+    return plugins.makeChannelFilename('BeerMe.reviews.snapshot', channel,
+                                       directory or None)
+
+
+def writeSnapshot(filename, records):
+    """Compiles review records into a BeerSnapshot file at <filename>,
+    atomically replacing any previous snapshot.  Returns the number of
+    beers written."""
+    (entries, offset) = ([], 0)
+    blobs = tempfile.TemporaryFile()
+    try:
+        for record in records:
+            beer_id = str(record.beer_id)
+            blob = json.dumps(dict([(name, getattr(record, name))
+                                    for name in record.fields]))
+            blobs.write(beer_id)
+            blobs.write(blob)
+            avg = record.rating_count and record.rating_avg() or 0.0
+            entries.append((beer_id, offset, offset + len(beer_id),
+                            len(blob), avg, record.rating_count,
+                            record.votes))
+            offset += len(beer_id) + len(blob)
+        entries.sort()
+        ranked = sorted(range(len(entries)), reverse=True,
+                        key=lambda i: (entries[i][4], entries[i][5],
+                                       entries[i][0]))
+        n = len(entries)
+        index = BeerSnapshot.header.size
+        ranking = index + n * BeerSnapshot.entry.size
+        data = ranking + 4 * n
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        fd = open(tmp, 'wb')
+        try:
+            fd.write(BeerSnapshot.header.pack(BeerSnapshot.magic, n, index,
+                                              ranking, data))
+            for (beer_id, id_off, blob_off, blob_len, avg, count, votes) \
+                    in entries:
+                fd.write(BeerSnapshot.entry.pack(data + id_off,
+                                                 len(beer_id),
+                                                 data + blob_off, blob_len,
+                                                 avg, count, votes))
+            fd.write(struct.pack('<%dI' % n, *ranked))
+            blobs.seek(0)
+            shutil.copyfileobj(blobs, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        os.rename(tmp, filename)
+    finally:
+        blobs.close()
+    return n
+
+
+class BeerSnapshot(object):
+    """Read-only view of a snapshot of a channel's review database, which
+    several bots can share.  The file is memory-mapped: a header, an index
+    of fixed-size entries sorted by beer_id holding each beer's rating
+    average, count and votes, the entries' order by rating, then the
+    beer ids and JSON records the entries point at.  Aggregates are read
+    straight from the mapping and a record is only decoded when asked for.
+    A new snapshot is published by renaming it over the old one; readers
+    notice and remap within a second."""
+    magic = 'BEERSNP1'
+    header = struct.Struct('<8sIQQQ')
+    entry = struct.Struct('<QIQIdIi')
+    Record = BeerReviewDB.DB.Record
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.map = None
+        self.ident = None
+        self.checked = time.time()
+        self._open()
+
+    def _open(self):
+        fd = open(self.filename, 'rb')
+        try:
+            st = os.fstat(fd.fileno())
+            m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        (magic, count, index, ranking, _) = self.header.unpack_from(m, 0)
+        if magic != self.magic:
+            m.close()
+            raise ValueError, '%s is not a BeerMe snapshot' % self.filename
+        if self.map is not None:
+            self.map.close()
+        (self.map, self.count, self.index, self.ranking) = \
+            (m, count, index, ranking)
+        self.ident = (st.st_ino, st.st_mtime, st.st_size)
+
+    def _refresh(self):
+        now = time.time()
+        if now - self.checked < 1:
+            return
+        self.checked = now
+        try:
+            st = os.stat(self.filename)
+        except EnvironmentError:
+            return
+        if (st.st_ino, st.st_mtime, st.st_size) != self.ident:
+            self._open()
+
+    def _entry(self, i):
+        return self.entry.unpack_from(self.map,
+                                      self.index + i * self.entry.size)
+
+    def _record(self, entry):
+        (_, _, blob_off, blob_len, _, _, _) = entry
+        return self.Record(**dict([(str(name), value) for (name, value) in
+                                   json.loads(self.map[blob_off:
+                                                       blob_off + blob_len])
+                                   .iteritems()]))
+
+    def get(self, beer_id):
+        beer_id = str(beer_id)
+        with self.lock:
+            self._refresh()
+            (lo, hi) = (0, self.count)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                entry = self._entry(mid)
+                found = self.map[entry[0]:entry[0] + entry[1]]
+                if found < beer_id:
+                    lo = mid + 1
+                elif found > beer_id:
+                    hi = mid
+                else:
+                    return self._record(entry)
+            raise KeyError, beer_id
+
+    def top(self, num):
+        """Returns the <num> best rated beers as (avg, count, record)."""
+        with self.lock:
+            self._refresh()
+            num = min(num, self.count)
+            ranked = struct.unpack_from('<%dI' % num, self.map, self.ranking)
+            return [(entry[4], entry[5], self._record(entry))
+                    for entry in [self._entry(i) for i in ranked]]
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+
+def recordFormat(filename):
+    """Returns 'csv' or 'jsonl', the import/export format for <filename>."""
+    if filename.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def readRecords(fd, format):
+    """Yields the rows of a CSV file with a header line, or of a JSONL file,
+    as dicts of str values; empty CSV cells are left out."""
+    if format == 'csv':
+        for row in csv.DictReader(fd):
+            yield dict([(key, value) for (key, value) in row.iteritems()
+                        if value not in (None, '')])
+    else:
+        for line in fd:
+            if line.strip():
+                row = json.loads(line)
+                yield dict([(str(key), (value.encode('utf-8')
+                                        if isinstance(value, unicode)
+                                        else value))
+                            for (key, value) in row.iteritems()])
+
+
+def importRecords(rows, review_db, tracker_db, channel, resolve):
+    """Bulk-loads review, votes and mention rows as read by readRecords into
+    <channel>'s databases, one write per beer.  Rows that name a beer rather
+    than give its beer_id are looked up with <resolve>, which is called once
+    with every distinct name (case and spacing folded) and returns a dict of
+    name to beer payload.
+    Returns the number of reviews and mentions imported and of rows
+    skipped."""
+    rows = list(rows)
+    for row in rows:
+        if 'beer' in row:
+            row['beer'] = ' '.join(row['beer'].lower().split())
+    names = set([row['beer'] for row in rows
+                 if 'beer_id' not in row and 'beer' in row])
+    found = {}
+    if names:
+        found = resolve(sorted(names))
+    (reviews, mentions, skipped) = ({}, {}, 0)
+    for row in rows:
+        if 'beer_id' in row:
+            (beer_id, name, brewery) = (str(row['beer_id']),
+                                        row.get('name', ''),
+                                        row.get('brewery', ''))
+        elif row.get('beer') in found:
+            beer = found[row['beer']]
+            brewery = ''
+            if 'breweries' in beer and 'name' in beer['breweries'][0]:
+                brewery = beer['breweries'][0]['name']
+            (beer_id, name) = (str(beer['id']), beer['name'])
+        else:
+            skipped += 1
+            continue
+        kind = row.get('type')
+        if kind is None:
+            kind = 'rating' in row and 'review' or 'mention'
+        try:
+            if kind == 'review':
+                float(row['rating'])
+                review = {'rating': str(row['rating']).strip(),
+                          'description': row.get('description', ''),
+                          'nick': row.get('nick', ''),
+                          'date': row.get('date') or
+                                  time.strftime('%B %d, %Y %H:%M',
+                                                time.localtime())}
+                reviews.setdefault(beer_id,
+                                   [name, brewery, [], None])[2].append(review)
+            elif kind == 'votes':
+                reviews.setdefault(beer_id,
+                                   [name, brewery, [], None])[3] = \
+                    int(row['votes'])
+            elif kind == 'mention':
+                when = row.get('when')
+                if when is not None:
+                    when = float(when)
+                mentions.setdefault(beer_id, (name, brewery, []))[2].append(
+                        (row.get('nick', ''), when))
+            else:
+                skipped += 1
+        except (KeyError, ValueError):
+            skipped += 1
+    review_db.import_reviews(channel, reviews)
+    tracker_db.import_mentions(channel, mentions)
+    return (sum([len(entry[2]) for entry in reviews.itervalues()]),
+            sum([len(entry[2]) for entry in mentions.itervalues()]),
+            skipped)
+
+
+def exportRecords(review_db, tracker_db, channel):
+    """Yields <channel>'s reviews, votes and mentions one row at a time, in
+    the form importRecords reads."""
+    for record in review_db.iter_records(channel):
+        beer = {'beer_id': record.beer_id, 'name': record.name,
+                'brewery': record.brewery}
+        for review in record.reviews:
+            row = dict(beer, type='review')
+            row.update(review)
+            yield row
+        if record.votes:
+            yield dict(beer, type='votes', votes=record.votes)
+    for record in tracker_db.iter_records(channel):
+        for (nick, when) in recordMentions(record):
+            yield {'type': 'mention', 'beer_id': record.beer_id,
+                   'name': record.name, 'brewery': record.brewery,
+                   'nick': nick, 'when': when}
+
+
+def writeRecords(rows, fd):
+    """Writes rows as JSONL, returning how many were written."""
+    n = 0
+    for row in rows:
+        fd.write(json.dumps(row) + '\n')
+        n += 1
+    return n
 
 
 class BeerMeHelper:
@@ -149,12 +1567,699 @@ class BeerMeHelper:
             cur = cur + kwargs['postfix']
         return u"{0}".format(mircColor(cur, color))
 
+    # Field renderers are compiled once per field list; these map the
+    # dispatch functions above to the compilers producing equivalent
+    # renderers with their color codes and brackets already joined up.
+    compilers = {'_getSimpleField': '_compileSimpleField',
+                 '_getBrewery': '_compileBrewery'}
+
+    @classmethod
+    def _colorCodes(self, color):
+        """Returns the (start, end) codes mircColor wraps text in."""
+        if color is None:
+            return ('', '')
+        return tuple(mircColor('\0', color).split('\0'))
+
+    @classmethod
+    def _compileSimpleField(self, path, color=None, prefix='', postfix='',
+                            bracketize=True):
+        (start, end) = self._colorCodes(color)
+        (start, end) = (start + prefix, postfix + end)
+        if bracketize is not False:
+            (start, end) = ('[' + start, end + ']')
+        path = tuple(path)
+        def render(beer):
+            cur = beer
+            for elem in path:
+                if elem not in cur:
+                    return ''
+                cur = cur[elem]
+            return u'%s%s%s' % (start, cur, end)
+        return render
+
+    @classmethod
+    def _compileBrewery(self, color=None, num=1, bracketize=True):
+        (start, end) = self._colorCodes(color)
+        (left, right) = ('[', ']') if bracketize is not False else ('', '')
+        def render(beer):
+            if 'breweries' not in beer:
+                return ''
+            breweries = []
+            for brewery in beer['breweries'][:num]:
+                if 'established' in brewery:
+                    breweries.append(u'%s%s%s, est. %s%s%s'
+                                     % (start, brewery['name'], end,
+                                        start, brewery['established'], end))
+                else:
+                    breweries.append(u'%s%s%s' % (start, brewery['name'], end))
+            if not breweries:
+                return ''
+            return u'%s%s%s' % (left, ' | '.join(breweries), right)
+        return render
+
+    @classmethod
+    def _compileDispatch(self, dispatch, kwargs):
+        bracketize = kwargs.get('bracketize') is not False
+        def render(beer):
+            out = dispatch(beer, **kwargs)
+            if out and bracketize:
+                return u"[{0}]".format(out)
+            return out
+        return render
+
+    @classmethod
+    def compileFields(self, fieldDispatch, fields):
+        """Returns a function rendering a beer payload as the given fields."""
+        renderers = []
+        for field in fields:
+            if field not in fieldDispatch:
+                continue
+            (dispatch, kwargs) = fieldDispatch[field]
+            compiler = self.compilers.get(dispatch.__name__)
+            if compiler is not None:
+                renderers.append(getattr(self, compiler)(**kwargs))
+            else:
+                renderers.append(self._compileDispatch(dispatch, kwargs))
+        def render(beer):
+            outFields = []
+            for renderer in renderers:
+                out = renderer(beer)
+                if out:
+                    outFields.append(out)
+            return ' '.join(outFields)
+        return render
+
+
+class BeerSearchCache(object):
+    """Bounded LRU cache of BreweryDB search results with a per-entry TTL."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, search_type):
+        return (' '.join(text.lower().split()), search_type)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                (expires, value) = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class RateLimited(BudgetExceeded):
+    """BreweryDB answered 429 Too Many Requests and asked for <wait>
+    seconds before the next request."""
+    def __init__(self, path, wait):
+        BudgetExceeded.__init__(self, path)
+        self.wait = wait
+
+
+class TokenBucket(object):
+    """Allows <rate> requests per second on average and up to <burst> at
+    once."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def available(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+
+class BreweryDBLimiter(object):
+    """Keeps BreweryDB requests within a global and a per-channel token
+    bucket and a daily quota.  Background requests must leave
+    supybot.plugins.BeerMe.limit.reserve requests for commands.  The
+    requests used today are kept in <filename>, written at most every
+    saveInterval seconds and on flush, so a restart doesn't hand out the
+    daily quota again.  After a pause, nothing is handed out until it is
+    over."""
+    saveInterval = 60
+
+    def __init__(self, filename, log):
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.log = log
+        group = conf.supybot.plugins.BeerMe.limit
+        self.bucket = TokenBucket(group.rate(), group.burst())
+        self.channels = ircutils.IrcDict()
+        self.day = None
+        self.used = 0
+        self.throttled = 0
+        self.paused_until = 0
+        self.saved = (None, 0)
+        self.last_save = time.time()
+        try:
+            fd = open(filename)
+            try:
+                state = json.load(fd)
+            finally:
+                fd.close()
+            self.saved = (tuple(state['day']), int(state['used']))
+            (self.day, self.used) = self.saved
+        except IOError:
+            pass
+        except (ValueError, KeyError, TypeError), e:
+            log.warning('BeerMe: ignoring unreadable %s: %s', filename, e)
+
+    def _channelBucket(self, channel, group):
+        if channel not in self.channels:
+            self.channels[channel] = TokenBucket(group.channelRate(),
+                                                 group.channelBurst())
+        bucket = self.channels[channel]
+        (bucket.rate, bucket.burst) = (group.channelRate(),
+                                       group.channelBurst())
+        return bucket
+
+    def _today(self):
+        today = time.gmtime()[:3]
+        if today != self.day:
+            (self.day, self.used) = (today, 0)
+
+    def acquire(self, channel=None, background=False):
+        """Takes a request from the budget, or returns False if there is
+        none left."""
+        group = conf.supybot.plugins.BeerMe.limit
+        reserve = group.reserve() if background else 0
+        with self.lock:
+            self._today()
+            if time.time() < self.paused_until:
+                self.throttled += 1
+                return False
+            (self.bucket.rate, self.bucket.burst) = (group.rate(),
+                                                     group.burst())
+            buckets = [self.bucket]
+            if channel is not None:
+                buckets.append(self._channelBucket(channel, group))
+            if ((group.daily() and
+                 self.used + reserve >= group.daily()) or
+                self.bucket.available() < reserve + 1 or
+                [b for b in buckets[1:] if b.available() < 1]):
+                self.throttled += 1
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.used += 1
+            if time.time() - self.last_save >= self.saveInterval:
+                self._save()
+            return True
+
+    def charge(self, n):
+        """Counts <n> requests already made, such as retries, against
+        today's quota."""
+        with self.lock:
+            self._today()
+            self.used += n
+
+    def pause(self, seconds):
+        """Hands out no requests for the next <seconds> seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def _save(self):
+        self.last_save = time.time()
+        if (self.day, self.used) == self.saved:
+            return
+        tmp = self.filename + '.tmp'
+        try:
+            fd = open(tmp, 'w')
+            try:
+                json.dump({'day': self.day, 'used': self.used}, fd)
+            finally:
+                fd.close()
+            os.rename(tmp, self.filename)
+            self.saved = (self.day, self.used)
+        except EnvironmentError, e:
+            self.log.warning('BeerMe: could not write %s: %s',
+                             self.filename, e)
+
+    def flush(self):
+        with self.lock:
+            self._save()
+
+    def remaining(self):
+        """Returns the requests left today (None if unlimited) and in the
+        global bucket."""
+        daily = conf.supybot.plugins.BeerMe.limit.daily()
+        with self.lock:
+            if time.gmtime()[:3] != self.day:
+                used = 0
+            else:
+                used = self.used
+            tokens = self.bucket.available()
+        return (max(daily - used, 0) if daily else None, int(tokens))
+
+
+class SingleFlight(object):
+    """Lets concurrent callers asking for the same key share one call: the
+    first caller runs it, the others wait for and receive its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+            else:
+                self.coalesced += 1
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            try:
+                call['result'] = fn()
+            except Exception, e:
+                call['error'] = e
+                raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['result']
+
+
+class BreweryDBClient(object):
+    """Pooled keep-alive HTTP session for the BreweryDB API.
+
+    Requests are retried after connection errors and 5xx responses, and
+    each retry is charged to <limiter>'s daily quota once it has been
+    made.  A 429 is never retried: it raises RateLimited instead."""
+    retryStatuses = (500, 502, 503, 504)
+    # Seconds to wait after a 429 that doesn't say how long.
+    rateLimitWait = 60
+
+    def __init__(self, baseUrl, log, stats, limiter, poolSize, retries,
+                 backoff):
+        # requests takes a while to import, so it is only imported once the
+        # plugin first talks to BreweryDB.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+        self.errors = (requests.RequestException, ValueError)
+        self.retryError = requests.exceptions.RetryError
+        self.baseUrl = baseUrl
+        self.log = log
+        self.stats = stats
+        self.limiter = limiter
+        self.retries = retries
+        self.slots = threading.BoundedSemaphore(poolSize)
+        # urllib3 retries any 429 with a Retry-After header unless told
+        # not to look at the header.
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=self.retryStatuses,
+                      method_whitelist=frozenset(['GET']),
+                      respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize,
+                              pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _retried(self, n):
+        if n:
+            self.stats.count('api retries', n)
+            self.limiter.charge(n)
+
+    def get(self, path, params, timeout):
+        with self.slots:
+            try:
+                r = self.session.get("%s%s" % (self.baseUrl, path),
+                                     params=params, timeout=timeout)
+                self.log.debug('BreweryDB URL=[%s]' % r.url)
+                retries = getattr(r.raw, 'retries', None)
+                self._retried(retries and len(retries.history) or 0)
+                if r.status_code == 429:
+                    try:
+                        wait = int(r.headers.get('Retry-After'))
+                    except (TypeError, ValueError):
+                        wait = self.rateLimitWait
+                    raise RateLimited(path, wait)
+                self.stats.count('api bytes received', len(r.content))
+                with self.stats.timer('decode %s' % path):
+                    return r.json()
+            except self.errors, e:
+                if isinstance(e, self.retryError):
+                    self._retried(self.retries)
+                self.log.warning('BreweryDB request for %s failed: %s'
+                                 % (path, e))
+                return {}
+
+    def close(self):
+        self.session.close()
+
+
+class BeerCatalog(object):
+    """Local index of every beer payload the plugin has seen, so lookups can
+    be answered without asking BreweryDB.
+
+    Payloads are kept in a cdb file alongside an inverted index from
+    case-folded name tokens to beer ids; beer name tokens live under 'n:'
+    keys and brewery name tokens under 'w:' keys.  The sorted token lists
+    are kept in memory so query terms can be matched as prefixes.
+
+    A cdb ReaderWriter keeps every value written in memory until it is
+    closed, so the file is reopened on every flush and after every
+    <reopenEvery> beers added."""
+    kinds = {'beer': 'n', 'brewery': 'w'}
+    reopenEvery = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = cdb.open(filename, 'c')
+        self.writes = 0
+        self.lock = threading.RLock()
+        self.tokens = dict([(kind, []) for kind in self.kinds.itervalues()])
+        for key in self.db.iterkeys():
+            (kind, _, token) = key.partition(':')
+            if kind in self.tokens:
+                self.tokens[kind].append(token)
+        for tokens in self.tokens.itervalues():
+            tokens.sort()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def tokenize(text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        text = re.sub(r'\(.*?\)', ' ', text)
+        return [token.encode('utf-8')
+                for token in re.findall(r'\w+', text.lower(), re.UNICODE)]
+
+    def _names(self, beer, search_type):
+        if search_type == 'beer':
+            return [beer['name']]
+        return [brewery.get('name', '')
+                for brewery in beer.get('breweries', [])]
+
+    def _post(self, kind, token, beer_id):
+        key = '%s:%s' % (kind, token)
+        ids = self.db.get(key, '').split()
+        if beer_id not in ids:
+            if not ids:
+                bisect.insort(self.tokens[kind], token)
+            ids.append(beer_id)
+            self.db[key] = ' '.join(ids)
+
+    def add(self, beer):
+        # Payloads fetched without withBreweries=Y can't answer brewery
+        # searches or show the brewery, so only full payloads are kept.
+        if 'id' not in beer or 'name' not in beer or 'breweries' not in beer:
+            return
+        beer_id = str(beer['id'])
+        serialized = json.dumps(beer)
+        with self.lock:
+            if self.db.get('b:' + beer_id) == serialized:
+                return
+            self.db['b:' + beer_id] = serialized
+            for (search_type, kind) in self.kinds.iteritems():
+                for name in self._names(beer, search_type):
+                    for token in set(self.tokenize(name)):
+                        self._post(kind, token, beer_id)
+            self.writes += 1
+            if self.writes >= self.reopenEvery:
+                self._reopen()
+
+    def _reopen(self):
+        self.db.close()
+        self.db = cdb.open(self.filename, 'c')
+        self.writes = 0
+
+    def _lookup(self, kind, term):
+        """Returns the ids of beers with a token starting with <term>, and
+        the subset whose token is exactly <term>."""
+        tokens = self.tokens[kind]
+        (ids, exact) = (set(), set())
+        i = bisect.bisect_left(tokens, term)
+        while i < len(tokens) and tokens[i].startswith(term):
+            posting = self.db['%s:%s' % (kind, tokens[i])].split()
+            ids.update(posting)
+            if tokens[i] == term:
+                exact.update(posting)
+            i += 1
+        return (ids, exact)
+
+    def search(self, text, search_type, maxNum):
+        """Returns up to <maxNum> known beers where every term of <text>
+        prefixes a word of the beer (or brewery) name, best matches first."""
+        terms = self.tokenize(text)
+        matched = set()
+        scores = {}
+        if terms:
+            with self.lock:
+                for (i, term) in enumerate(terms):
+                    (ids, exact) = self._lookup(self.kinds[search_type], term)
+                    matched = ids if i == 0 else (matched & ids)
+                    for beer_id in exact:
+                        scores[beer_id] = scores.get(beer_id, 0) + 1
+                beers = [json.loads(self.db['b:' + beer_id])
+                         for beer_id in matched]
+        if not matched:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return rank(beers, maxNum,
+                    lambda b: (scores.get(b['id'], 0), -len(b['name'])))
+
+    def random(self):
+        """Returns a random known beer, or None if none are known."""
+        with self.lock:
+            tokens = self.tokens[self.kinds['beer']]
+            if not tokens:
+                return None
+            key = '%s:%s' % (self.kinds['beer'], random.choice(tokens))
+            beer_id = random.choice(self.db[key].split())
+            return json.loads(self.db['b:' + beer_id])
+
+    def buffered(self):
+        with self.lock:
+            return cdbBuffered(self.db)
+
+    def flush(self):
+        with self.lock:
+            self._reopen()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class RandomBeerPool(object):
+    """Bounded supply of prefetched random beers, topped up in the
+    background so random doesn't have to wait on BreweryDB.  Once fewer
+    than the low watermark are left, each get fetches at most batch more
+    until the pool is back up to the high one, so prefetching never costs
+    much more than the random commands it serves.
+
+    The pool is never filled past the number of gets in the last maxAge
+    seconds, so beers are only prefetched at the pace they are asked for
+    and a quiet channel's don't expire unused."""
+    batch = 2
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.beers = deque()
+        self.asked = deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.filling = False
+        self.closed = False
+        self.hits = 0
+        self.fallbacks = 0
+
+    def get(self, low, high, maxAge):
+        """Returns a prefetched beer no older than <maxAge> seconds, or None,
+        and fetches up to batch more while the pool is being topped up to
+        <high> beers, which starts once fewer than <low> are left."""
+        with self.lock:
+            now = time.time()
+            expired = now - maxAge
+            while self.beers and self.beers[0][0] < expired:
+                self.beers.popleft()
+            while self.asked and (self.asked[0] < expired or
+                                  len(self.asked) > high):
+                self.asked.popleft()
+            high = min(high, len(self.asked))
+            self.asked.append(now)
+            if self.beers:
+                beer = self.beers.popleft()[1]
+                self.hits += 1
+            else:
+                beer = None
+                self.fallbacks += 1
+            if len(self.beers) < low:
+                self.filling = True
+            wanted = min(self.batch, high - len(self.beers))
+            if self.filling and wanted > 0 and not self.closed and \
+                    (self.thread is None or not self.thread.isAlive()):
+                self.thread = world.SupyThread(target=self._refill,
+                                               args=(wanted, high),
+                                               name='BeerMe random beer '
+                                                    'refill')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        return beer
+
+    def _refill(self, wanted, high):
+        for i in range(wanted):
+            if self.closed:
+                return
+            beer = self.fetch()
+            with self.lock:
+                if beer is None:
+                    # Over budget or failed: try again on a later get.
+                    return
+                self.beers.append((time.time(), beer))
+                if len(self.beers) >= high:
+                    self.filling = False
+
+    def close(self):
+        """Stops refilling and waits for a refill under way to finish, so
+        it no longer uses the databases its fetch writes to."""
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+class LazyResource(object):
+    """Stands in for a database or client that is only made, by calling
+    <make>, when one of its attributes is first used.  Flushing or closing
+    it before then does nothing.  Its own attributes are underscored so
+    they don't hide the resource's."""
+    def __init__(self, make):
+        self._make = make
+        self._lock = threading.Lock()
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._make()
+        return self._target
+
+    @property
+    def loaded(self):
+        """The resource if it has been made, else None."""
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def flush(self):
+        if self._target is not None:
+            self._target.flush()
+
+    def close(self):
+        if self._target is not None:
+            self._target.close()
+
+
+class NoLock(object):
+    """A lock that never blocks."""
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+
+class BeerMeStats(object):
+    """Counters and rolling latency samples for the plugin's hot paths."""
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen=self.samples)
+            self.timings[name].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        with self.lock:
+            samples = sorted(self.timings.get(name, ()))
+        if not samples:
+            return [0.0 for point in points]
+        return [samples[min(len(samples) - 1, len(samples) * point // 100)]
+                for point in points]
+
+    def snapshot(self):
+        """Returns the counters and each timing's sample count and
+        p50/p95/p99 in seconds."""
+        with self.lock:
+            names = sorted(self.timings)
+            counters = dict(self.counters)
+        timings = {}
+        for name in names:
+            (p50, p95, p99) = self.percentiles(name)
+            timings[name] = {'count': len(self.timings[name]),
+                             'p50': p50, 'p95': p95, 'p99': p99}
+        return {'timings': timings, 'counters': counters}
+
 
 class BeerMe(callbacks.Plugin):
     """
     Water and tea ain't got nothin' on me
     """
-    baseUrl = 'http://api.brewerydb.com/v2'
+    threaded = True
 
     fieldDispatch = {
             'name': (BeerMeHelper._getSimpleField,
@@ -185,11 +2290,85 @@ class BeerMe(callbacks.Plugin):
                     'num': 3})
             }
 
+    # Leaderboard windows in UTC days, counting today.
+    windows = {'day': 1, 'week': 7, 'month': 30, 'all': None}
+    windowOpts = {'window': ('literal', ('day', 'week', 'month', 'all')),
+                  'nick': 'something'}
+
+    avgLabel = mircColor('Avg.', 'dark grey')
+    mentionsLabel = mircColor('Mentions:', 'dark grey')
+    mentionersLabel = mircColor('Mentioners:', 'dark grey')
+
     def __init__(self, irc):
         self.__parent = super(BeerMe, self)
         self.__parent.__init__(irc)
-        self.review_db = plugins.DB('BeerMe', {'cdb': BeerReviewDB})()
-        self.tracker_db = plugins.DB('BeerMe', {'cdb': BeerTrackerDB})()
+        # supybot holds a per-plugin lock around callCommand, so even
+        # threaded commands run one at a time and one waiting on BreweryDB
+        # holds up the rest.  Everything shared between commands has its
+        # own lock, so let them overlap.
+        setattr(self, utils.python.Synchronized.LOCK, NoLock())
+        self.stats = BeerMeStats()
+        # Databases and the BreweryDB client are only opened by the first
+        # command using them, so loading the plugin stays cheap on bots
+        # where nobody asks for a beer.
+        self.review_db = LazyResource(lambda: self._makeDB(
+                {'cdb': BeerReviewDB, 'sqlite3': BeerReviewSQLiteDB}))
+        self.tracker_db = LazyResource(lambda: self._makeDB(
+                {'cdb': BeerTrackerDB, 'sqlite3': BeerTrackerSQLiteDB}))
+        self.aliases = LazyResource(lambda: BeerAliasDB(
+                conf.supybot.directories.data.dirize('BeerMe')))
+        self.catalog = LazyResource(lambda: BeerCatalog(
+                conf.supybot.directories.data.dirize('BeerMe.catalog.db')))
+        for db in self._databases():
+            world.flushers.append(db.flush)
+        self.brewerydb = LazyResource(lambda: BreweryDBClient(
+                self.registryValue('apiUrl'), self.log, self.stats,
+                self.limiter, self.registryValue('http.concurrency'),
+                self.registryValue('http.retries'),
+                self.registryValue('http.backoff')))
+        self._renderers = {}
+        self.snapshots = {}
+        self.limiter = BreweryDBLimiter(
+                conf.supybot.directories.data.dirize('BeerMe.limit.json'),
+                self.log)
+        world.flushers.append(self.limiter.flush)
+        self.random_pool = RandomBeerPool(self._prefetch_random)
+        self.search_cache = BeerSearchCache(
+                self.registryValue('search.cacheSize'),
+                self.registryValue('search.cacheTTL'))
+        self.search_flight = SingleFlight()
+        dumpInterval = self.registryValue('stats.dumpInterval')
+        if self.registryValue('stats.dumpFile') and dumpInterval:
+            schedule.addPeriodicEvent(self._dumpStats, dumpInterval,
+                                      name='BeerMeStatsDump', now=False)
+
+    def _makeDB(self, types):
+        # plugins.DB only tries the backends listed in supybot.databases,
+        # which knows nothing about sqlite3, so pick the backend ourselves
+        # using the same filename scheme.
+        backend = self.registryValue('database')
+        filename = conf.supybot.directories.data.dirize('BeerMe')
+        return types[backend]('.'.join([filename, backend, 'db']))
+
+    def die(self):
+        try:
+            schedule.removePeriodicEvent('BeerMeStatsDump')
+        except KeyError:
+            pass
+        # A refill writes to the catalog.
+        self.random_pool.close()
+        for db in self._databases():
+            world.flushers.remove(db.flush)
+            db.close()
+        world.flushers.remove(self.limiter.flush)
+        self.limiter.flush()
+        for snapshot in self.snapshots.itervalues():
+            snapshot.close()
+        self.brewerydb.close()
+        self.__parent.die()
+
+    def _databases(self):
+        return [self.review_db, self.tracker_db, self.aliases, self.catalog]
 
     def listCommands(self):
         return self.__parent.listCommands(["random",
@@ -200,20 +2379,63 @@ class BeerMe(callbacks.Plugin):
                                            "top",
                                            "upvote",
                                            "downvote",
-                                           "tracker"])
+                                           "tracker",
+                                           "beerstats",
+                                           "beerimport",
+                                           "beerexport",
+                                           "beersnapshot"])
+
+    def callCommand(self, command, irc, msg, *args, **kwargs):
+        with self.stats.timer('command %s' % ' '.join(command)):
+            self.__parent.callCommand(command, irc, msg, *args, **kwargs)
 
     def _printFields(self, beer, fields):
-        outFields = []
-        for field in fields:
-            if field in self.fieldDispatch:
-                (dispatch, kwargs) = self.fieldDispatch[field]
-                out = dispatch(beer, **kwargs)
-                if out:
-                    if 'bracketize' in kwargs and kwargs['bracketize'] is False:
-                        outFields.append(out)
-                    else:
-                        outFields.append(u"[{0}]".format(out))
-        return ' '.join(outFields)
+        key = tuple(fields)
+        try:
+            render = self._renderers[key]
+        except KeyError:
+            # Field lists come from user input, so keep this bounded.
+            if len(self._renderers) >= 64:
+                self._renderers.clear()
+            render = BeerMeHelper.compileFields(self.fieldDispatch, fields)
+            self._renderers[key] = render
+        return render(beer)
+
+    def _request(self, path, payload, channel=None, background=False):
+        if not self.limiter.acquire(channel, background):
+            self.log.debug('BreweryDB request budget exhausted, not '
+                           'requesting %s', path)
+            raise BudgetExceeded, path
+        payload['key'] = self.registryValue('apiKey')
+        self.stats.count('api calls')
+        try:
+            with self.stats.timer('http %s' % path):
+                jr = self.brewerydb.get(path, payload,
+                                        self.registryValue('http.timeout'))
+        except RateLimited, e:
+            self.log.warning('BreweryDB is rate limiting requests, pausing '
+                             'them for %d seconds', e.wait)
+            self.stats.count('api rate limited')
+            self.limiter.pause(e.wait)
+            raise
+        if not jr:
+            self.stats.count('api errors')
+        return jr
+
+    def _fetch_random(self, payload, channel=None, background=False):
+        jr = self._request('/beer/random', payload, channel, background)
+        if 'data' in jr and jr['status'] == 'success':
+            if self.registryValue('catalog.enabled'):
+                self.catalog.add(jr['data'])
+            return jr['data']
+        return None
+
+    def _prefetch_random(self):
+        try:
+            return self._fetch_random({'withBreweries': 'Y'},
+                                      background=True)
+        except BudgetExceeded:
+            return None
 
     def random(self, irc, msg, args, text):
         """[<field>,...]
@@ -224,32 +2446,47 @@ class BeerMe(callbacks.Plugin):
         e.g. 'random style,desc,abv'
         """
         self.log.debug('Fetching random beer..')
-        payload = {'key': self.registryValue('apiKey')}
         fields = ['name']
         if text:
             fields.extend(text.split(','))
+        beer = None
+        high = self.registryValue('random.highWatermark')
+        if high > 0:
+            beer = self.random_pool.get(
+                    self.registryValue('random.lowWatermark'), high,
+                    self.registryValue('random.maxAge'))
+        if beer is None:
+            payload = {}
             if 'brew' in fields or 'brewery' in fields:
                 payload['withBreweries'] = 'Y'
-        r = requests.get("%s/beer/random" % self.baseUrl, params=payload)
-        jr = r.json()
-        if 'data' in jr and jr['status'] == 'success':
-            output = self._printFields(jr['data'], fields)
+            channel = msg.args[0]
+            if not irc.isChannel(channel):
+                channel = None
+            try:
+                beer = self._fetch_random(payload, channel)
+            except BudgetExceeded:
+                if self.registryValue('catalog.enabled'):
+                    beer = self.catalog.random()
+        if beer is not None:
+            with self.stats.timer('render random'):
+                output = self._printFields(beer, fields)
             irc.reply(output)
         else:
             irc.reply('The random beers only start after the first seven')
     random = wrap(random, [optional('text')])
 
     def _track(self, channel, beer, nick):
-        self.tracker_db.update(channel,
-                               beer['id'],
-                               beer['name'],
-                               (beer['breweries'][0]['name']
-                                   if ('breweries' in beer
+        self.aliases.add(channel, beer['name'], beer)
+        with self.stats.timer('db tracker.update'):
+            self.tracker_db.update(channel,
+                                   beer['id'],
+                                   beer['name'],
+                                   (beer['breweries'][0]['name']
+                                       if ('breweries' in beer
                                            and 'name' in beer['breweries'][0])
-                                   else ''),
-                               nick,
-                               time.strftime('%B %d, %Y %H:%M',
-                                             time.localtime()))
+                                       else ''),
+                                   nick,
+                                   time.time())
 
     def _match(self, text, beer, search_type):
         match = False
@@ -258,24 +2495,81 @@ class BeerMe(callbacks.Plugin):
                 if term.lower() in beer['name'].lower():
                     match = True
             elif search_type == 'brewery':
-                for brewery in beer['breweries']:
+                for brewery in beer.get('breweries', []):
                     if term.lower() in brewery['name'].lower():
                         match = True
         return match
 
-    def _internal_search(self, text, maxNum, search_type):
-        self.log.debug('Searching beers for %s (%d hits)..' % (text, maxNum))
-        payload = {'key': self.registryValue('apiKey'),
-                   'type': 'beer',
+    def _fetch_search(self, text, search_type, channel=None):
+        cache = self.search_cache
+        cache.size = self.registryValue('search.cacheSize')
+        cache.ttl = self.registryValue('search.cacheTTL')
+        key = cache.key(text, search_type)
+        data = cache.get(key)
+        if data is not None:
+            self.log.debug('Search cache hit for %s' % (key,))
+            return data
+        return self.search_flight.do(
+                key, lambda: self._fetch_upstream(text, key, channel))
+
+    def _fetch_upstream(self, text, key, channel):
+        payload = {'type': 'beer',
                    'withBreweries': 'Y',
                    'q': text}
-        r = requests.get("%s/search" % self.baseUrl, params=payload)
-        self.log.debug('Search URL=[%s]' % r.url)
-        jr = r.json()
+        jr = self._request('/search', payload, channel)
+        if 'data' in jr and jr['status'] == 'success':
+            self.search_cache.put(key, jr['data'])
+            if self.registryValue('catalog.enabled'):
+                for beer in jr['data']:
+                    self.catalog.add(beer)
+            return jr['data']
+        return None
+
+    def _seedAliases(self, channel):
+        """Fills a channel's alias index from the beers it has reviewed and
+        mentioned, the first time it is used."""
+        if self.aliases.seeded(channel):
+            return
+        for db in (self.tracker_db, self.review_db):
+            for r in db.iter_records(channel, ('beer_id', 'name', 'brewery')):
+                self.aliases.add(channel, r.name,
+                                 {'id': r.beer_id, 'name': r.name,
+                                  'breweries': [{'name': r.brewery}]},
+                                 replace=False)
+        self.aliases.mark_seeded(channel)
+
+    def _lookup_beer(self, text, channel):
+        """Resolves <text> to a single beer, from the channel's alias index
+        if it knows the name and by searching otherwise.  Returns the same
+        (hits, reason) as _internal_search."""
+        self._seedAliases(channel)
+        beer = self.aliases.get(channel, text)
+        if beer is not None:
+            return ([beer], '')
+        (beers, reason) = self._internal_search(text, 1, 'beer', channel)
+        if beers:
+            self.aliases.add(channel, beers[0]['name'], beers[0])
+        return (beers, reason)
+
+    def _internal_search(self, text, maxNum, search_type, channel=None):
+        self.log.debug('Searching beers for %s (%d hits)..' % (text, maxNum))
+        hits = []
+        if self.registryValue('catalog.enabled'):
+            hits = self.catalog.search(text, search_type, maxNum)
+            if len(hits) >= maxNum:
+                return (hits, '')
+        try:
+            data = self._fetch_search(text, search_type, channel)
+        except BudgetExceeded:
+            # Over budget: settle for whatever the catalog had.
+            if hits:
+                return (hits, '')
+            return ([], 'Easy there, BreweryDB needs a breather. '
+                        'Try again later')
         hits = []
         reason = ''
-        if 'data' in jr and jr['status'] == 'success':
-            for beer in jr['data']:
+        if data is not None:
+            for beer in data:
                 if (len(hits) + 1) > maxNum:
                     break
                 if self._match(text, beer, search_type):
@@ -314,9 +2608,13 @@ class BeerMe(callbacks.Plugin):
                 except ValueError:
                     irc.reply('Only integers in parentheses next time!')
                 text = text.replace(term, '')
-        (hits, no_hits_reason) = self._internal_search(text, maxNum, search_type)
+        (hits, no_hits_reason) = self._internal_search(text, maxNum, search_type,
+                                                       channel)
         if len(hits) > 0:
-            pretty_hits = [self._printFields(hit, fields) for hit in hits]
+            with self.stats.timer('render search'):
+                pretty_hits = [self._printFields(hit, fields) for hit in hits]
+            for hit in hits:
+                self.aliases.add(channel, hit['name'], hit)
             self._track(channel, hits[0], msg.nick)
             irc.replies(pretty_hits, prefixNick=False)
         else:
@@ -332,71 +2630,119 @@ class BeerMe(callbacks.Plugin):
         and fields must be specified as a comma-separated list in parens 
         e.g. 'Ruination IPA (style,abv,desc)'
         """
-        (hits, no_hits_reason) = self._internal_search(text, 1, 'beer')
+        (hits, no_hits_reason) = self._internal_search(text, 1, 'beer',
+                                                       channel)
         if len(hits) > 0:
             fields = ['name', 'style', 'brewery', 'abv', 'glass', 'desc']
             for term in text.split():
                 if term.startswith('(') and term.endswith(')'):
                     fields = ['name'] + term[1:-1].split(',')
-            pretty_hits = [self._printFields(hit, fields) for hit in hits]
+            with self.stats.timer('render describe'):
+                pretty_hits = [self._printFields(hit, fields)
+                               for hit in hits]
             self._track(channel, hits[0], msg.nick)
             irc.replies(pretty_hits, prefixNick=False)
         else:
             irc.reply(no_hits_reason)
     describe = wrap(describe, ['channel', 'text'])
 
-    def tracker(self, irc, msg, args, channel):
+    def _window(self, optlist):
+        """Returns the (days, nick) a leaderboard's options ask for."""
+        (days, nick) = (None, None)
+        for (opt, arg) in optlist:
+            if opt == 'window':
+                days = self.windows[arg]
+            elif opt == 'nick':
+                nick = arg
+        return (days, nick)
+
+    def tracker(self, irc, msg, args, channel, optlist):
+        """[<channel>] [--window day|week|month|all] [--nick <nick>]
+
+        Returns the most mentioned beers in <channel>, only counting
+        mentions from the last day, week or month, or by <nick>, if given.
+        """
         output = []
-        freq_calculated = []
-        records = self.tracker_db.get_all(channel)
-        for (_, r) in records.iteritems():
-            freq = len(r.refs)
-            mentioners = set([ref[0] for ref in r.refs])
-            freq_calculated.append((freq, mentioners, r))
-        ranked_by_freq = sorted(freq_calculated, reverse=True)[0:10]
-        for i, (freq, ments, r) in enumerate(ranked_by_freq, start=1):
-            nicks = ', '.join([mircColor(m, 'blue') for m in ments])
-            output.append((u" [{rank}] {name} ({brewery}) [{ms} {freq}] "
-                            "[{mrs} {nicks}]"
-                            .format(rank=mircColor(i, 'blue'),
-                                    name=mircColor(r.name, 'orange'),
-                                    brewery=mircColor(r.brewery, 'dark blue'),
-                                    freq=mircColor(freq, 'green'),
-                                    ms=mircColor('Mentions:', 'dark grey'),
-                                    mrs=mircColor('Mentioners:', 'dark grey'),
-                                    nicks=nicks)))
+        (days, nick) = self._window(optlist)
+        with self.stats.timer('db tracker.top'):
+            ranked_by_freq = self.tracker_db.top(channel, 10, days, nick)
+        if len(ranked_by_freq) == 0:
+            irc.reply('No tracked beers!')
+            return
+        with self.stats.timer('render tracker'):
+            for i, (freq, r) in enumerate(ranked_by_freq, start=1):
+                ments = sorted(r.nicks, key=r.nicks.get, reverse=True)
+                nicks = ', '.join([mircColor(m, 'blue') for m in ments])
+                output.append((u" [{rank}] {name} ({brewery}) [{ms} {freq}] "
+                                "[{mrs} {nicks}]"
+                                .format(rank=mircColor(i, 'blue'),
+                                        name=mircColor(r.name, 'orange'),
+                                        brewery=mircColor(r.brewery,
+                                                          'dark blue'),
+                                        freq=mircColor(freq, 'green'),
+                                        ms=self.mentionsLabel,
+                                        mrs=self.mentionersLabel,
+                                        nicks=nicks)))
         irc.replies(output, prefixNick=False)
-    tracker = wrap(tracker, ['channel'])
+    tracker = wrap(tracker, ['channel', getopts(windowOpts)])
 
-    def _show_review(self, irc, channel, beer_id=None, beer_name=None):
+    def _format_review(self, entry):
+        out = [(u"{0} ({1}) [Avg. {2}] [{3} vote{4}]"
+                .format(mircColor(entry.name, 'orange'),
+                        mircColor(entry.brewery, 'dark blue'),
+                        mircColor(entry.rating_avg(), 'green'),
+                        mircColor(entry.votes, 'dark grey'),
+                        's' if int(entry.votes) != 1 else ''))]
+        for review in entry.reviews:
+            r = (u" [{0}][{1}][{2}][{3}]"
+                    .format(mircColor(review['date'], 'dark grey'),
+                            mircColor(review['nick'], 'blue'),
+                            mircColor(('{0:0.1f}'
+                                       .format(float(review['rating']))),
+                                       'green'),
+                            mircColor(review['description'], 'light grey')))
+            out.append(r)
+        return out
+
+    def _snapshotFile(self, channel):
+        return snapshotFile(channel,
+                            self.registryValue('snapshot.directory', channel))
+
+    def _snapshot(self, channel):
+        """Returns <channel>'s review snapshot if it should be read from and
+        has been written, else None."""
+        if not self.registryValue('snapshot.read', channel):
+            return None
+        filename = self._snapshotFile(channel)
+        if filename not in self.snapshots:
+            try:
+                snapshot = BeerSnapshot(filename)
+            except (EnvironmentError, ValueError), e:
+                self.log.warning('BeerMe: could not open snapshot %s: %s',
+                                 filename, e)
+                return None
+            # Another command may have opened it meanwhile.
+            if self.snapshots.setdefault(filename, snapshot) is not snapshot:
+                snapshot.close()
+        return self.snapshots[filename]
+
+    def _show_review(self, irc, channel, beer_id=None, beer_name=None,
+                     snapshot=None):
         try:
             if not beer_id:
-                (beers, reason) = self._internal_search(beer_name, 1, 'beer')
+                (beers, reason) = self._lookup_beer(beer_name, channel)
                 if len(beers) != 1:
                     irc.reply('Cannot find this one: %s' % reason)
                     return
                 beer_id = beers[0]['id']
-            entry = self.review_db.get(channel, beer_id)
-            rating_sum = float(0)
-            for review in entry.reviews:
-                rating_sum = rating_sum + float(review['rating'])
-            num_reviews = len(entry.reviews)
-            rating_avg = rating_sum / num_reviews
-            out = [(u"{0} ({1}) [Avg. {2}] [{3} vote{4}]"
-                    .format(mircColor(entry.name, 'orange'),
-                            mircColor(entry.brewery, 'dark blue'),
-                            mircColor(rating_avg, 'green'),
-                            mircColor(entry.votes, 'dark grey'),
-                            's' if int(entry.votes) != 1 else ''))]
-            for review in entry.reviews:
-                r = (u" [{0}][{1}][{2}][{3}]"
-                        .format(mircColor(review['date'], 'dark grey'),
-                                mircColor(review['nick'], 'blue'),
-                                mircColor(('{0:0.1f}'
-                                           .format(float(review['rating']))),
-                                           'green'),
-                                mircColor(review['description'], 'light grey')))
-                out.append(r)
+            if snapshot is not None:
+                with self.stats.timer('snapshot review.get'):
+                    entry = snapshot.get(beer_id)
+            else:
+                with self.stats.timer('db review.get'):
+                    entry = self.review_db.get(channel, beer_id)
+            with self.stats.timer('render review'):
+                out = self._format_review(entry)
             irc.replies(out, prefixNick=False)
         except KeyError:
             irc.reply('Cannot find a review for \'%s\'' % beer_name)
@@ -406,7 +2752,7 @@ class BeerMe(callbacks.Plugin):
         if len(components) == 3:
             date = time.strftime('%B %d, %Y %H:%M', time.localtime())
             (beer_name, rating, desc) = tuple(components)
-            (beers, reason) = self._internal_search(beer_name, 1, 'beer')
+            (beers, reason) = self._lookup_beer(beer_name, channel)
             if len(beers) == 1:
                 beer = beers[0]
                 review = {'rating': rating.strip(),
@@ -416,9 +2762,11 @@ class BeerMe(callbacks.Plugin):
                 brewery = ''
                 if 'breweries' in beer and 'name' in beer['breweries'][0]:
                     brewery = beer['breweries'][0]['name']
-                self.review_db.update(channel,
-                                      beer['id'], beer['name'], brewery,
-                                      date, msg.nick, review)
+                with self.stats.timer('db review.update'):
+                    self.review_db.update(channel,
+                                          beer['id'], beer['name'], brewery,
+                                          date, msg.nick, review)
+                self.aliases.add(channel, beer['name'], beer)
                 self._show_review(irc, channel, beer_id=beer['id'])
             else:
                 irc.reply('Cannot find this one: %s' % reason)
@@ -427,56 +2775,66 @@ class BeerMe(callbacks.Plugin):
     review = wrap(review, ['channel', 'text'])
 
     def reviews(self, irc, msg, args, channel, text):
-        self._show_review(irc, channel, beer_name=text)
+        self._show_review(irc, channel, beer_name=text,
+                          snapshot=self._snapshot(channel))
     reviews = wrap(reviews, ['channel', 'text'])
 
-    def top(self, irc, msg, args, channel):
-        rating_calculated = []
-        all_beers = self.review_db.get_all(channel)
-        if len(all_beers) == 0:
+    def top(self, irc, msg, args, channel, optlist):
+        """[<channel>] [--window day|week|month|all] [--nick <nick>]
+
+        Returns the best rated beers in <channel>, only counting reviews
+        from the last day, week or month, or by <nick>, if given.
+        """
+        (days, nick) = self._window(optlist)
+        snapshot = self._snapshot(channel)
+        if snapshot is not None and days is None and nick is None:
+            with self.stats.timer('snapshot review.top'):
+                ranked_by_rating = snapshot.top(10)
+        else:
+            with self.stats.timer('db review.top'):
+                ranked_by_rating = self.review_db.top(channel, 10, days,
+                                                      nick)
+        if len(ranked_by_rating) == 0:
             irc.reply('No reviewed beers!')
             return
-        for (beer_id, record) in all_beers.iteritems():
-            rating_sum = float(0)
-            for review in record.reviews:
-                rating_sum = rating_sum + float(review['rating'])
-            num_reviews = len(record.reviews)
-            rating_avg = rating_sum / num_reviews
-            rating_calculated.append((rating_avg, num_reviews, record))
-        output = []
-        ranked_by_rating = sorted(rating_calculated, reverse=True)[0:10]
-        l = [(len(r.name) + len(r.brewery)) for (_, _, r) in ranked_by_rating]
-        max_len = sorted(l, reverse=True)[0] + 11
-        for i, (avg, num, record) in enumerate(ranked_by_rating, start=1):
-            beer_brewery = (u"{0} ({1})"
-                            .format(mircColor(record.name, 'orange'),
-                                    mircColor(record.brewery, 'dark blue')))
-            output.append((u" [{rank}] {beer:{beer_width}} [{avg_str} {avg} "
-                            "({num_reviews} review{rev_plural})] "
-                            "[{num_votes} vote{vote_plural}]"
-                            .format(rank=mircColor(i, 'blue'),
-                                    beer=beer_brewery, beer_width=int(max_len),
-                                    avg_str=mircColor('Avg.', 'dark grey'),
-                                    avg=mircColor('{0:0.1f}'.format(avg),
-                                                  'green'),
-                                    num_reviews=mircColor(num, 'light grey'),
-                                    rev_plural=('s' if num > 1 else ' '),
-                                    num_votes=mircColor(record.votes,
-                                                        'dark grey'),
-                                    vote_plural=('s' if int(record.votes) != 1
-                                                     else ''))))
+        with self.stats.timer('render top'):
+            output = []
+            l = [(len(r.name) + len(r.brewery))
+                 for (_, _, r) in ranked_by_rating]
+            max_len = sorted(l, reverse=True)[0] + 11
+            for i, (avg, num, record) in enumerate(ranked_by_rating, start=1):
+                beer_brewery = (u"{0} ({1})"
+                                .format(mircColor(record.name, 'orange'),
+                                        mircColor(record.brewery,
+                                                  'dark blue')))
+                output.append((u" [{rank}] {beer:{beer_width}} "
+                                "[{avg_str} {avg} "
+                                "({num_reviews} review{rev_plural})] "
+                                "[{num_votes} vote{vote_plural}]"
+                                .format(rank=mircColor(i, 'blue'),
+                                        beer=beer_brewery,
+                                        beer_width=int(max_len),
+                                        avg_str=self.avgLabel,
+                                        avg=mircColor('{0:0.1f}'.format(avg),
+                                                      'green'),
+                                        num_reviews=mircColor(num,
+                                                              'light grey'),
+                                        rev_plural=('s' if num > 1 else ' '),
+                                        num_votes=mircColor(record.votes,
+                                                            'dark grey'),
+                                        vote_plural=(
+                                            's' if int(record.votes) != 1
+                                            else ''))))
         irc.replies(output, prefixNick=False)
-    top = wrap(top, ['channel'])
+    top = wrap(top, ['channel', getopts(windowOpts)])
 
     def _vote(self, irc, msg, args, channel, text, up_vote=True):
         try:
-            (beers, reason) = self._internal_search(text, 1, 'beer')
+            (beers, reason) = self._lookup_beer(text, channel)
             if len(beers) == 1:
                 beer_id = beers[0]['id']
-                entry = self.review_db.get(channel, beer_id)
-                num_votes = ((entry.votes + 1) if up_vote
-                             else ((entry.votes - 1) if entry.votes > 0 else 0))
-                self.review_db.update_votes(channel, beer_id, num_votes)
+                with self.stats.timer('db review.vote'):
+                    self.review_db.vote(channel, beer_id, up_vote)
                 self._show_review(irc, channel, beer_id=beer_id)
             else:
                 irc.reply('Cannot find this one: %s' % reason)
@@ -495,6 +2853,189 @@ class BeerMe(callbacks.Plugin):
         self.random(irc, msg, args)
     beerme = wrap(beerme)
 
+    def _resolve(self, names):
+        """Looks up each of <names> once, waiting for the request budget
+        rather than giving up while today's quota lasts."""
+        found = {}
+        for name in names:
+            hits = []
+            if self.registryValue('catalog.enabled'):
+                hits = self.catalog.search(name, 'beer', 1)
+            while not hits:
+                try:
+                    data = self._fetch_search(name, 'beer')
+                except BudgetExceeded:
+                    if self.limiter.remaining()[0] == 0:
+                        raise
+                    time.sleep(1.0 / self.registryValue('limit.rate'))
+                    continue
+                hits = [beer for beer in data or []
+                        if self._match(name, beer, 'beer')][:1]
+                break
+            if hits:
+                found[name] = hits[0]
+        return found
+
+    def beerimport(self, irc, msg, args, channel, filename):
+        """[<channel>] <filename>
+
+        Bulk-loads reviews, votes and mentions into <channel>'s databases
+        from <filename> in the bot's data directory: a CSV file with a header
+        line, or JSONL as written by beerexport.  Rows may give a beer_id or
+        a beer name to look up; each name is looked up once.
+        """
+        path = conf.supybot.directories.data.dirize(filename)
+        try:
+            fd = open(path)
+        except EnvironmentError, e:
+            irc.error('Could not open %s: %s' % (filename, e))
+            return
+        try:
+            try:
+                (reviews, mentions, skipped) = importRecords(
+                        readRecords(fd, recordFormat(filename)),
+                        self.review_db, self.tracker_db, channel,
+                        self._resolve)
+            except BudgetExceeded:
+                irc.error('BreweryDB request budget ran out while looking '
+                          'up beers; nothing was imported.')
+                return
+            except (ValueError, csv.Error), e:
+                irc.error('Could not read %s: %s' % (filename, e))
+                return
+        finally:
+            fd.close()
+        irc.reply('Imported %d reviews and %d mentions, skipped %d rows.' %
+                  (reviews, mentions, skipped))
+    beerimport = wrap(beerimport, ['owner', 'channel', 'something'])
+
+    def beerexport(self, irc, msg, args, channel, filename):
+        """[<channel>] <filename>
+
+        Writes <channel>'s reviews, votes and mentions as JSONL to
+        <filename> in the bot's data directory.
+        """
+        path = conf.supybot.directories.data.dirize(filename)
+        try:
+            fd = open(path, 'w')
+            try:
+                n = writeRecords(exportRecords(self.review_db,
+                                               self.tracker_db, channel), fd)
+            finally:
+                fd.close()
+        except EnvironmentError, e:
+            irc.error('Could not write %s: %s' % (filename, e))
+            return
+        irc.reply('Exported %d rows to %s.' % (n, filename))
+    beerexport = wrap(beerexport, ['owner', 'channel', 'something'])
+
+    def beersnapshot(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Compiles <channel>'s reviews into its read-only snapshot file in
+        supybot.plugins.BeerMe.snapshot.directory, replacing the previous
+        one.  Bots and processes reading the snapshot pick up the new one
+        within a second.
+        """
+        filename = self._snapshotFile(channel)
+        try:
+            with self.stats.timer('snapshot write'):
+                n = writeSnapshot(filename,
+                                  self.review_db.iter_records(channel))
+        except EnvironmentError, e:
+            irc.error('Could not write %s: %s' % (filename, e))
+            return
+        irc.reply('Wrote %d beers to %s.' % (n, filename))
+    beersnapshot = wrap(beersnapshot, ['owner', 'channel'])
+
+    def _collectStats(self):
+        # Only report on what has been opened rather than opening it.
+        def dbStats(db):
+            return db.loaded is not None and db.loaded.stats() or {}
+        catalog = self.catalog.loaded
+        snapshot = self.stats.snapshot()
+        snapshot['counters'].update({
+            'search cache hits': self.search_cache.hits,
+            'search cache misses': self.search_cache.misses,
+            'searches coalesced': self.search_flight.coalesced,
+            'api throttled': self.limiter.throttled,
+            'catalog hits': getattr(catalog, 'hits', 0),
+            'catalog misses': getattr(catalog, 'misses', 0),
+            'catalog buffered bytes':
+                catalog is not None and catalog.buffered() or 0,
+            'random pool hits': self.random_pool.hits,
+            'random pool fallbacks': self.random_pool.fallbacks,
+            'review db bytes written':
+                dbStats(self.review_db).get('bytes_written', 0)})
+        aliases = dbStats(self.aliases)
+        snapshot['counters'].update({
+            'alias hits': aliases.get('hits', 0),
+            'alias misses': aliases.get('misses', 0),
+            'alias db bytes written': aliases.get('bytes_written', 0)})
+        (daily, tokens) = self.limiter.remaining()
+        snapshot['counters']['api requests left today'] = \
+            'unlimited' if daily is None else daily
+        snapshot['counters']['api burst left'] = tokens
+        snapshot['tracker'] = dbStats(self.tracker_db)
+        snapshot['handles'] = {}
+        for (name, stats) in (('reviews', dbStats(self.review_db)),
+                              ('tracker', snapshot['tracker']),
+                              ('aliases', aliases)):
+            if 'open_handles' in stats:
+                snapshot['handles'][name] = \
+                    dict([(key, stats[key]) for key in
+                          ('open_handles', 'opened_handles',
+                           'evicted_handles', 'buffered_bytes')])
+        return snapshot
+
+    def _dumpStats(self):
+        filename = conf.supybot.directories.data.dirize(
+            self.registryValue('stats.dumpFile'))
+        tmp = filename + '.tmp'
+        try:
+            fd = open(tmp, 'w')
+            try:
+                json.dump(self._collectStats(), fd, indent=2, sort_keys=True)
+            finally:
+                fd.close()
+            os.rename(tmp, filename)
+        except EnvironmentError, e:
+            self.log.warning('BeerMe: could not write stats to %s: %s',
+                             filename, e)
+
+    def beerstats(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the plugin's latency percentiles (p50/p95/p99 in ms) per
+        command, HTTP call, database operation and rendering step, and its
+        API, cache and database counters.
+        """
+        snapshot = self._collectStats()
+        timings = []
+        for (name, t) in sorted(snapshot['timings'].iteritems()):
+            timings.append('%s: %d calls %.0f/%.0f/%.0fms' %
+                           (name, t['count'], t['p50'] * 1000,
+                            t['p95'] * 1000, t['p99'] * 1000))
+        counters = ['%s: %s' % item
+                    for item in sorted(snapshot['counters'].iteritems())]
+        tracker = snapshot['tracker']
+        counters.append('tracker: %d pending, %d batches in %.3fs, '
+                        '%d bytes written' %
+                        (tracker.get('pending', 0),
+                         tracker.get('batches', 0),
+                         tracker.get('batch_time', 0.0),
+                         tracker.get('bytes_written', 0)))
+        handles = ['%s: %d open (%d opened, %d evicted), %d bytes '
+                   'buffered' % (name, h['open_handles'],
+                                 h['opened_handles'], h['evicted_handles'],
+                                 h['buffered_bytes'])
+                   for (name, h) in sorted(snapshot['handles'].iteritems())]
+        irc.reply('; '.join(timings) or 'No timings yet.')
+        irc.reply('; '.join(counters))
+        if handles:
+            irc.reply('Channel databases: ' + '; '.join(handles))
+    beerstats = wrap(beerstats, ['owner'])
+
 
 Class = BeerMe
 
@@ -3,8 +3,748 @@
 # All rights reserved.
 ###
 
+import random
+from cStringIO import StringIO
+
 from supybot.test import *
 
+import supybot.dbi as dbi
+import supybot.cdb as cdb
+import supybot.plugins as plugins
+
+import plugin
+from benchmarks.fakeserver import FakeBreweryDB, loadPayloads
+
+def openDatabases(backend):
+    """Returns the review and tracker databases of <backend> in the data
+    dir, named as the plugin names them."""
+    filename = '.'.join([conf.supybot.directories.data.dirize('BeerMe'),
+                         backend, 'db'])
+    types = {'cdb': (plugin.BeerReviewDB, plugin.BeerTrackerDB),
+             'sqlite3': (plugin.BeerReviewSQLiteDB,
+                         plugin.BeerTrackerSQLiteDB)}
+    return [cls(filename) for cls in types[backend]]
+
+
+def daysAgo(now, days):
+    return time.strftime('%B %d, %Y %H:%M',
+                         time.localtime(now - days * 86400))
+
+
+def fillDatabases(review_db, tracker_db, channel, now):
+    """Reviews and mentions of three beers by three nicks, some from today
+    and some from weeks ago."""
+    review = lambda nick, rating, days: {'nick': nick, 'rating': rating,
+                                         'description': 'by %s' % nick,
+                                         'date': daysAgo(now, days)}
+    review_db.import_reviews(channel, {
+        'b1': ('Ruination IPA', 'Stone', [review('al', '4.5', 0),
+                                          review('bo', '4.0', 3)], 2),
+        'b2': ('Pliny the Elder', 'Russian River', [review('al', '5', 20)],
+               0),
+        'b3': ('Narwhal', 'Sierra Nevada', [review('cy', '3.0', 1),
+                                            review('al', '3.5', 40)], 1)})
+    tracker_db.import_mentions(channel, {
+        'b1': ('Ruination IPA', 'Stone', [('al', now - 10 * 86400),
+                                          ('bo', now - 2 * 86400),
+                                          ('al', now)]),
+        'b2': ('Pliny the Elder', 'Russian River', [('cy', now - 86400)]),
+        'b3': ('Narwhal', 'Sierra Nevada', [('al', now - 30 * 86400)])})
+
+
+def reviewRecords(review_db, channel):
+    return sorted([(r.beer_id, r.name, r.brewery, r.nick, r.date_added,
+                    r.votes, r.reviews, r.rating_sum, r.rating_count)
+                   for r in review_db.iter_records(channel)])
+
+
+def trackerRecords(tracker_db, channel):
+    return sorted([(r.beer_id, r.name, r.brewery, r.count, r.nicks,
+                    r.first_seen, r.last_seen, r.recent)
+                   for r in tracker_db.iter_records(channel)])
+
+
+class BaselineReview(dbi.Record):
+    """A review record as the plugin stored them before rating aggregates."""
+    __fields__ = ['beer_id', 'name', 'brewery', 'nick', 'date_added',
+                  'votes', 'reviews']
+
+
+class BaselineMentions(dbi.Record):
+    """A tracker record as the plugin stored them before mention counters."""
+    __fields__ = ['beer_id', 'name', 'brewery', 'refs']
+
+
+def openBaseline(channel, kind):
+    """Opens the channel's cdb <kind> file, 'reviews' or 'tracker', as a
+    plain cdb."""
+    filename = '.'.join([conf.supybot.directories.data.dirize('BeerMe'),
+                         'cdb', 'db'])
+    return cdb.open('%s.%s' % (plugins.makeChannelFilename(filename, channel),
+                               kind), 'c')
+
+
+def writeBaselineReviews(channel, beers):
+    """Writes <beers>, a dict of beer_id to a list of ratings, to the
+    channel's cdb review file the way the plugin used to."""
+    db = openBaseline(channel, 'reviews')
+    for (beer_id, ratings) in beers.iteritems():
+        reviews = [{'nick': 'al', 'rating': rating, 'description': '',
+                    'date': 'January 01, 2014 12:00'} for rating in ratings]
+        db[beer_id] = BaselineReview(beer_id=beer_id, name=beer_id,
+                                     brewery='', nick='al',
+                                     date_added='January 01, 2014 12:00',
+                                     votes=0, reviews=reviews).serialize()
+    db.close()
+
+
+def baselineTop(beers, num):
+    """Ranks <beers> as top did before rating aggregates: every record
+    scanned, averaged and sorted."""
+    ranked = []
+    for (beer_id, ratings) in beers.iteritems():
+        avg = sum([float(rating) for rating in ratings]) / len(ratings)
+        ranked.append((avg, len(ratings), beer_id))
+    return sorted(ranked, reverse=True)[:num]
+
+
 class BeerMeTestCase(PluginTestCase):
     plugins = ('BeerMe',)
 
+    def testImportCdbMatchesCdb(self):
+        now = time.time()
+        (review_db, tracker_db) = openDatabases('cdb')
+        try:
+            for channel in ('#beer', '#ale'):
+                fillDatabases(review_db, tracker_db, channel, now)
+            tracker_db.update('#ale', 'b4', 'Stone IPA', 'Stone', 'dee',
+                              now)
+            review_db.vote('#ale', 'b2', True)
+            expected = dict([(channel, (reviewRecords(review_db, channel),
+                                        trackerRecords(tracker_db, channel)))
+                             for channel in ('#beer', '#ale')])
+        finally:
+            review_db.close()
+            tracker_db.close()
+        (review_db, tracker_db) = openDatabases('sqlite3')
+        try:
+            self.assertEqual(plugin.importCdb(conf.supybot.directories.data(),
+                                              review_db, tracker_db),
+                             (10, 11))
+            for (channel, (reviews, mentions)) in expected.iteritems():
+                self.assertEqual(reviewRecords(review_db, channel), reviews)
+                self.assertEqual(trackerRecords(tracker_db, channel),
+                                 mentions)
+        finally:
+            review_db.close()
+            tracker_db.close()
+
+    def testExportImportRoundTrip(self):
+        now = time.time()
+        for backend in ('cdb', 'sqlite3'):
+            (review_db, tracker_db) = openDatabases(backend)
+            try:
+                fillDatabases(review_db, tracker_db, '#beer', now)
+                fd = StringIO()
+                self.assertEqual(plugin.writeRecords(
+                    plugin.exportRecords(review_db, tracker_db, '#beer'),
+                    fd), 12)
+                fd.seek(0)
+                def resolve(names):
+                    self.fail('Exported rows should have beer ids: %r' %
+                              names)
+                rows = plugin.readRecords(fd, 'jsonl')
+                self.assertEqual(plugin.importRecords(rows, review_db,
+                                                      tracker_db, '#copy',
+                                                      resolve),
+                                 (5, 5, 0))
+                self.assertEqual(reviewRecords(review_db, '#copy'),
+                                 reviewRecords(review_db, '#beer'))
+                self.assertEqual(trackerRecords(tracker_db, '#copy'),
+                                 trackerRecords(tracker_db, '#beer'))
+            finally:
+                review_db.close()
+                tracker_db.close()
+
+    def testWindowedRankings(self):
+        now = time.time()
+        week = plugin.BeerMe.windows['week']
+        for backend in ('cdb', 'sqlite3'):
+            (review_db, tracker_db) = openDatabases(backend)
+            try:
+                fillDatabases(review_db, tracker_db, '#beer', now)
+                top = lambda days, nick: \
+                    [(r.beer_id, avg, count) for (avg, count, r)
+                     in review_db.top('#beer', 10, days, nick)]
+                tracker = lambda days, nick: \
+                    [(r.beer_id, count, r.nicks) for (count, r)
+                     in tracker_db.top('#beer', 10, days, nick)]
+                self.assertEqual(top(None, None), [('b2', 5.0, 1),
+                                                   ('b1', 4.25, 2),
+                                                   ('b3', 3.25, 2)])
+                self.assertEqual(top(week, None), [('b1', 4.25, 2),
+                                                   ('b3', 3.0, 1)])
+                self.assertEqual(top(None, 'Al'), [('b2', 5.0, 1),
+                                                   ('b1', 4.5, 1),
+                                                   ('b3', 3.5, 1)])
+                self.assertEqual(top(week, 'al'), [('b1', 4.5, 1)])
+                self.assertEqual(top(week, 'dee'), [])
+                self.assertEqual(tracker(None, None),
+                                 [('b1', 3, {'al': 2, 'bo': 1}),
+                                  ('b3', 1, {'al': 1}),
+                                  ('b2', 1, {'cy': 1})])
+                self.assertEqual(tracker(week, None),
+                                 [('b1', 2, {'al': 1, 'bo': 1}),
+                                  ('b2', 1, {'cy': 1})])
+                self.assertEqual(tracker(None, 'al'),
+                                 [('b1', 2, {'al': 2}),
+                                  ('b3', 1, {'al': 1})])
+                self.assertEqual(tracker(week, 'bo'),
+                                 [('b1', 1, {'bo': 1})])
+            finally:
+                review_db.close()
+                tracker_db.close()
+
+    def testSnapshotMatchesDatabase(self):
+        (review_db, tracker_db) = openDatabases('cdb')
+        filename = plugin.snapshotFile('#beer')
+        try:
+            fillDatabases(review_db, tracker_db, '#beer', time.time())
+            self.assertEqual(plugin.writeSnapshot(
+                filename, review_db.iter_records('#beer')), 3)
+            snapshot = plugin.BeerSnapshot(filename)
+            try:
+                fields = lambda r: [getattr(r, name) for name in r.fields]
+                for beer_id in ('b1', 'b2', 'b3'):
+                    self.assertEqual(fields(snapshot.get(beer_id)),
+                                     fields(review_db.get('#beer', beer_id)))
+                self.assertEqual([(avg, count, fields(r)) for (avg, count, r)
+                                  in snapshot.top(10)],
+                                 [(avg, count, fields(r)) for (avg, count, r)
+                                  in review_db.top('#beer', 10)])
+                self.assertEqual([r.beer_id for (_, _, r)
+                                  in snapshot.top(2)], ['b2', 'b1'])
+                self.assertRaises(KeyError, snapshot.get, 'b0')
+                self.assertRaises(KeyError, snapshot.get, 'b4')
+            finally:
+                snapshot.close()
+        finally:
+            review_db.close()
+            tracker_db.close()
+        filename = plugin.snapshotFile('#empty')
+        self.assertEqual(plugin.writeSnapshot(filename, []), 0)
+        snapshot = plugin.BeerSnapshot(filename)
+        try:
+            self.assertEqual(snapshot.top(10), [])
+            self.assertRaises(KeyError, snapshot.get, 'b1')
+        finally:
+            snapshot.close()
+
+    def testLimiterKeepsDailyUsage(self):
+        filename = conf.supybot.directories.data.dirize('limit.json')
+        cb = self.irc.getCallback('BeerMe')
+        limiter = plugin.BreweryDBLimiter(filename, cb.log)
+        for i in range(3):
+            self.failUnless(limiter.acquire('#beer'))
+        limiter.flush()
+        limiter = plugin.BreweryDBLimiter(filename, cb.log)
+        self.assertEqual((limiter.day, limiter.used),
+                         (time.gmtime()[:3], 3))
+        self.failUnless(limiter.acquire())
+        self.assertEqual(limiter.used, 4)
+        limiter.day = (2014, 1, 1)
+        limiter.flush()
+        limiter = plugin.BreweryDBLimiter(filename, cb.log)
+        self.failUnless(limiter.acquire())
+        self.assertEqual(limiter.used, 1)
+
+    def testLookupAliasesBeerNamesOnly(self):
+        cb = self.irc.getCallback('BeerMe')
+        beer = {'id': 'b1', 'name': 'Ruination IPA',
+                'breweries': [{'name': 'Stone'}]}
+        searches = []
+        def search(text, maxNum, search_type, channel=None):
+            searches.append(text)
+            return ([beer], '')
+        cb._internal_search = search
+        for text in ('ruination', 'ruination', 'Ruination  ipa'):
+            self.assertEqual(cb._lookup_beer(text, '#beer')[0][0]['id'],
+                             'b1')
+        self.assertEqual(searches, ['ruination', 'ruination'])
+        self.assertEqual(cb.aliases.get('#beer', 'ruination'), None)
+
+    def testSearchCacheExpires(self):
+        cache = plugin.BeerSearchCache(4, 0.05)
+        key = cache.key('  Pliny  the ELDER', 'beer')
+        self.assertEqual(key, ('pliny the elder', 'beer'))
+        cache.put(key, ['pliny'])
+        self.assertEqual(cache.get(key), ['pliny'])
+        time.sleep(0.1)
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testSearchCacheEvictsLeastRecentlyUsed(self):
+        cache = plugin.BeerSearchCache(2, 3600)
+        cache.put('pliny', 1)
+        cache.put('stone', 2)
+        self.assertEqual(cache.get('pliny'), 1)
+        cache.put('narwhal', 3)
+        self.assertEqual(cache.get('stone'), None)
+        self.assertEqual(cache.get('pliny'), 1)
+        self.assertEqual(cache.get('narwhal'), 3)
+        self.assertEqual(len(cache.entries), 2)
+        cache.size = 0
+        cache.put('stone', 2)
+        self.assertEqual(cache.get('stone'), None)
+
+    def testRandomPoolRefillsAFewAtATime(self):
+        fetched = []
+        fetching = threading.Event()
+        def fetch():
+            fetching.set()
+            time.sleep(0.05)
+            fetched.append(len(fetched))
+            return {'id': 'r%d' % fetched[-1]}
+        pool = plugin.RandomBeerPool(fetch)
+        # As if random had been busy, so the pool may fill up to high.
+        pool.asked.extend([time.time()] * 10)
+        self.assertEqual(pool.get(3, 10, 3600), None)
+        pool.thread.join()
+        self.assertEqual(len(fetched), pool.batch)
+        fetching.clear()
+        self.assertEqual(pool.get(3, 10, 3600), {'id': 'r0'})
+        # Closing waits for the refill under way, which stops early.
+        fetching.wait()
+        pool.close()
+        self.failIf(pool.thread.isAlive())
+        self.assertEqual(len(fetched), pool.batch + 1)
+        self.assertEqual(pool.get(3, 10, 3600), {'id': 'r1'})
+        self.failIf(pool.thread.isAlive())
+        self.assertEqual(len(fetched), pool.batch + 1)
+
+    def testRandomPoolOnlyPrefetchesWhatWasAskedFor(self):
+        fetched = []
+        def fetch():
+            fetched.append(len(fetched))
+            return {'id': 'r%d' % fetched[-1]}
+        pool = plugin.RandomBeerPool(fetch)
+        for i in range(3):
+            self.assertEqual(pool.get(3, 10, 0.05), None)
+            time.sleep(0.1)
+        self.assertEqual(pool.thread, None)
+        self.assertEqual((len(fetched), pool.fallbacks), (0, 3))
+        # Asked for twice within maxAge, so the next one is prefetched.
+        self.assertEqual(pool.get(3, 10, 3600), None)
+        self.assertEqual(pool.get(3, 10, 3600), None)
+        pool.thread.join()
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(pool.get(3, 10, 3600), {'id': 'r0'})
+        pool.close()
+
+    def testSnapshotFilePerChannel(self):
+        directory = os.path.join(conf.supybot.directories.data(), 'shared')
+        beer = plugin.snapshotFile('#beer', directory)
+        ale = plugin.snapshotFile('#ale', directory)
+        self.assertNotEqual(beer, ale)
+        for filename in (beer, ale):
+            self.failUnless(filename.startswith(directory + os.sep),
+                            filename)
+        self.assertEqual(plugin.snapshotFile('#Beer', directory), beer)
+        self.assertNotEqual(plugin.snapshotFile('#beer'), beer)
+
+    def testCatalogSearch(self):
+        names = lambda beers: sorted([beer['name'] for beer in beers])
+        catalog = plugin.BeerCatalog(
+                conf.supybot.directories.data.dirize('catalog.db'))
+        try:
+            self.assertEqual(catalog.random(), None)
+            beers = loadPayloads()
+            for beer in beers:
+                catalog.add(beer)
+            changed = dict(beers[-1], abv='7.0')
+            catalog.add(changed)
+            self.assertEqual(catalog.db['n:stone'].split(),
+                             ['tGVYBe', 'dKJ4pS'])
+            # Both of Stone Xocoveza's breweries are Brewing ones.
+            self.assertEqual(catalog.db['w:brewing'].split().count('dKJ4pS'),
+                             1)
+            self.assertEqual(names(catalog.search('ston', 'beer', 5)),
+                             ['Stone IPA', 'Stone Xocoveza'])
+            self.assertEqual(names(catalog.search('Stone IPA', 'beer', 5)),
+                             ['Stone IPA'])
+            (hit,) = catalog.search('xocoveza', 'beer', 5)
+            self.assertEqual(hit['abv'], '7.0')
+            self.assertEqual(names(catalog.search('sierra', 'brewery', 5)),
+                             ['Narwhal Imperial Stout',
+                              'Sierra Nevada Pale Ale', 'Stone Xocoveza'])
+            self.assertEqual(catalog.search('brewing', 'beer', 5), [])
+            self.failUnless(catalog.random()['id'] in
+                            [beer['id'] for beer in beers])
+            self.failUnless(catalog.buffered())
+            catalog.flush()
+            self.assertEqual(catalog.buffered(), 0)
+            self.assertEqual(names(catalog.search('ston', 'beer', 5)),
+                             ['Stone IPA', 'Stone Xocoveza'])
+            catalog.reopenEvery = 2
+            for beer in beers:
+                catalog.add(dict(beer, abv='1.0'))
+            self.failUnless(catalog.writes < 2)
+        finally:
+            catalog.close()
+        catalog = plugin.BeerCatalog(
+                conf.supybot.directories.data.dirize('catalog.db'))
+        try:
+            self.assertEqual(names(catalog.search('pliny', 'beer', 5)),
+                             ['Pliny the Elder'])
+        finally:
+            catalog.close()
+
+    def testReviewMigrationMatchesFullScan(self):
+        rng = random.Random(0)
+        beers = dict([('b%d' % i,
+                       [str(rng.randint(10, 50) / 10.0)
+                        for j in range(rng.randint(1, 4))])
+                      for i in range(30)])
+        writeBaselineReviews('#beer', beers)
+        for migrated in (False, True):
+            (review_db, tracker_db) = openDatabases('cdb')
+            try:
+                for num in (10, 25):
+                    self.assertEqual([(avg, count, record.beer_id)
+                                      for (avg, count, record)
+                                      in review_db.top('#beer', num)],
+                                     baselineTop(beers, num))
+                for (beer_id, ratings) in beers.iteritems():
+                    record = review_db.get('#beer', beer_id)
+                    self.assertEqual([r['rating'] for r in record.reviews],
+                                     ratings)
+                    self.assertEqual(record.rating_count, len(ratings))
+                if migrated:
+                    self.assertEqual(review_db.stats()['bytes_written'], 0)
+                else:
+                    self.failUnless(review_db.stats()['bytes_written'])
+            finally:
+                review_db.close()
+                tracker_db.close()
+
+    def testTrackerMigrationKeepsMentions(self):
+        refs = {'b1': [('al', 'January 01, 2014 12:00'),
+                       ('bo', 'March 05, 2014 18:30'),
+                       ('al', 'sometime last spring'),
+                       ('al', 'February 10, 2014 09:15')],
+                'b2': [('cy', '')]}
+        db = openBaseline('#beer', 'tracker')
+        for (beer_id, mentions) in refs.iteritems():
+            db[beer_id] = BaselineMentions(beer_id=beer_id, name=beer_id,
+                                           brewery='Stone',
+                                           refs=mentions).serialize()
+        db.close()
+        keep = conf.supybot.plugins.BeerMe.tracker.recent()
+        for migrated in (False, True):
+            (review_db, tracker_db) = openDatabases('cdb')
+            try:
+                b1 = tracker_db.get('#beer', 'b1')
+                self.assertEqual((b1.count, b1.nicks, b1.refs),
+                                 (4, {'al': 3, 'bo': 1}, []))
+                self.assertEqual((b1.first_seen, b1.last_seen),
+                                 (plugin.parseDate('January 01, 2014 12:00'),
+                                  plugin.parseDate('March 05, 2014 18:30')))
+                self.assertEqual(b1.recent,
+                                 [(nick, plugin.parseDate(date))
+                                  for (nick, date) in refs['b1']][-keep:])
+                b2 = tracker_db.get('#beer', 'b2')
+                self.assertEqual((b2.count, b2.nicks, b2.first_seen,
+                                  b2.last_seen),
+                                 (1, {'cy': 1}, None, None))
+                self.assertEqual([(count, record.beer_id) for
+                                  (count, record) in
+                                  tracker_db.top('#beer', 5)],
+                                 [(4, 'b1'), (1, 'b2')])
+                if migrated:
+                    self.assertEqual(tracker_db.stats()['bytes_written'], 0)
+            finally:
+                review_db.close()
+                tracker_db.close()
+
+    def trackerReply(self, channel):
+        return ircutils.stripFormatting(
+                self.getMsg('tracker %s' % channel).args[1])
+
+    def testPendingMentionsSurviveFlushAndUnload(self):
+        group = conf.supybot.plugins.BeerMe
+        ruination = {'id': 'b1', 'name': 'Ruination IPA',
+                     'breweries': [{'name': 'Stone'}]}
+        narwhal = {'id': 'b3', 'name': 'Narwhal',
+                   'breweries': [{'name': 'Sierra Nevada'}]}
+        (backend, interval) = (group.database(), group.tracker.batchInterval())
+        group.tracker.batchInterval.setValue(3600)
+        try:
+            for name in ('cdb', 'sqlite3'):
+                group.database.setValue(name)
+                self.assertNotError('reload BeerMe')
+                cb = self.irc.getCallback('BeerMe')
+                for (beer, nick) in ((ruination, 'al'), (narwhal, 'bo'),
+                                     (ruination, 'bo')):
+                    cb._track('#flushed', beer, nick)
+                self.failUnless(group.tracker.batchSize() > 3)
+                self.assertEqual(cb.tracker_db.stats()['pending'], 3)
+                cb.tracker_db.flush()
+                self.assertEqual(cb.tracker_db.stats()['pending'], 0)
+                cb._track('#unloaded', narwhal, 'cy')
+                cb._track('#unloaded', narwhal, 'al')
+                self.assertEqual(cb.tracker_db.stats()['pending'], 2)
+                self.assertNotError('reload BeerMe')
+                reply = self.trackerReply('#flushed')
+                self.failUnless(re.search(r'\[1\] Ruination IPA \(Stone\) '
+                                          r'\[Mentions: 2\] .* \[2\] Narwhal '
+                                          r'\(Sierra Nevada\) '
+                                          r'\[Mentions: 1\] ', reply), reply)
+                reply = self.trackerReply('#unloaded')
+                self.failUnless(reply.startswith(
+                    ' [1] Narwhal (Sierra Nevada) [Mentions: 2] '), reply)
+                self.failIf('[2]' in reply, reply)
+        finally:
+            group.database.setValue(backend)
+            group.tracker.batchInterval.setValue(interval)
+
+    def testOneOpenDatabaseLosesNothing(self):
+        maxOpen = conf.supybot.plugins.BeerMe.db.maxOpen()
+        conf.supybot.plugins.BeerMe.db.maxOpen.setValue(1)
+        now = time.time()
+        channels = ('#beer', '#ale')
+        def review(channel, i):
+            return {'nick': 'al', 'rating': str(i % 5 + 1),
+                    'description': '%s %d' % (channel, i),
+                    'date': daysAgo(now, 0)}
+        try:
+            (review_db, tracker_db) = openDatabases('cdb')
+            try:
+                # Every call opens its channel's database and closes the
+                # other's, with mentions still buffered in it.
+                for i in range(10):
+                    for channel in channels:
+                        review_db.update(channel, 'b%d' % (i % 3), 'Beer',
+                                         'Stone', daysAgo(now, 0), 'al',
+                                         review(channel, i))
+                        tracker_db.update(channel, 'b%d' % (i % 3), 'Beer',
+                                          'Stone', 'al', now)
+                stats = review_db.stats()
+                self.assertEqual(stats['open_handles'], 1)
+                self.failUnless(stats['evicted_handles'] >= 19)
+                # While an iterator pins #beer, #ale is what gets closed,
+                # even though #beer was used longer ago.
+                records = review_db.iter_records('#beer')
+                first = records.next()
+                for i in range(10, 20):
+                    review_db.update('#ale', 'b%d' % (i % 3), 'Beer',
+                                     'Stone', daysAgo(now, 0), 'al',
+                                     review('#ale', i))
+                    self.assertEqual(review_db.dbs.keys(), ['#beer'])
+                self.assertEqual(len([first] + list(records)), 3)
+                review_db.update('#ale', 'b0', 'Beer', 'Stone',
+                                 daysAgo(now, 0), 'al', review('#ale', 20))
+                self.assertEqual(review_db.dbs.keys(), ['#ale'])
+                # Threads writing two channels at once only ever close a
+                # database neither of them is using.
+                def write(channel):
+                    for i in range(21, 61):
+                        review_db.update(channel, 'b%d' % (i % 3), 'Beer',
+                                         'Stone', daysAgo(now, 0), 'al',
+                                         review(channel, i))
+                        tracker_db.update(channel, 'b%d' % (i % 3), 'Beer',
+                                          'Stone', 'al', now)
+                threads = [threading.Thread(target=write, args=(channel,))
+                           for channel in channels]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                review_db.close()
+                tracker_db.close()
+            (review_db, tracker_db) = openDatabases('cdb')
+            try:
+                for (channel, reviews) in (('#beer', 50), ('#ale', 61)):
+                    records = list(review_db.iter_records(channel))
+                    self.assertEqual(sum([r.rating_count for r in records]),
+                                     reviews)
+                    self.assertEqual(sum([len(r.reviews) for r in records]),
+                                     reviews)
+                    self.assertEqual(sum([r.count for r in
+                                          tracker_db.iter_records(channel)]),
+                                     50)
+            finally:
+                review_db.close()
+                tracker_db.close()
+        finally:
+            conf.supybot.plugins.BeerMe.db.maxOpen.setValue(maxOpen)
+
+    def testConcurrentReviewsAndVotes(self):
+        now = time.time()
+        for backend in ('cdb', 'sqlite3'):
+            (review_db, tracker_db) = openDatabases(backend)
+            done = threading.Event()
+            def write(n):
+                for i in range(50):
+                    review_db.update('#beer', 'b%d' % (i % 4), 'Beer',
+                                     'Stone', daysAgo(now, 0), 'n%d' % n,
+                                     {'nick': 'n%d' % n, 'rating': '4.0',
+                                      'description': '',
+                                      'date': daysAgo(now, 0)})
+                    review_db.vote('#beer', 'b0', True)
+            def flush():
+                while not done.isSet():
+                    review_db.flush()
+                    time.sleep(0.001)
+            try:
+                review_db.update('#beer', 'b0', 'Beer', 'Stone',
+                                 daysAgo(now, 0), 'al',
+                                 {'nick': 'al', 'rating': '4.0',
+                                  'description': '', 'date': daysAgo(now, 0)})
+                flusher = threading.Thread(target=flush)
+                flusher.start()
+                writers = [threading.Thread(target=write, args=(n,))
+                           for n in range(8)]
+                for thread in writers:
+                    thread.start()
+                for thread in writers:
+                    thread.join()
+                done.set()
+                flusher.join()
+                records = list(review_db.iter_records('#beer'))
+                self.assertEqual(sum([len(r.reviews) for r in records]), 401)
+                self.assertEqual(review_db.get('#beer', 'b0').votes, 400)
+            finally:
+                done.set()
+                review_db.close()
+                tracker_db.close()
+
+
+class FakeServerMixin:
+    """Runs the plugin against a local fake BreweryDB serving the sample
+    payloads."""
+    plugins = ('BeerMe',)
+    latency = 0.0
+
+    def setUp(self):
+        self.server = FakeBreweryDB(latency=self.latency).start()
+        self.config = {'supybot.plugins.BeerMe.apiUrl': self.server.url}
+        ChannelPluginTestCase.setUp(self)
+        self.cb = self.irc.getCallback('BeerMe')
+
+    def tearDown(self):
+        ChannelPluginTestCase.tearDown(self)
+        self.server.stop()
+
+    def takeReplies(self, count):
+        """Returns the next <count> replies, waiting for them as long as a
+        single command may take."""
+        replies = []
+        deadline = time.time() + self.timeout
+        while len(replies) < count and time.time() < deadline:
+            m = self.irc.takeMsg()
+            if m is None:
+                time.sleep(0.01)
+            else:
+                replies.append(m.args[1])
+        return replies
+
+
+class BeerMeSingleFlightTestCase(FakeServerMixin, ChannelPluginTestCase):
+    # Long enough that every command is waiting on the first one's search.
+    latency = 0.5
+
+    def testConcurrentSearchesShareOneRequest(self):
+        for i in range(8):
+            self.feedMsg('@describe Ruination IPA')
+        replies = self.takeReplies(8)
+        self.assertEqual(len(replies), 8)
+        for reply in replies:
+            self.failUnless('Ruination IPA' in reply, reply)
+        self.assertEqual(self.server.count('/search'), 1)
+        self.assertEqual(self.cb.search_flight.coalesced, 7)
+
+
+class BeerMeFakeServerTestCase(FakeServerMixin, ChannelPluginTestCase):
+    def loaded(self, cb):
+        return [resource.loaded is not None
+                for resource in cb._databases() + [cb.brewerydb]]
+
+    def testResourcesLoadOnFirstUse(self):
+        # review_db, tracker_db, aliases, catalog, brewerydb
+        self.assertEqual(self.loaded(self.cb), [False] * 5)
+        self.assertRegexp('BeerMe search pliny', 'Pliny the Elder')
+        self.assertEqual(self.loaded(self.cb)[3:], [True, True])
+        self.failIf(self.loaded(self.cb)[0])
+        self.assertNotError('top')
+        self.assertEqual(self.loaded(self.cb), [True] * 5)
+
+    def testDieBeforeFirstUse(self):
+        cb = plugin.Class(self.irc)
+        flushers = len(world.flushers)
+        cb.die()
+        self.assertEqual(self.loaded(cb), [False] * 5)
+        self.assertEqual(len(world.flushers), flushers - 5)
+
+    def testRepeatedSearchIsCached(self):
+        enabled = conf.supybot.plugins.BeerMe.catalog.enabled()
+        conf.supybot.plugins.BeerMe.catalog.enabled.setValue(False)
+        try:
+            self.assertRegexp('BeerMe search pliny', 'Pliny the Elder')
+            self.assertRegexp('BeerMe search  PLINY', 'Pliny the Elder')
+            self.assertEqual(self.server.count('/search'), 1)
+            self.assertEqual(self.cb.search_cache.hits, 1)
+            self.assertRegexp('BeerMe search stone', 'Stone IPA')
+            self.assertEqual(self.server.count('/search'), 2)
+        finally:
+            conf.supybot.plugins.BeerMe.catalog.enabled.setValue(enabled)
+
+    def testQuietRandomDoesNotPrefetch(self):
+        maxAge = conf.supybot.plugins.BeerMe.random.maxAge()
+        conf.supybot.plugins.BeerMe.random.maxAge.setValue(1)
+        try:
+            for i in range(3):
+                self.assertNotError('BeerMe random')
+                time.sleep(1.1)
+        finally:
+            conf.supybot.plugins.BeerMe.random.maxAge.setValue(maxAge)
+        self.assertEqual(self.cb.random_pool.thread, None)
+        self.assertEqual(self.server.count('/beer/random'), 3)
+
+    def testCatalogMissFallsBackToBreweryDB(self):
+        catalog = self.cb.catalog
+        (hits, reason) = self.cb._internal_search('Pliny the Elder', 1,
+                                                  'beer', self.channel)
+        self.assertEqual([beer['name'] for beer in hits], ['Pliny the Elder'])
+        self.assertEqual((catalog.hits, catalog.misses), (0, 1))
+        self.assertEqual(self.server.count('/search'), 1)
+        (hits, reason) = self.cb._internal_search('Pliny the Elder', 1,
+                                                  'beer', self.channel)
+        self.assertEqual([beer['name'] for beer in hits], ['Pliny the Elder'])
+        self.assertEqual((catalog.hits, catalog.misses), (1, 1))
+        self.assertEqual(self.server.count('/search'), 1)
+
+    def testRetriesCountAgainstDailyQuota(self):
+        backoff = conf.supybot.plugins.BeerMe.http.backoff()
+        conf.supybot.plugins.BeerMe.http.backoff.setValue(0.01)
+        try:
+            self.server.failures = [503, 503]
+            jr = self.cb._request('/beer/random', {}, self.channel)
+        finally:
+            conf.supybot.plugins.BeerMe.http.backoff.setValue(backoff)
+        self.assertEqual(jr['status'], 'success')
+        self.assertEqual(self.server.count('/beer/random'), 3)
+        self.assertEqual(self.cb.limiter.used, 3)
+        self.assertEqual(self.cb.stats.counters['api retries'], 2)
+
+    def testRateLimitPausesRequests(self):
+        self.server.failures = [429]
+        self.assertRaises(plugin.RateLimited, self.cb._request,
+                          '/beer/random', {}, self.channel)
+        self.assertEqual(self.server.count('/beer/random'), 1)
+        self.failUnless(self.cb.limiter.paused_until > time.time() + 25)
+        self.assertRaises(plugin.BudgetExceeded, self.cb._request,
+                          '/beer/random', {}, self.channel)
+        self.assertRegexp('BeerMe search pliny', 'breather')
+        self.assertEqual(len(self.server.calls), 1)